@@ -1,5 +1,13 @@
+import atexit
+import base64
+import itertools
 import math
+import multiprocessing
 import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
 import warnings
@@ -14,6 +22,184 @@ from .cube_config import CubeConfig, CUBE_CHANGELOG
 # from .cube_provider import CubeSourceProvider
 from .version import version as __version__
 
+# The provider instances of a worker process, see Cube.update_many()
+_worker_providers = None
+
+
+def _init_worker_providers(providers):
+    global _worker_providers
+    _worker_providers = providers
+    for provider in _worker_providers:
+        if hasattr(provider, 'image_prefetch_depth'):
+            # Every worker computes other periods, the source images of the next periods would be read in vain
+            provider.image_prefetch_depth = 0
+        provider.prepare()
+    # Workers exit normally when the pool is shut down, close datasets and stop background threads then
+    atexit.register(_close_worker_providers)
+
+
+def _close_worker_providers():
+    global _worker_providers
+    if _worker_providers is not None:
+        for provider in _worker_providers:
+            provider.close()
+        _worker_providers = None
+
+
+def _compute_worker_images(provider_index, period_start, period_end):
+    return _worker_providers[provider_index].compute_variable_images(period_start, period_end)
+
+
+class _ImageBlock:
+    """
+    A reusable buffer for the images of one write batch of *size* consecutive time steps of all variables
+    in *datasets*. Computed images are copied into the block right away, so that no list of images and
+    no intermediate image stack has to be kept. Zarr is given contiguous slabs of the block.
+    """
+
+    def __init__(self, datasets, size):
+        self._fill_values = {var_name: ds.fill_value for var_name, ds in datasets.items()}
+        self.arrays = {var_name: np.empty((size,) + ds.shape[1:], ds.dtype) for var_name, ds in datasets.items()}
+        self.size = size
+        # The first time index of the batch
+        self.i0 = None
+        # Maps variable names to the range (i1, iend) of time indices put into the block
+        self.ranges = {}
+
+    @property
+    def empty(self) -> bool:
+        return not self.ranges
+
+    def reset(self):
+        self.i0 = None
+        self.ranges = {}
+
+    def get_end_index(self, var_name):
+        """Return the time index following the last one put for variable *var_name*, or None."""
+        time_range = self.ranges.get(var_name)
+        return time_range[1] if time_range else None
+
+    def put(self, time_index, var_name_to_image):
+        """
+        Copy the images of *time_index*. Time steps of a variable skipped since its last image
+        are set to fill values.
+        """
+        if self.i0 is None:
+            self.i0 = time_index - time_index % self.size
+        for var_name, image in var_name_to_image.items():
+            array = self.arrays[var_name]
+            i1, iend = self.ranges.get(var_name, (time_index, time_index))
+            array[iend - self.i0:time_index - self.i0] = self._fill_values[var_name]
+            array[time_index - self.i0] = image
+            self.ranges[var_name] = i1, time_index + 1
+
+    def get_slab(self, var_name):
+        """Return the view of the filled time steps of variable *var_name*."""
+        i1, iend = self.ranges[var_name]
+        return self.arrays[var_name][i1 - self.i0:iend - self.i0]
+
+
+class _CompletionLedger:
+    """
+    Records for every variable in *datasets* which time indices have been completely written.
+    The records are kept as compact bitmaps in the zarr group attribute ``cube.completed``,
+    so that an interrupted update can skip the completed time steps when it is run again.
+    The records are updated by the writer thread while the main thread queries them, so all
+    accesses are serialized by a lock.
+    """
+
+    ATTR_NAME = 'cube.completed'
+
+    def __init__(self, zgroup, datasets):
+        self._zgroup = zgroup
+        self._lock = threading.Lock()
+        completed = zgroup.attrs.get(self.ATTR_NAME, {})
+        self._bitmaps = {var_name: self._decode(completed.get(var_name), ds.shape[0])
+                         for var_name, ds in datasets.items()}
+
+    def is_completed(self, time_index, var_names) -> bool:
+        """Whether *time_index* has been written for all variables in *var_names*."""
+        with self._lock:
+            return all(self._bitmaps[var_name][time_index] for var_name in var_names)
+
+    def any_completed(self, var_name, i0, iend) -> bool:
+        """Whether any time index in the range *i0* to *iend* (exclusive) has been written for *var_name*."""
+        with self._lock:
+            return bool(self._bitmaps[var_name][i0:iend].any())
+
+    def set_completed(self, ranges):
+        """
+        Record time indices as written and persist the records.
+
+        :param ranges: Maps variable names to ranges (i0, iend) of written time indices.
+        """
+        with self._lock:
+            for var_name, (i0, iend) in ranges.items():
+                self._bitmaps[var_name][i0:iend] = True
+            completed = dict(self._zgroup.attrs.get(self.ATTR_NAME, {}))
+            completed.update({var_name: self._encode(bitmap) for var_name, bitmap in self._bitmaps.items()})
+            self._zgroup.attrs[self.ATTR_NAME] = completed
+
+    @staticmethod
+    def _encode(bitmap):
+        return base64.b64encode(np.packbits(bitmap).tobytes()).decode('ascii')
+
+    @staticmethod
+    def _decode(text, size):
+        bitmap = np.zeros(size, dtype=bool)
+        if text:
+            bits = np.unpackbits(np.frombuffer(base64.b64decode(text), dtype=np.uint8)).astype(bool)
+            n = min(size, bits.size)
+            bitmap[:n] = bits[:n]
+        return bitmap
+
+
+class _ImageWriter:
+    """
+    Calls *write_func* on a background thread for every batch of images passed to **write()**,
+    so that the computation of the next images overlaps with compressing and writing the previous ones.
+    At most *queue_size* batches are waiting to be written, further calls to **write()** block.
+    """
+
+    def __init__(self, write_func, queue_size):
+        self._write_func = write_func
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='esdl-cube-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, *args):
+        while True:
+            self.raise_error()
+            try:
+                self._queue.put(args, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        """Wait until all pending batches have been written."""
+        self._queue.put(None)
+        self._thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        """Re-raise the error raised by the last failed write, if any."""
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                break
+            # After an error, keep consuming so that producers never block on a full queue
+            if self._error is None:
+                try:
+                    self._write_func(*args)
+                except BaseException as e:
+                    self._error = e
+
 
 class Cube:
     """
@@ -63,7 +249,7 @@ class Cube:
         The cube's data represented as an xarray dataset
         """
         if not self._data:
-            self._data = xr.open_zarr(self.base_dir)
+            self._data = xr.open_zarr(self.base_dir, consolidated=self._has_consolidated_metadata(self.base_dir))
         return self._data
 
     @staticmethod
@@ -78,7 +264,10 @@ class Cube:
 
         if not os.path.exists(base_dir):
             raise IOError('data cube base directory does not exists: %s' % base_dir)
-        zg = zarr.open_group(base_dir)
+        if Cube._has_consolidated_metadata(base_dir):
+            zg = zarr.open_consolidated(base_dir)
+        else:
+            zg = zarr.open_group(base_dir)
 
         # Construct a CubeConfig object from the zarr attributes.
         # datetime values have to be parsed
@@ -104,13 +293,9 @@ class Cube:
         if os.path.exists(base_dir):
             raise IOError('data cube base directory exists: %s' % base_dir)
 
-        num_periods_per_year = config.num_periods_per_year
         bndsdim = ('bnds', [0, 1])
 
-        temporal_res = config.temporal_res
-        start_year = config.start_time.year
-        end_year = config.end_time.year
-        start_nums = [config.date2num(datetime(yr, 1, 1)) for yr in range(start_year, end_year)]
+        time_vals, time_bnds_vals = Cube._get_time_values(config, config.start_time.year, config.end_time.year)
 
         time_bnds_attrs = {
             'units': config.time_units,
@@ -118,20 +303,6 @@ class Cube:
             '_ARRAY_DIMENSIONS': ['time', 'bnds']
         }
 
-        def correctub(sn, temporal_res, i, ntot):
-            if i == (ntot-1):
-                return sn+366
-            else:
-                return sn + temporal_res * (i + 1.0)
-
-        lower_bounds = [sn + temporal_res * (i + 0.0)
-                        for sn in start_nums for i in range(num_periods_per_year)]
-        upper_bounds = [correctub(sn, temporal_res, i, num_periods_per_year)
-                        for sn in start_nums for i in range(num_periods_per_year)]
-        time_bnds_vals = np.zeros((len(lower_bounds), 2))
-        time_bnds_vals[:, 0] = lower_bounds
-        time_bnds_vals[:, 1] = upper_bounds
-
         time_attrs = {
             'long_name': 'time',
             'standard_name': 'time',
@@ -140,8 +311,6 @@ class Cube:
             'bounds': 'time_bnds',
             '_ARRAY_DIMENSIONS': ['time'],
         }
-        time_vals = [sn + temporal_res * (i + 0.5)
-                     for sn in start_nums for i in range(num_periods_per_year)]
         # times[-1] = var_time_bnds[-1,0] + (var_time_bnds[-1,1] - var_time_bnds[-1,0]) / 2.
         # Thus, we keep date of the last time range always at Julian day 364, not in the center of the period.
         # The time bounds then specify the real extent of the period.
@@ -213,58 +382,397 @@ class Cube:
 
         z = zarr.open_group(base_dir)
         z.attrs['cube.config'] = configdict
+        zarr.consolidate_metadata(base_dir)
 
         return Cube(base_dir, config)
 
+    def extend(self, end_time):
+        """
+        Extend the time axis of the data cube up to the new, exclusive *end_time*. The time coordinates
+        and all variables are resized in place, new time steps are filled with the variables' fill values.
+        The time axis is extended by whole years, up to and including the year of *end_time*.
+        Use the **Cube.update(provider, start_time=...)** method afterwards with the returned start time
+        to add the data of the new time steps only.
+
+        :param end_time: The new end time. Must be later than the cube's current end time.
+        :return: The start time of the first new time step.
+        """
+        if end_time <= self._config.end_time:
+            raise ValueError('end_time must be later than the cube\'s end time %s' % self._config.end_time)
+
+        zg = zarr.open_group(self.base_dir)
+        # Take the current end of the time axis from the axis itself, cubes always cover whole years
+        start_year = self._config.start_time.year + zg['time'].shape[0] // self._config.num_periods_per_year
+        time_vals, time_bnds_vals = self._get_time_values(self._config, start_year, self._get_end_year(end_time))
+        if len(time_vals) > 0:
+            zg['time'].append(np.array(time_vals))
+            zg['time_bnds'].append(time_bnds_vals)
+            num_times = zg['time'].shape[0]
+            for name, array in zg.arrays():
+                if name not in ('time', 'time_bnds') and array.attrs.get('_ARRAY_DIMENSIONS', [None])[0] == 'time':
+                    array.resize((num_times,) + array.shape[1:])
+
+        config = dict(zg.attrs['cube.config'])
+        config['end_time'] = str(end_time)
+        zg.attrs['cube.config'] = config
+        zarr.consolidate_metadata(self.base_dir)
+        self._config.end_time = end_time
+        self._data = None
+        return datetime(start_year, 1, 1)
+
+    @staticmethod
+    def _has_consolidated_metadata(base_dir):
+        """
+        Whether the cube in *base_dir* has consolidated metadata, which lets it be opened by reading
+        a single metadata file. Cubes written by older versions have none.
+        """
+        return os.path.exists(os.path.join(base_dir, '.zmetadata'))
+
+    @staticmethod
+    def _get_end_year(end_time):
+        """Return the exclusive end year of the time axis of a cube whose data ends at *end_time*."""
+        if end_time == datetime(end_time.year, 1, 1):
+            return end_time.year
+        return end_time.year + 1
+
+    @staticmethod
+    def _get_time_values(config, start_year, end_year):
+        """
+        Return the time coordinate values and time bounds values of all periods in the years
+        *start_year* to *end_year* (exclusive).
+        """
+        num_periods_per_year = config.num_periods_per_year
+        temporal_res = config.temporal_res
+        start_nums = [config.date2num(datetime(yr, 1, 1)) for yr in range(start_year, end_year)]
+
+        def correctub(sn, temporal_res, i, ntot):
+            if i == (ntot-1):
+                return sn+366
+            else:
+                return sn + temporal_res * (i + 1.0)
+
+        lower_bounds = [sn + temporal_res * (i + 0.0)
+                        for sn in start_nums for i in range(num_periods_per_year)]
+        upper_bounds = [correctub(sn, temporal_res, i, num_periods_per_year)
+                        for sn in start_nums for i in range(num_periods_per_year)]
+        time_bnds_vals = np.zeros((len(lower_bounds), 2))
+        time_bnds_vals[:, 0] = lower_bounds
+        time_bnds_vals[:, 1] = upper_bounds
+
+        time_vals = [sn + temporal_res * (i + 0.5)
+                     for sn in start_nums for i in range(num_periods_per_year)]
+        return time_vals, time_bnds_vals
+
     def close(self):
         warnings.warn(
             "This function is deprecated. Zarr cubes do not have to be closed.", DeprecationWarning)
 
-    def update(self, provider: 'CubeSourceProvider', image_cache_size=12):
+    def update(self, provider: 'CubeSourceProvider', image_cache_size=12, workers=None, write_queue_size=1,
+               resume=False, write_workers=None, start_time=None):
         """
         Updates the data cube with source data from the given image provider.
 
         :param provider: An instance of the abstract ImageProvider class
+        :param image_cache_size: The maximum number of time steps of every variable kept in memory. They are split
+               into *write_queue_size* + 1 image blocks of equal size. Each block is written at once and is rounded
+               down to a multiple of the time chunk size of the variables, so that every chunk is written only once.
+               If *image_cache_size* cannot hold a whole time chunk per block, the blocks are enlarged to one time
+               chunk, using more memory, and a warning is issued.
+        :param workers: The number of worker processes used to compute the images of independent
+               target periods in parallel. Each worker re-creates *provider* from its constructor arguments
+               and the options set on it (see :py:class:`CubeSourceProvider`) and closes it when the update
+               is done. Images are still written in time order. Defaults to ``None`` (sequential computation).
+        :param write_queue_size: The maximum number of image blocks waiting to be written while the next images
+               are computed into another block.
+        :param resume: Whether to skip time steps that have already been written for all variables of *provider*,
+               e.g. by a previous, interrupted update. The written time steps are always recorded in the cube.
+               Only resume an update of the same source data, time steps written before the source data
+               has been refreshed would be kept. Defaults to ``False`` (all time steps are computed).
+        :param write_workers: The number of threads used to compress and write the chunks of all variables
+               concurrently. Defaults to ``None`` (variables are written one after another).
+        :param start_time: If given, only the time steps from *start_time* on are updated, e.g. the new
+               time steps returned by :py:meth:`extend`. Defaults to ``None`` (the cube's start time).
+        """
+        self.update_many([provider], image_cache_size=image_cache_size, workers=workers,
+                         write_queue_size=write_queue_size, resume=resume, write_workers=write_workers,
+                         start_time=start_time)
+
+    def update_many(self, providers, image_cache_size=12, workers=None, write_queue_size=1, resume=False,
+                    write_workers=None, start_time=None):
+        """
+        Updates the data cube with source data from all given image providers in a single pass over the time axis.
+        For every target period, all providers compute their images, which are then written together.
+        Each provider must provide different variables.
+
+        The parameters *image_cache_size*, *workers*, *write_queue_size*, *resume*, *write_workers*
+        and *start_time* are the ones of :py:meth:`update`. With *workers*, all providers share a single pool of
+        *workers* worker processes, each of which re-creates all providers that support parallel updates.
+
+        :param providers: A sequence of instances of the abstract ImageProvider class
         """
         if self._closed:
             raise IOError('cube has been closed')
 
-        provider.prepare()
+        dsgroup = zarr.open_group(self.base_dir)
+
+        provider_var_names = []
+        new_arrays = False
+        for provider in providers:
+            var_names = list(provider.variable_descriptors.keys())
+            for other_var_names in provider_var_names:
+                common_var_names = set(var_names) & set(other_var_names)
+                if common_var_names:
+                    raise ValueError('variable(s) %s provided by multiple providers' % ', '.join(common_var_names))
+            provider_var_names.append(var_names)
+            # Initiate zarr datasets
+            for varname in var_names:
+                if not varname in dsgroup.array_keys():
+                    self._init_variable_dataset(provider, varname)
+                    new_arrays = True
+        if new_arrays:
+            # Consolidate right away, so that the new variables are visible even if the update fails
+            zarr.consolidate_metadata(self.base_dir)
+
+        # Chunks that contain only fill values are not stored, zarr returns fill values for missing chunks
+        datasets = {var_name: zarr.Array(dsgroup.store, path=var_name, write_empty_chunks=False)
+                    for var_names in provider_var_names for var_name in var_names}
+        ledger = _CompletionLedger(dsgroup, datasets)
+
         try:
-            target_start_time, target_end_time = provider.temporal_coverage
-        except Exception as e:
-            raise e
+            provider_periods = []
+            for provider, var_names in zip(providers, provider_var_names):
+                target_periods = self._get_provider_periods(provider, start_time)
+                if resume:
+                    num_periods = len(target_periods)
+                    target_periods = [period for period in target_periods
+                                      if not ledger.is_completed(period[0], var_names)]
+                    if len(target_periods) < num_periods:
+                        print('Skipping %d time step(s) of %s already written by a previous update' %
+                              (num_periods - len(target_periods), ', '.join(var_names)))
+                provider_periods.append(target_periods)
+
+            parallel_providers = []
+            if workers and workers > 1:
+                parallel_providers = [provider for provider, target_periods in zip(providers, provider_periods)
+                                      if target_periods and provider.supports_parallel_update]
+            executor = None
+            if parallel_providers:
+                # Workers are spawned rather than forked, as forking while the writer and prefetch threads
+                # hold locks may deadlock the workers
+                executor = ProcessPoolExecutor(max_workers=workers,
+                                               mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=_init_worker_providers,
+                                               initargs=(parallel_providers,))
+                # Limit the number of pending periods of all providers, so that results are not piling up
+                # in memory while the main process is busy writing
+                max_pending = max(1, 2 * workers // len(parallel_providers))
+
+            image_streams = []
+            for provider, target_periods in zip(providers, provider_periods):
+                if provider in parallel_providers:
+                    stream = self._compute_worker_images(executor, parallel_providers.index(provider),
+                                                         target_periods, max_pending)
+                else:
+                    stream = self._compute_images(provider, target_periods)
+                image_streams.append(([period[0] for period in target_periods], stream))
+
+            # Multiple images are cached so that they may be written at once,
+            # This should be much faster when writing time series.
+            # Batches are aligned with the time chunks, so that no chunk is read, merged and rewritten.
+            # Writing happens on a background thread while the next images are computed. The image blocks
+            # are preallocated and reused, one is filled while the others are waiting or being written.
+            # All blocks together hold no more than image_cache_size time steps, unless a block must be
+            # enlarged to hold a whole time chunk.
+            num_blocks = max(1, write_queue_size) + 1
+            max_batch_size = max(1, image_cache_size // num_blocks)
+            batch_size = self._get_write_batch_size(datasets, max_batch_size)
+            if batch_size > max_batch_size:
+                warnings.warn('image_cache_size=%d cannot hold %d blocks of whole time chunks, '
+                              'keeping %d time steps of every variable in memory instead'
+                              % (image_cache_size, num_blocks, num_blocks * batch_size))
+            free_blocks = queue.Queue()
+            for _ in range(num_blocks):
+                free_blocks.put(_ImageBlock(datasets, batch_size))
+
+            write_executor = ThreadPoolExecutor(max_workers=write_workers) if write_workers else None
+            fill_chunk_stats = [0, 0]
+
+            def write_block(block):
+                try:
+                    num_chunks, num_bytes = self._write_images(datasets, block, write_executor)
+                    fill_chunk_stats[0] += num_chunks
+                    fill_chunk_stats[1] += num_bytes
+                    ledger.set_completed(block.ranges)
+                finally:
+                    block.reset()
+                    free_blocks.put(block)
+
+            def get_free_block():
+                # Blocks queued after a failed write are never released, so watch out for errors
+                while True:
+                    writer.raise_error()
+                    try:
+                        return free_blocks.get(timeout=1.0)
+                    except queue.Empty:
+                        pass
+
+            def must_flush(block, time_index, var_name_to_image):
+                if block.empty:
+                    return False
+                if time_index // batch_size != block.i0 // batch_size:
+                    return True
+                # Completed time steps that have been skipped must not be overwritten with fill values
+                for var_name in var_name_to_image:
+                    iend = block.get_end_index(var_name)
+                    if iend is not None and ledger.any_completed(var_name, iend, time_index):
+                        return True
+                return False
+
+            batches = []
+            time_indices = {var_name: [] for var_name in datasets}
+            writer = _ImageWriter(write_block, write_queue_size)
+            try:
+                block = get_free_block()
+                for time_index, var_name_to_image in self._merge_images(image_streams):
+                    if must_flush(block, time_index, var_name_to_image or {}):
+                        batches.extend((var_name, i1, iend) for var_name, (i1, iend) in block.ranges.items())
+                        writer.write(block)
+                        block = get_free_block()
+                    if var_name_to_image:
+                        block.put(time_index, var_name_to_image)
+                        for var_name in var_name_to_image:
+                            time_indices[var_name].append(time_index)
+                    # The images have been copied, release them before the next ones are computed
+                    var_name_to_image = None
+                if not block.empty:
+                    batches.extend((var_name, i1, iend) for var_name, (i1, iend) in block.ranges.items())
+                    writer.write(block)
+            finally:
+                # Shut everything down even if writing failed, the first error is raised afterwards
+                try:
+                    writer.close()
+                finally:
+                    try:
+                        if write_executor is not None:
+                            write_executor.shutdown()
+                    finally:
+                        if executor is not None:
+                            executor.shutdown(cancel_futures=True)
+        finally:
+            for provider in providers:
+                provider.close()
+
+        # Include new variables and attributes in the cube's consolidated metadata
+        zarr.consolidate_metadata(self.base_dir)
+        self._data = None
+
+        # Compare with writing every image_cache_size time steps regardless of the chunk boundaries
+        unaligned_batches = [(var_name, i1, iend)
+                             for var_name, var_time_indices in time_indices.items()
+                             for i1, iend in self._get_unaligned_batches(var_time_indices, image_cache_size)]
+        print('Wrote %d chunk(s), %d of them partially; writing every %d time step(s) would have written '
+              '%d chunk(s), %d of them partially' % (self._count_chunk_writes(datasets, batches)
+                                                      + (image_cache_size,)
+                                                      + self._count_chunk_writes(datasets, unaligned_batches)))
+        print('Skipped %d chunk(s) containing only fill values, %d uncompressed bytes not written' %
+              tuple(fill_chunk_stats))
+
+    def _get_provider_periods(self, provider, start_time=None):
+        """
+        Prepare *provider* and return the list of (time_index, time_1, time_2) tuples of all cube periods
+        covered by it, from *start_time* on if given.
+        """
+        provider.prepare()
+        target_start_time, target_end_time = provider.temporal_coverage
         if self._config.start_time and self._config.start_time > target_start_time:
             target_start_time = self._config.start_time
+        if start_time and start_time > target_start_time:
+            target_start_time = start_time
         if self._config.end_time and self._config.end_time < target_end_time:
             target_end_time = self._config.end_time
+        return self._get_target_periods(target_start_time, target_end_time)
 
-        dsgroup = zarr.open_group(self.base_dir)
+    @staticmethod
+    def _merge_images(image_streams):
+        """
+        Merge the (time_index, var_name_to_image) tuples generated by every stream in *image_streams*
+        into single tuples per time index in time order. *image_streams* is a sequence of
+        (time_indices, stream) pairs, where *time_indices* are the time indices generated by *stream* in order.
+        A stream is only advanced when its next time index is due, so that no images are computed ahead.
+        """
+        pending_time_indices = [deque(time_indices) for time_indices, _ in image_streams]
+        streams = [stream for _, stream in image_streams]
+        for time_index in sorted(set(itertools.chain.from_iterable(pending_time_indices))):
+            var_name_to_image = {}
+            for stream, time_indices in zip(streams, pending_time_indices):
+                if time_indices and time_indices[0] == time_index:
+                    time_indices.popleft()
+                    var_name_to_image.update(next(stream)[1] or {})
+            yield time_index, var_name_to_image or None
 
-        # Initiate zarr datasets
-        for varname in provider.variable_descriptors:
-            if not varname in dsgroup.array_keys():
-                self._init_variable_dataset(provider, varname)
+    @staticmethod
+    def _get_write_batch_size(datasets, max_batch_size):
+        """
+        Return the number of time steps written at once: the multiple of the time chunk sizes of all *datasets*
+        that is closest to, but not greater than, *max_batch_size*. At least one multiple is returned,
+        so that every chunk is written at once, even if this exceeds *max_batch_size*.
+        """
+        chunk_size = 1
+        for ds in datasets.values():
+            chunk_size = chunk_size * ds.chunks[0] // math.gcd(chunk_size, ds.chunks[0])
+        return chunk_size * max(1, max_batch_size // chunk_size)
+
+    @staticmethod
+    def _get_unaligned_batches(time_indices, batch_size):
+        """
+        Return the (i0, iend) batches that would be written if every *batch_size* time steps were written
+        regardless of the chunk boundaries.
+        """
+        batches = []
+        i0 = None
+        for time_index in time_indices:
+            if i0 is None:
+                i0 = time_index
+            if time_index - i0 + 1 >= batch_size:
+                batches.append((i0, time_index + 1))
+                i0 = None
+        if i0 is not None:
+            batches.append((i0, time_indices[-1] + 1))
+        return batches
 
-        varnames = provider.variable_descriptors.keys()
-        target_year_1 = target_start_time.year
-        target_year_2 = target_end_time.year
+    @staticmethod
+    def _count_chunk_writes(datasets, batches):
+        """
+        Return the number of chunks of *datasets* that are written by the given (var_name, i0, iend) batches,
+        and the number of those that are written partially, i.e. read, merged and rewritten by zarr.
+        """
+        count = 0
+        partial_count = 0
+        for var_name, i0, iend in batches:
+            ds = datasets[var_name]
+            time_chunk_size = ds.chunks[0]
+            num_spatial_chunks = ds.nchunks // ds.cdata_shape[0]
+            for chunk_index in range(i0 // time_chunk_size, (iend - 1) // time_chunk_size + 1):
+                chunk_start = chunk_index * time_chunk_size
+                chunk_end = min(chunk_start + time_chunk_size, ds.shape[0])
+                count += num_spatial_chunks
+                if i0 > chunk_start or iend < chunk_end:
+                    partial_count += num_spatial_chunks
+        return count, partial_count
+
+    def _get_target_periods(self, target_start_time, target_end_time):
+        """
+        Return the list of (time_index, time_1, time_2) tuples of all cube periods that overlap
+        the given target time range.
+        """
         cube_temporal_res = self._config.temporal_res
         num_periods_per_year = self._config.num_periods_per_year
-        datasets = {varname: dsgroup[varname] for varname in provider.variable_descriptors}
-        imagecache = []
-
-        # Preallocate cache so that multiple images may be written at once,
-        # This should be much faster when writing time series
-
-        # Initial index inside zarr array to write to
-        i0 = (target_year_1-self._config.start_time.year)*num_periods_per_year
-        ilast = i0-1
-        for target_year in range(target_year_1, target_year_2+1):
-            time_min = datetime(target_year, 1, 1)
+        d_time = timedelta(days=cube_temporal_res)
+        target_periods = []
+        for target_year in range(target_start_time.year, target_end_time.year + 1):
             time_max = datetime(target_year + 1, 1, 1)
-            d_time = timedelta(days=cube_temporal_res)
-            time_1 = time_min
+            time_1 = datetime(target_year, 1, 1)
+            i0 = (target_year - self._config.start_time.year) * num_periods_per_year
             for time_index in range(num_periods_per_year):
                 time_2 = time_1 + d_time
                 if time_2 > time_max:
@@ -272,39 +780,95 @@ class Cube:
                 weight = esdl.util.temporal_weight(
                     time_1, time_2, target_start_time, target_end_time)
                 if weight > 0.0:
-                    var_name_to_image = provider.compute_variable_images(time_1, time_2)
-                    if var_name_to_image:
-                        imagecache.append((i0, var_name_to_image))
-                #print("t1: ", time_1, " t2: ", time_2)
-                if i0-ilast >= image_cache_size:
-                    #print("i0 ilast", i0, ilast)
-                    if len(imagecache) > 0:
-                        # print(datasets)
-                        self._write_images(provider, datasets, imagecache,
-                                           varnames, image_cache_size)
-                    imagecache = []
-                    ilast = i0
+                    target_periods.append((i0 + time_index, time_1, time_2))
                 time_1 = time_2
-                i0 = i0 + 1
-        if len(imagecache) > 0:
-            self._write_images(provider, datasets, imagecache, varnames, image_cache_size)
-        provider.close()
-
-    def _write_images(self, provider, datasets, imagecache, varnames, image_cache_size):
-        # First we unpack the data into 3d-numpy arrays
-        for var_name in varnames:
+        return target_periods
+
+    @staticmethod
+    def _compute_images(provider, target_periods):
+        """
+        Generate (time_index, var_name_to_image) tuples for the given target periods in time order.
+        """
+        for time_index, time_1, time_2 in target_periods:
+            yield time_index, provider.compute_variable_images(time_1, time_2)
+
+    @staticmethod
+    def _compute_worker_images(executor, provider_index, target_periods, max_pending):
+        """
+        Generate (time_index, var_name_to_image) tuples for the given target periods in time order.
+        The images are computed by the worker processes of *executor* with their provider at *provider_index*,
+        at most *max_pending* periods are computed ahead.
+        """
+        pending = deque()
+        for time_index, time_1, time_2 in target_periods:
+            if len(pending) >= max_pending:
+                yield pending[0][0], pending.popleft()[1].result()
+            pending.append((time_index, executor.submit(_compute_worker_images, provider_index, time_1, time_2)))
+        while pending:
+            yield pending[0][0], pending.popleft()[1].result()
+
+    @staticmethod
+    def _write_images(datasets, block, executor=None):
+        """
+        Write the images of *block* to *datasets*. If *executor* is given, the chunks of all variables
+        are compressed and written concurrently by its threads.
+
+        :return: The number and the uncompressed size in bytes of the written chunks that contain only fill values.
+                 Such chunks are not stored by zarr if the datasets do not write empty chunks.
+        """
+        futures = []
+        num_fill_chunks = 0
+        num_fill_bytes = 0
+        for var_name, (i1, iend) in block.ranges.items():
+            print("Writing variable %s image from time index %d to %d" % (var_name, i1, iend))
             ds = datasets[var_name]
-            i0 = imagecache[0][0]
-            iend = imagecache[-1][0] + 1
-            im_first = imagecache[0][1][var_name]
-            image_all = np.full(
-                (iend-i0, im_first.shape[0], im_first.shape[1]), ds.fill_value, ds.dtype)
-            for entry in imagecache:
-                i1 = entry[0]
-                im_now = entry[1][var_name]
-                image_all[i1-i0, :, :] = im_now
-            print("Writing variable %s image from time index %d to %d" % (var_name, i0, iend))
-            ds[i0:iend, :, :] = image_all
+            slab = block.get_slab(var_name)
+            if executor is None:
+                ds[i1:iend, :, :] = slab
+            for t_slice, y_slice, x_slice in Cube._get_chunk_regions(ds, i1, iend):
+                region = slab[t_slice.start - i1:t_slice.stop - i1, y_slice, x_slice]
+                if Cube._is_whole_chunk(ds, t_slice, y_slice, x_slice) and Cube._is_fill(region, ds.fill_value):
+                    num_fill_chunks += 1
+                    num_fill_bytes += region.nbytes
+                if executor is not None:
+                    # Every region is a single chunk, so no two threads write the same chunk
+                    futures.append(executor.submit(ds.__setitem__, (t_slice, y_slice, x_slice), region))
+        # Wait for all writes before the block is reused, then raise the first error, if any
+        wait(futures)
+        for future in futures:
+            future.result()
+        return num_fill_chunks, num_fill_bytes
+
+    @staticmethod
+    def _get_chunk_regions(ds, i1, iend):
+        """
+        Return the (t_slice, y_slice, x_slice) regions of the chunks of the 3D dataset *ds*
+        within the time indices *i1* to *iend* (exclusive).
+        """
+        num_times, height, width = ds.shape
+        chunk_size, chunk_height, chunk_width = ds.chunks
+        t_starts = [i1] + list(range(i1 - i1 % chunk_size + chunk_size, iend, chunk_size))
+        return [(slice(t, min(t - t % chunk_size + chunk_size, iend)),
+                 slice(y, min(y + chunk_height, height)),
+                 slice(x, min(x + chunk_width, width)))
+                for t in t_starts
+                for y in range(0, height, chunk_height)
+                for x in range(0, width, chunk_width)]
+
+    @staticmethod
+    def _is_whole_chunk(ds, t_slice, y_slice, x_slice):
+        """Whether the given chunk region covers the whole chunk of *ds* or the whole remainder at its edges."""
+        return all(s.start % chunk == 0 and (s.stop % chunk == 0 or s.stop == size)
+                   for s, chunk, size in zip((t_slice, y_slice, x_slice), ds.chunks, ds.shape))
+
+    @staticmethod
+    def _is_fill(region, fill_value):
+        """Whether *region* contains only *fill_value*."""
+        if fill_value is None:
+            return False
+        if isinstance(fill_value, float) and math.isnan(fill_value):
+            return bool(np.isnan(region).all())
+        return bool((region == fill_value).all())
 
     def _init_variable_dataset(self, provider, variable_name):
         import time
@@ -1,6 +1,7 @@
 import argparse
 import os
 import sys
+from datetime import datetime
 
 from pkg_resources import iter_entry_points
 
@@ -75,8 +76,16 @@ def main(args=None):
                         help="list all available source providers")
     parser.add_argument('-G', '--dont-clear-cache', action='store_true',
                         help="do not clear data cache before updating the cube (faster)")
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help="skip time steps that have already been written by a previous, interrupted update "
+                             "of the same source data")
     parser.add_argument('-c', '--cube-conf', metavar='CONFIG',
                         help="data cube configuration file")
+    parser.add_argument('-w', '--workers', metavar='WORKERS', type=int,
+                        help="number of worker processes shared by all sources to compute their images")
+    parser.add_argument('-e', '--extend', metavar='END_TIME',
+                        help="extend the time axis of an existing data cube to the new end time "
+                             "(format YYYY-MM-DD) before updating it")
     parser.add_argument('cube_dir', metavar='TARGET', nargs='?',
                         help="data cube root directory")
     parser.add_argument('cube_sources', metavar='SOURCE', nargs='*',
@@ -92,14 +101,22 @@ def main(args=None):
     cube_sources = args_obj.cube_sources
     source_provider_infos = []
     list_mode = args_obj.list
+    extend_end_time = None
     if cube_config_file and not os.path.isfile(cube_config_file):
         parser.error('CONFIG file not found: %s' % cube_config_file)
+    if args_obj.extend:
+        try:
+            extend_end_time = datetime.strptime(args_obj.extend, '%Y-%m-%d')
+        except ValueError:
+            parser.error('END_TIME must be given in the format YYYY-MM-DD')
     if not cube_dir and (cube_config_file or cube_sources):
         parser.error('TARGET directory must be provided')
     if cube_dir:
         is_new = not os.path.exists(cube_dir) or not os.listdir(cube_dir)
         if not is_new and cube_config_file:
             parser.error('TARGET directory must be empty')
+        if is_new and extend_end_time:
+            parser.error('TARGET directory must contain a data cube to be extended')
         for source in cube_sources:
             source_name, source_args, source_kwargs, source_error_msg = _parse_source_arg(source)
             if source_error_msg:
@@ -131,12 +148,17 @@ def main(args=None):
             cube = Cube.create(cube_dir, cube_config)
         else:
             cube = Cube.open(cube_dir)
+        start_time = None
+        if extend_end_time:
+            # Only the new time steps are updated, also in cubes that have no record of written time steps
+            start_time = cube.extend(extend_end_time)
 
         source_providers = [cls(cube.config, *args, name=name, **kwargs)
                             for name, cls, args, kwargs in source_provider_infos]
 
-        for source_provider in source_providers:
-            cube.update(source_provider)
+        if source_providers:
+            cube.update_many(source_providers, workers=args_obj.workers, resume=args_obj.resume,
+                             start_time=start_time)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,13 @@
+import atexit
+import bisect
 import glob
+import multiprocessing
 import os.path
+import re
 import time
 from abc import ABCMeta, abstractmethod, abstractproperty
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import gridtools.resampling as gtr
 import netCDF4
@@ -10,7 +15,29 @@ import numpy as np
 from typing import Tuple, Dict, Any
 
 from .cube_config import CubeConfig
-from .util import Config, NetCDFDatasetCache, aggregate_images, temporal_weight
+from .resampling import ResamplingAccumulator, resample_2d
+from .util import Config, NetCDFDatasetCache, NETCDF_LOCK, ImageAccumulator, read_nan_array, temporal_weight
+
+
+# The provider instance of a source scanning process, see NetCDFCubeSourceProvider.scan_source_time_ranges()
+_scan_worker_provider = None
+
+
+def _init_scan_worker_provider(provider):
+    global _scan_worker_provider
+    _scan_worker_provider = provider
+    atexit.register(_close_scan_worker_provider)
+
+
+def _close_scan_worker_provider():
+    global _scan_worker_provider
+    if _scan_worker_provider is not None:
+        _scan_worker_provider.close()
+        _scan_worker_provider = None
+
+
+def _read_scan_worker_file_time_ranges(file):
+    return list(_scan_worker_provider._read_file_time_ranges(file))
 
 
 def _get_us_method(var_attributes):
@@ -21,15 +48,52 @@ def _get_ds_method(var_attributes):
     return gtr.__dict__['DS_' + var_attributes.get('ds_method', 'MEAN')]
 
 
+def _get_target_shift(shift, src_w, w, us_method):
+    """
+    Get the number of columns the target image of width *w* must be rolled by to match rolling its source images
+    of width *src_w* by *shift* columns, or ``None`` if the shift does not commute with the spatial resampling.
+    This is the case if the shift moves whole blocks of source columns resampled to a single target column,
+    or single source columns upsampled to a block of target columns by the nearest neighbour.
+    """
+    shift %= src_w
+    if w <= src_w:
+        if src_w % w == 0 and shift % (src_w // w) == 0:
+            return shift // (src_w // w)
+    elif us_method == gtr.US_NEAREST and w % src_w == 0:
+        return shift * (w // src_w)
+    return None
+
+
+def _new_source_provider(provider_class, args, kwargs):
+    return provider_class(*args, **kwargs)
+
+
 class CubeSourceProvider(metaclass=ABCMeta):
     """
     An abstract interface for objects representing data source providers for the data cube.
     Cube source providers are passed to the :py:meth:`Cube.update` method.
 
+    Instances are pickled by their constructor arguments, so that a provider can be re-created in
+    another process (see the *workers* parameter of :py:meth:`Cube.update`). Options given by public class
+    attributes, such as **image_prefetch_depth**, are pickled too if they have been set on the instance.
+    The re-created provider starts unprepared and owns its own resources such as dataset caches.
+
     :param cube_config: Specifies the fixed layout and conventions used for the cube.
     :param name: The provider's registration name.
     """
 
+    def __new__(cls, *args, **kwargs):
+        provider = super(CubeSourceProvider, cls).__new__(cls)
+        provider._constructor_args = args, kwargs
+        return provider
+
+    def __reduce__(self):
+        args, kwargs = self._constructor_args
+        # Options set after construction, which override public class attributes
+        options = {name: value for name, value in vars(self).items()
+                   if not name.startswith('_') and hasattr(type(self), name)}
+        return _new_source_provider, (type(self), args, kwargs), options
+
     def __init__(self, cube_config: CubeConfig, name: str):
         if not cube_config:
             raise ValueError('cube_config expected')
@@ -48,6 +112,14 @@ class CubeSourceProvider(metaclass=ABCMeta):
         """ The data cube's configuration. """
         return self._cube_config
 
+    @property
+    def supports_parallel_update(self) -> bool:
+        """
+        Whether :py:meth:`compute_variable_images` may be called for independent time periods
+        in separate processes, i.e. its result does not depend on the order of calls.
+        """
+        return True
+
     @abstractmethod
     def prepare(self):
         """
@@ -141,12 +213,31 @@ class BaseCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
     def __init__(self, cube_config: CubeConfig, name: str):
         super(BaseCubeSourceProvider, self).__init__(cube_config, name)
         self._source_time_ranges = None
+        self._source_start_times = None
+        self._source_max_end_times = None
+        self._source_ranges_sorted = False
 
     def prepare(self):
         """
         Calls **compute_source_time_ranges** and assigns the return value to the field **source_time_ranges**.
         """
         self._source_time_ranges = self.compute_source_time_ranges()
+        self._index_source_time_ranges()
+
+    def _index_source_time_ranges(self):
+        """
+        Index the sorted source time ranges by their start times and by the running maximum of their end times,
+        so that the ranges overlapping a given period can be found by bisection.
+        """
+        self._source_start_times = [source_time_range[0] for source_time_range in self._source_time_ranges]
+        self._source_ranges_sorted = all(t1 <= t2 for t1, t2 in zip(self._source_start_times,
+                                                                       self._source_start_times[1:]))
+        self._source_max_end_times = []
+        max_end_time = None
+        for source_time_range in self._source_time_ranges:
+            if max_end_time is None or source_time_range[1] > max_end_time:
+                max_end_time = source_time_range[1]
+            self._source_max_end_times.append(max_end_time)
 
     @property
     def source_time_ranges(self):
@@ -194,17 +285,7 @@ class BaseCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
                  Return ``None`` if no such variables exists for the given target time range.
         """
 
-        source_time_ranges = self._source_time_ranges
-        if len(source_time_ranges) == 0:
-            return None
-
-        index_to_weight = dict()
-        for i in range(len(source_time_ranges)):
-            source_start_time, source_end_time = source_time_ranges[i][0:2]
-            weight = temporal_weight(source_start_time, source_end_time,
-                                     period_start, period_end)
-            if weight > 0.0:
-                index_to_weight[i] = weight
+        index_to_weight = self._get_index_to_weight(period_start, period_end)
         if not index_to_weight:
             return None
 
@@ -213,10 +294,37 @@ class BaseCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
         t1 = time.time()
         result = self.compute_variable_images_from_sources(index_to_weight)
         t2 = time.time()
-        self.log('images computed for %s, took %f seconds' % (str(list(result.keys())), t2 - t1))
+        self.log('images computed for %s, took %f seconds' % (str(list(result.keys()) if result else []), t2 - t1))
 
         return result
 
+    def _get_index_to_weight(self, period_start: datetime, period_end: datetime) -> Dict[int, float]:
+        """
+        Return a dictionary that maps the indexes of all source time ranges overlapping the given period
+        to their weights.
+        """
+        source_time_ranges = self._source_time_ranges
+        if len(source_time_ranges) == 0:
+            return dict()
+        if self._source_start_times is None or len(self._source_start_times) != len(source_time_ranges):
+            self._index_source_time_ranges()
+
+        if self._source_ranges_sorted:
+            # Only source ranges starting before the period's end and ending after its start can overlap
+            i1 = bisect.bisect_left(self._source_max_end_times, period_start)
+            i2 = bisect.bisect_right(self._source_start_times, period_end)
+        else:
+            i1, i2 = 0, len(source_time_ranges)
+
+        index_to_weight = dict()
+        for i in range(i1, i2):
+            source_start_time, source_end_time = source_time_ranges[i][0:2]
+            weight = temporal_weight(source_start_time, source_end_time,
+                                     period_start, period_end)
+            if weight > 0.0:
+                index_to_weight[i] = weight
+        return index_to_weight
+
     @abstractmethod
     def compute_variable_images_from_sources(self, index_to_weight: Dict[int, float]):
         """
@@ -269,6 +377,11 @@ class BaseStaticCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
         """Clear the flag that indicates that the static sources have been processed."""
         self._variable_images_computed = False
 
+    @property
+    def supports_parallel_update(self) -> bool:
+        """Static images are computed once only, by the first call of :py:meth:`compute_variable_images`."""
+        return False
+
     @property
     def spatial_coverage(self):
         """
@@ -289,6 +402,13 @@ class BaseStaticCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
         if self._variable_images_computed:
             return None
 
+        # Not holding NETCDF_LOCK, so that other providers keep reading source datasets in background threads
+        # while the static images are computed
+        target_var_images = self._compute_variable_images()
+        self._variable_images_computed = True
+        return target_var_images
+
+    def _compute_variable_images(self):
         dataset = self.open_dataset()
         try:
             var_descriptors = self.variable_descriptors
@@ -297,12 +417,12 @@ class BaseStaticCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
                 source_name = var_attributes.get('source_name', var_name)
                 var_image = self.get_dataset_image(dataset, source_name)
                 var_image = self.transform_source_image(var_image)
-                var_image = gtr.resample_2d(var_image,
-                                            self.cube_config.grid_width,
-                                            self.cube_config.grid_height,
-                                            ds_method=_get_ds_method(var_attributes),
-                                            us_method=_get_us_method(var_attributes),
-                                            fill_value=var_attributes.get('fill_value', np.nan))
+                var_image = resample_2d(var_image,
+                                        self.cube_config.grid_width,
+                                        self.cube_config.grid_height,
+                                        ds_method=_get_ds_method(var_attributes),
+                                        us_method=_get_us_method(var_attributes),
+                                        fill_value=var_attributes.get('fill_value', np.nan))
                 if var_image.shape[1] / var_image.shape[0] != 2.0:
                     print("Warning: wrong size ratio of image in '%s'. Expected 2, got %f" % (
                         self.get_dataset_file_path(dataset),
@@ -312,20 +432,20 @@ class BaseStaticCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
         finally:
             self.close_dataset(dataset)
 
-        self._variable_images_computed = True
         return target_var_images
 
     @abstractmethod
     def open_dataset(self) -> object:
         """
         Open the single dataset and return its representation.
+        Implementations opening netCDF files must hold ``NETCDF_LOCK`` while doing so.
         :return: a dataset object
         """
 
     @abstractmethod
     def close_dataset(self, dataset: object):
         """
-        Close *dataset*.
+        Close *dataset*. Implementations closing netCDF files must hold ``NETCDF_LOCK`` while doing so.
         :param dataset: the dataset returned by :py:meth:`open_dataset`
         """
 
@@ -340,7 +460,8 @@ class BaseStaticCubeSourceProvider(CubeSourceProvider, metaclass=ABCMeta):
     @abstractmethod
     def get_dataset_image(self, dataset: object, name: str):
         """
-        Get a 2D-image for *dataset* for the given variable *name*.
+        Get a 2D-image for *dataset* for the given variable *name*. Implementations reading netCDF files must
+        hold ``NETCDF_LOCK`` around the reads only, not around computations on the data read.
         :param dataset: the dataset returned by :py:meth:`open_dataset`.
         :param name: the variable name.
         :return: a 2D-image
@@ -421,16 +542,73 @@ class NetCDFCubeSourceProvider(BaseCubeSourceProvider, metaclass=ABCMeta):
     :param dir_path: Source directory to read the files from. If relative path,
            it will be resolved against the **cube_sources_root** path of the
            global ESDL configuration (**esdl.util.Config.instance()**).
-    :param resampling_order: The order in which resampling is performed. One of 'time_first', 'space_first'.
+    :param resampling_order: The order in which resampling is performed. One of 'time_first', 'space_first' or
+           'fused', which aggregates the source images over time and space in a single pass
+           (see :py:class:`esdl.resampling.ResamplingAccumulator`).
     """
 
+    #: Maximum number of processes used by :py:meth:`scan_source_time_ranges` to read source files
+    #: not found in the source time range index, ``1`` to read them in the calling process.
+    source_scan_workers = 8
+
+    #: Maximum number of source datasets kept open by the **dataset_cache**, ``None`` for no limit.
+    max_open_datasets = 32
+
+    #: Maximum total size in bytes of the source files kept open by the **dataset_cache**, ``None`` for no limit.
+    max_open_dataset_bytes = None
+
+    #: Maximum total size in bytes of the unpacked ``*.gz`` source files in the **dataset_cache** directory,
+    #: ``None`` for no limit.
+    max_unpacked_bytes = 16 * 1024 ** 3
+
+    #: Number of upcoming ``*.gz`` source files unpacked in the background while images are computed.
+    unpack_prefetch_count = 2
+
+    #: Number of upcoming target periods whose source images are read ahead by a background thread,
+    #: 0 to read source images only when they are needed.
+    image_prefetch_depth = 2
+
+    #: Optional time resolution from source file names, a tuple (pattern, time_format, duration).
+    #: The first group of the regular expression *pattern* matched against a file's name is parsed by
+    #: ``datetime.strptime(group, time_format)``, the file's single image covers *duration* from that time on.
+    #: If given, :py:meth:`get_file_time_ranges` never opens a source file and files not matching *pattern*
+    #: are ignored.
+    source_file_name_time = None
+
+    #: If ``True``, source files that cannot be opened when computing images are reported and skipped rather than
+    #: failing the update. Useful together with **source_file_name_time**, as files are not validated earlier.
+    skip_invalid_source_files = False
+
+    #: If ``True``, source images are read as plain float arrays with NaN for missing values instead of
+    #: masked arrays (see :py:func:`esdl.util.read_nan_array`) and aggregated with NaN-aware kernels.
+    #: This saves the boolean masks, but NaN values already present in the source data are then treated as
+    #: missing values in temporal aggregation rather than resulting in a missing value.
+    #: Only worth it for packed integer sources (``scale_factor``, ``add_offset``), which are then unpacked in
+    #: a single pass using less memory; float sources are read faster as masked arrays
+    #: (see ``test/sandbox/benchmark_nan_source_images.py``).
+    nan_source_images = False
+
+    #: If ``True``, source images are transposed when read, e.g. if their first axis is longitude.
+    #: Like **flip_source_images**, this returns a view of the image read rather than a copy.
+    transpose_source_images = False
+
+    #: If ``True``, the rows of source images are flipped when read (after transposing),
+    #: e.g. if their first row is the southernmost one.
+    flip_source_images = False
+
+    #: Number of columns the source images are rolled to the right (after flipping), like
+    #: ``numpy.roll(image, n, axis=1)``, e.g. half their width if their first column is at 0° longitude.
+    #: Where the shift commutes with the spatial resampling, it is applied once to the target image
+    #: instead of copying every source image.
+    shift_source_images = 0
+
     def __init__(self, cube_config: CubeConfig, name: str, dir_path: str, resampling_order: str):
         super(NetCDFCubeSourceProvider, self).__init__(cube_config, name)
 
         if dir_path is None:
             raise ValueError('dir_path expected')
 
-        valid_resampling_order = ('time_first', 'space_first')
+        valid_resampling_order = ('time_first', 'space_first', 'fused')
         if resampling_order is None:
             resampling_order = valid_resampling_order[0]
         if resampling_order not in valid_resampling_order:
@@ -441,8 +619,23 @@ class NetCDFCubeSourceProvider(BaseCubeSourceProvider, metaclass=ABCMeta):
         else:
             self._dir_path = dir_path
         self._resampling_order = resampling_order
-        self._dataset_cache = NetCDFDatasetCache(name)
+        self._dataset_cache = NetCDFDatasetCache(name,
+                                                 max_open_datasets=self.max_open_datasets,
+                                                 max_bytes=self.max_open_dataset_bytes,
+                                                 max_unpacked_bytes=self.max_unpacked_bytes)
         self._old_indices = None
+        self._invalid_files = set()
+        self._has_packed_files = None
+        self._image_prefetch_executor = None
+        self._prefetched_images = dict()
+        self._image_stall_time = 0.0
+
+    @property
+    def image_stall_time(self) -> float:
+        """
+        The total time in seconds spent waiting for source images to be read while computing images.
+        """
+        return self._image_stall_time
 
     @property
     def dir_path(self):
@@ -452,54 +645,192 @@ class NetCDFCubeSourceProvider(BaseCubeSourceProvider, metaclass=ABCMeta):
     def dataset_cache(self):
         return self._dataset_cache
 
+    def prepare(self):
+        """
+        Calls **compute_source_time_ranges** and saves newly read file time ranges to the persistent
+        source time range index of the **dataset_cache**.
+        """
+        super(NetCDFCubeSourceProvider, self).prepare()
+        self._dataset_cache.time_range_index.save()
+        self._has_packed_files = None
+
+    def get_file_time_ranges(self, file: str):
+        """
+        Get the source time ranges of the images in *file*. The time ranges are taken from the persistent
+        source time range index of the **dataset_cache**, only unseen or changed files are read by
+        :py:meth:`read_file_time_ranges`. If **source_file_name_time** is given, the time range is taken from
+        the file's name by :py:meth:`get_file_name_time_ranges` instead.
+
+        :param file: The source file path.
+        :return: A list of (start_time, end_time, file, time_index) tuples
+                 as returned by :py:meth:`compute_source_time_ranges`.
+        """
+        if self.source_file_name_time is not None:
+            return self.get_file_name_time_ranges(file)
+        return self._get_indexed_file_time_ranges(file, self._read_file_time_ranges)
+
+    def _get_indexed_file_time_ranges(self, file: str, read_time_ranges):
+        time_ranges = self._dataset_cache.time_range_index.get_time_ranges(file, read_time_ranges)
+        return [(start_time, end_time, file, time_index) for start_time, end_time, time_index in time_ranges]
+
+    def get_file_name_time_ranges(self, file: str):
+        """
+        Get the time range of the single image in *file* from the file's name using **source_file_name_time**.
+
+        :param file: The source file path.
+        :return: A list containing one (start_time, end_time, file, 0) tuple,
+                 or an empty list if the file name does not match.
+        """
+        pattern, time_format, duration = self.source_file_name_time
+        match = re.search(pattern, os.path.basename(file))
+        if match is None:
+            return []
+        start_time = datetime.strptime(match.group(1), time_format)
+        return [(start_time, start_time + duration, file, 0)]
+
+    def scan_source_time_ranges(self, files):
+        """
+        Get the source time ranges of all *files* using :py:meth:`get_file_time_ranges`.
+        The files not found in the source time range index are read by a pool of up to **source_scan_workers**
+        processes. Unlike threads, processes do not share ``NETCDF_LOCK``, so the netCDF header reads and the
+        unpacking of ``*.gz`` files run concurrently. As the processes are started for every scan, the pool only
+        pays off for many new files, e.g. when a source is indexed for the first time.
+
+        :param files: The source file paths.
+        :return: A list of (start_time, end_time, file, time_index) tuples sorted by start time.
+        """
+        files = list(files)
+        if self.source_file_name_time is not None:
+            # File names are resolved without any I/O
+            file_time_ranges = [self.get_file_name_time_ranges(file) for file in files]
+        else:
+            time_range_index = self._dataset_cache.time_range_index
+            new_files = [file for file in files if not time_range_index.contains(file)]
+            num_workers = min(self.source_scan_workers, len(new_files))
+            read_time_ranges = self._read_file_time_ranges
+            if num_workers > 1:
+                with ProcessPoolExecutor(max_workers=num_workers,
+                                         mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_init_scan_worker_provider,
+                                         initargs=(self,)) as executor:
+                    new_file_time_ranges = dict(zip(new_files,
+                                                    executor.map(_read_scan_worker_file_time_ranges, new_files)))
+
+                def read_time_ranges(file):
+                    # Files changed since being checked are read again
+                    if file in new_file_time_ranges:
+                        return new_file_time_ranges.pop(file)
+                    return self._read_file_time_ranges(file)
+
+            file_time_ranges = [self._get_indexed_file_time_ranges(file, read_time_ranges) for file in files]
+        source_time_ranges = [time_range for time_ranges in file_time_ranges for time_range in time_ranges]
+        return sorted(source_time_ranges, key=lambda item: item[0])
+
+    def _read_file_time_ranges(self, file: str):
+        # Only unpacking may run concurrently within a process, reading netCDF files must not
+        self._dataset_cache.unpack_file(file)
+        with NETCDF_LOCK:
+            return self.read_file_time_ranges(file)
+
+    def read_file_time_ranges(self, file: str):
+        """
+        Read the time ranges of the images in source *file*. Must be overridden by providers
+        that use :py:meth:`get_file_time_ranges`.
+
+        :param file: The source file path.
+        :return: A sequence of (start_time, end_time, time_index) tuples.
+        """
+        raise NotImplementedError()
+
+    def compute_variable_images(self, period_start: datetime, period_end: datetime):
+        """
+        Like the base class implementation, but first schedules reading the source images of this and the next
+        **image_prefetch_depth** target periods on a background thread.
+        """
+        if self.image_prefetch_depth > 0 and self._source_time_ranges:
+            self._prefetch_source_images(period_start, period_end)
+        return super(NetCDFCubeSourceProvider, self).compute_variable_images(period_start, period_end)
+
     def compute_variable_images_from_sources(self, index_to_weight):
 
-        new_indices = self.close_unused_open_files(index_to_weight)
+        with NETCDF_LOCK:
+            new_indices = self.close_unused_open_files(index_to_weight)
+        if self.unpack_prefetch_count > 0 and new_indices:
+            self._prefetch_unpacked_files(max(new_indices) + 1)
+        if self.skip_invalid_source_files:
+            with NETCDF_LOCK:
+                new_indices = self._get_valid_indices(new_indices)
+            if not new_indices:
+                return None
 
         var_descriptors = self.variable_descriptors
-        target_var_images = dict()
-        for var_name, var_attributes in var_descriptors.items():
-            source_var_images = [None] * len(new_indices)
-            source_weights = [None] * len(new_indices)
-            var_image_index = 0
-            for i in new_indices:
-                file, time_index = self._get_file_and_time_index(i)
-                source_name = var_attributes.get('source_name', var_name)
-                variable = self._dataset_cache.get_dataset(file).variables[source_name]
-                if len(variable.shape) == 3:
-                    var_image = variable[time_index, :, :]
-                elif len(variable.shape) == 2:
-                    var_image = variable[:, :]
-                else:
-                    raise ValueError("unexpected shape for variable '%s'" % var_name)
-                var_image = self.transform_source_image(var_image)
-                if self._resampling_order == 'space_first':
-                    var_image = gtr.resample_2d(var_image,
+        source_names = self._get_source_names()
+        indices = sorted(new_indices)
+        # Temporal aggregation while reading, if required
+        var_name_to_accumulator = None
+        if self._resampling_order == 'fused':
+            # Temporal aggregation and spatial resampling in one pass
+            var_name_to_accumulator = {var_name: self._new_resampling_accumulator(var_attributes)
+                                       for var_name, var_attributes in var_descriptors.items()}
+        elif len(indices) > 1:
+            var_name_to_accumulator = {var_name: ImageAccumulator(skip_nan=self.nan_source_images)
+                                       for var_name in var_descriptors.keys()}
+        var_name_to_image = dict()
+        var_name_to_target_shift = dict()
+        # Visit each file and time index once only and read all variables from it. Every run of consecutive
+        # time indexes is aggregated as soon as it has been read, so that only one run is kept in memory.
+        for index_run in self._get_index_runs(indices):
+            index_to_source_images = self._get_source_images(index_run, source_names)
+            for i in index_run:
+                file, _ = self._get_file_and_time_index(i)
+                source_images = index_to_source_images.pop(i)
+                for var_name, var_attributes in var_descriptors.items():
+                    var_image = source_images[var_attributes.get('source_name', var_name)]
+                    var_image = self.transform_source_image(var_image)
+                    if self.shift_source_images:
+                        if var_name not in var_name_to_target_shift:
+                            var_name_to_target_shift[var_name] = _get_target_shift(self.shift_source_images,
+                                                                                   var_image.shape[1],
+                                                                                   self.cube_config.grid_width,
+                                                                                   _get_us_method(var_attributes))
+                        if var_name_to_target_shift[var_name] is None:
+                            # The shift does not commute with the spatial resampling
+                            var_image = np.roll(var_image, self.shift_source_images, axis=1)
+                    if self._resampling_order == 'space_first':
+                        var_image = resample_2d(var_image,
                                                 self.cube_config.grid_width,
                                                 self.cube_config.grid_height,
                                                 ds_method=_get_ds_method(var_attributes),
                                                 us_method=_get_us_method(var_attributes),
                                                 fill_value=var_attributes.get('fill_value', np.nan))
-                if var_image.shape[1] / var_image.shape[0] != 2.0:
-                    print("Warning: wrong size ratio of image in '%s'. Expected 2, got %f" % (
-                        file, var_image.shape[1] / var_image.shape[0]))
-                source_var_images[var_image_index] = var_image
-                source_weights[var_image_index] = index_to_weight[i]
-                var_image_index += 1
-            if len(new_indices) > 1:
-                # Temporal aggregation
-                var_image = aggregate_images(source_var_images, weights=source_weights)
+                    if var_image.shape[1] / var_image.shape[0] != 2.0:
+                        print("Warning: wrong size ratio of image in '%s'. Expected 2, got %f" % (
+                            file, var_image.shape[1] / var_image.shape[0]))
+                    if var_name_to_accumulator is not None:
+                        var_name_to_accumulator[var_name].add(var_image, index_to_weight[i])
+                    else:
+                        var_name_to_image[var_name] = var_image
+            # Release the images of this run before the next one is read
+            source_images = var_image = None
+
+        target_var_images = dict()
+        for var_name, var_attributes in var_descriptors.items():
+            if var_name_to_accumulator is not None:
+                var_image = var_name_to_accumulator[var_name].get_image()
             else:
                 # Temporal aggregation not required
-                var_image = source_var_images[0]
+                var_image = var_name_to_image[var_name]
             # Spatial resampling
             if self._resampling_order == 'time_first':
-                var_image = gtr.resample_2d(var_image,
-                                            self.cube_config.grid_width,
-                                            self.cube_config.grid_height,
-                                            ds_method=_get_ds_method(var_attributes),
-                                            us_method=_get_us_method(var_attributes),
-                                            fill_value=var_attributes.get('fill_value', np.nan))
+                var_image = resample_2d(var_image,
+                                        self.cube_config.grid_width,
+                                        self.cube_config.grid_height,
+                                        ds_method=_get_ds_method(var_attributes),
+                                        us_method=_get_us_method(var_attributes),
+                                        fill_value=var_attributes.get('fill_value', np.nan))
+            target_shift = var_name_to_target_shift.get(var_name)
+            if target_shift:
+                var_image = np.roll(var_image, target_shift, axis=1)
             target_var_images[var_name] = var_image
 
         return target_var_images
@@ -512,6 +843,176 @@ class NetCDFCubeSourceProvider(BaseCubeSourceProvider, metaclass=ABCMeta):
         """
         return source_image
 
+    def _new_resampling_accumulator(self, var_attributes):
+        return ResamplingAccumulator(self.cube_config.grid_width,
+                                     self.cube_config.grid_height,
+                                     ds_method=_get_ds_method(var_attributes),
+                                     us_method=_get_us_method(var_attributes),
+                                     fill_value=var_attributes.get('fill_value', np.nan),
+                                     skip_nan=self.nan_source_images)
+
+    def _get_source_names(self):
+        source_names = []
+        for var_name, var_attributes in self.variable_descriptors.items():
+            source_name = var_attributes.get('source_name', var_name)
+            if source_name not in source_names:
+                source_names.append(source_name)
+        return source_names
+
+    def _get_index_runs(self, indices):
+        """
+        Split the sorted source *indices* into runs of indices referring to consecutive time indexes
+        of the same file.
+        """
+        index_runs = []
+        last_file, last_time_index = None, None
+        for index in indices:
+            file, time_index = self._get_file_and_time_index(index)
+            if index_runs and file == last_file and time_index is not None and last_time_index is not None \
+                    and time_index == last_time_index + 1 and index == index_runs[-1][-1] + 1:
+                index_runs[-1].append(index)
+            else:
+                index_runs.append([index])
+            last_file, last_time_index = file, time_index
+        return index_runs
+
+    def _get_source_images(self, index_run, source_names):
+        """
+        Return a dictionary that maps each index of *index_run* to its source images, taken from the prefetched
+        source images or read now.
+        """
+        index_to_source_images = dict()
+        missing_indices = []
+        t1 = time.time()
+        for index in index_run:
+            future = self._prefetched_images.pop(index, None)
+            if future is not None and not future.cancelled():
+                index_to_source_images[index] = future.result()[index]
+            else:
+                missing_indices.append(index)
+        for missing_index_run in self._get_index_runs(missing_indices):
+            index_to_source_images.update(self._read_source_images(missing_index_run, source_names))
+        self._image_stall_time += time.time() - t1
+        return index_to_source_images
+
+    def _read_source_images(self, index_run, source_names):
+        """
+        Read the source images of all *source_names* for the indices of *index_run*. Consecutive time indexes of
+        a file are read as a single 3D hyperslab, so that every HDF5 chunk is read and decompressed once only.
+        """
+        file, time_index_1 = self._get_file_and_time_index(index_run[0])
+        index_to_source_images = {index: dict() for index in index_run}
+        with NETCDF_LOCK:
+            variables = self._dataset_cache.get_dataset(file).variables
+            for source_name in source_names:
+                variable = variables[source_name]
+                if len(variable.shape) == 3:
+                    if len(index_run) == 1:
+                        source_images = [self._read_variable(variable, time_index_1)]
+                    else:
+                        source_images = self._read_variable(variable,
+                                                            slice(time_index_1, time_index_1 + len(index_run)))
+                elif len(variable.shape) == 2:
+                    source_images = [self._read_variable(variable, Ellipsis)] * len(index_run)
+                else:
+                    raise ValueError("unexpected shape for variable '%s'" % source_name)
+                for i, index in enumerate(index_run):
+                    index_to_source_images[index][source_name] = source_images[i]
+        return index_to_source_images
+
+    def _read_variable(self, variable, key):
+        if self.nan_source_images:
+            images = read_nan_array(variable, key)
+        else:
+            images = variable[key]
+        # Views of the images read, for both single images and hyperslabs
+        if self.transpose_source_images:
+            images = images.swapaxes(-1, -2)
+        if self.flip_source_images:
+            images = images[..., ::-1, :]
+        return images
+
+    def _prefetch_source_images(self, period_start: datetime, period_end: datetime):
+        """
+        Schedule reading the source images of the given and the next **image_prefetch_depth** target periods.
+        Scheduled reads no longer needed are cancelled, so the buffer never exceeds these periods.
+        """
+        source_names = self._get_source_names()
+
+        index_runs = []
+        indices = set()
+        for next_period_start, next_period_end in [(period_start, period_end)] + \
+                self._get_next_periods(period_end, self.image_prefetch_depth):
+            period_indices = []
+            for index in sorted(self._get_index_to_weight(next_period_start, next_period_end).keys()):
+                file, _ = self._get_file_and_time_index(index)
+                if file not in self._invalid_files and index not in indices:
+                    period_indices.append(index)
+                    indices.add(index)
+            index_runs += self._get_index_runs(period_indices)
+
+        unused_futures = set()
+        for index in set(self._prefetched_images.keys()) - indices:
+            unused_futures.add(self._prefetched_images.pop(index))
+        # A future reads a whole index run, it is only cancelled if none of its indexes is needed anymore
+        for future in unused_futures - set(self._prefetched_images.values()):
+            future.cancel()
+        if self._image_prefetch_executor is None:
+            self._image_prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        for index_run in index_runs:
+            index_run = [index for index in index_run if index not in self._prefetched_images]
+            if index_run:
+                for index_run_part in self._get_index_runs(index_run):
+                    future = self._image_prefetch_executor.submit(self._read_source_images, index_run_part,
+                                                                  source_names)
+                    for index in index_run_part:
+                        self._prefetched_images[index] = future
+
+    def _get_next_periods(self, period_end: datetime, count: int):
+        """Return the next *count* target periods following the one ending at *period_end*."""
+        temporal_res = timedelta(days=self.cube_config.temporal_res)
+        periods = []
+        period_start = period_end
+        while len(periods) < count and period_start < self.cube_config.end_time:
+            # Like the cube's time axis, periods restart at the beginning of each year
+            period_end = min(period_start + temporal_res, datetime(period_start.year + 1, 1, 1))
+            periods.append((period_start, period_end))
+            period_start = period_end
+        return periods
+
+    def _prefetch_unpacked_files(self, start_index):
+        """Let the dataset cache unpack the files of the source time ranges following *start_index*."""
+        source_time_ranges = self._source_time_ranges
+        if self._has_packed_files is None:
+            self._has_packed_files = any(time_range[2].endswith('.gz') for time_range in source_time_ranges)
+        if not self._has_packed_files:
+            return
+        files = []
+        for i in range(start_index, len(source_time_ranges)):
+            file = source_time_ranges[i][2]
+            if file not in files:
+                files.append(file)
+                if len(files) == self.unpack_prefetch_count:
+                    break
+        self._dataset_cache.prefetch_unpacked_files(files)
+
+    def _get_valid_indices(self, indices):
+        valid_indices = []
+        for i in indices:
+            file, _ = self._get_file_and_time_index(i)
+            if file in self._invalid_files:
+                continue
+            try:
+                dataset = self._dataset_cache.get_dataset(file)
+            except (OSError, RuntimeError) as error:
+                dataset = None
+                self.log("skipping invalid source file '%s': %s" % (file, error))
+            if dataset is None:
+                self._invalid_files.add(file)
+            else:
+                valid_indices.append(i)
+        return valid_indices
+
     def close_unused_open_files(self, index_to_weight):
         """
         Close all datasets that wont be used anymore w.r.t. the given **index_to_weight** dictionary passed to the
@@ -530,4 +1031,13 @@ class NetCDFCubeSourceProvider(BaseCubeSourceProvider, metaclass=ABCMeta):
         return new_indices
 
     def close(self):
-        self._dataset_cache.close_all_datasets()
+        if self._image_prefetch_executor is not None:
+            self._image_prefetch_executor.shutdown(wait=True, cancel_futures=True)
+            self._image_prefetch_executor = None
+        self._prefetched_images = dict()
+        with NETCDF_LOCK:
+            self._dataset_cache.close_all_datasets()
+        stats = self._dataset_cache.stats
+        self.log('dataset cache: %d hit(s), %d miss(es), %d eviction(s)' % (stats['hits'], stats['misses'],
+                                                                           stats['evictions']))
+        self.log('waited %f seconds for source images' % self._image_stall_time)
@@ -8,6 +8,10 @@ from esdl.cube_provider import NetCDFCubeSourceProvider
 
 
 class AerosolsProvider(NetCDFCubeSourceProvider):
+    source_file_name_time = (r'^(\d{8})-', '%Y%m%d', timedelta(days=1))
+    skip_invalid_source_files = True
+    flip_source_images = True
+
     def __init__(self, cube_config, name='aerosols', dir=None, resampling_order=None):
         super(AerosolsProvider, self).__init__(cube_config, name, dir, resampling_order)
         self.old_indices = None
@@ -78,7 +82,7 @@ class AerosolsProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         for root, sub_dirs, files in os.walk(self.dir_path):
             for sub_dir in sub_dirs:
                 source_year = int(sub_dir)
@@ -86,22 +90,9 @@ class AerosolsProvider(NetCDFCubeSourceProvider):
                     sub_dir_path = os.path.join(self.dir_path, sub_dir)
                     file_names = os.listdir(sub_dir_path)
                     for file_name in file_names:
-                        time_info = file_name.split('-', 1)[0]
-                        time = self.day2date(int(time_info))
-                        if self.cube_config.start_time <= time <= self.cube_config.end_time:
-                            file = os.path.join(sub_dir_path, file_name)
-                            self.dataset_cache.get_dataset(file)
-                            self.dataset_cache.close_dataset(file)
-                            source_time_ranges.append((time, time + timedelta(days=1), file, 0))
-        return sorted(source_time_ranges, key=lambda item: item[0])
-
-    def transform_source_image(self, source_image):
-        """
-        Transforms the source image, here by flipping and then shifting horizontally.
-        :param source_image: 2D image
-        :return: source_image
-        """
-        return numpy.flipud(source_image)
+                        source_files.append(os.path.join(sub_dir_path, file_name))
+        return [time_range for time_range in self.scan_source_time_ranges(source_files)
+                if self.cube_config.start_time <= time_range[0] <= self.cube_config.end_time]
 
     @staticmethod
     def day2date(times):
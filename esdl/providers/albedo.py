@@ -8,6 +8,10 @@ from esdl.cube_provider import NetCDFCubeSourceProvider
 
 
 class AlbedoProvider(NetCDFCubeSourceProvider):
+    # The 5th dot-separated part of a file name is the start year and day of year of its 8-day period
+    source_file_name_time = (r'^(?:[^.]*\.){4}(\d{7})(?:\.|$)', '%Y%j', datetime.timedelta(days=8))
+    skip_invalid_source_files = True
+
     def __init__(self, cube_config, name='albedo', dir=None, resampling_order=None):
         super(AlbedoProvider, self).__init__(cube_config, name, dir, resampling_order)
         self.old_indices = None
@@ -46,19 +50,9 @@ class AlbedoProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
-
-        file_names = os.listdir(self.dir_path)
-        for file_name in file_names:
-            time_info = file_name.split('.', 5)[4]
-            t1, t2 = self.day2date(int(time_info))
-            if self.cube_config.start_time <= t1 <= self.cube_config.end_time:
-                file = os.path.join(self.dir_path, file_name)
-                self.dataset_cache.get_dataset(file)
-                self.dataset_cache.close_dataset(file)
-                source_time_ranges.append((t1, t2, file, 0))
-
-        return sorted(source_time_ranges, key=lambda item: item[0])
+        source_files = [os.path.join(self.dir_path, file_name) for file_name in os.listdir(self.dir_path)]
+        return [time_range for time_range in self.scan_source_time_ranges(source_files)
+                if self.cube_config.start_time <= time_range[0] <= self.cube_config.end_time]
 
     @staticmethod
     def day2date(times):
@@ -41,7 +41,7 @@ class AlbedoAVHRRProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         for root, sub_dirs, files in os.walk(self.dir_path):
             for sub_dir in sub_dirs:
                 source_year = int(sub_dir)
@@ -51,13 +51,16 @@ class AlbedoAVHRRProvider(NetCDFCubeSourceProvider):
                     for file_name in file_names:
                         if '.nc' in file_name:
                             file = os.path.join(sub_dir_path, file_name)
-                            dataset = self.dataset_cache.get_dataset(file)
-                            time = num2date(dataset.variables['time'][0],
-                                            dataset.variables['time'].units,
-                                            calendar='gregorian')
-                            self.dataset_cache.close_dataset(file)
-                            source_time_ranges.append((time, time + timedelta(days=1), file, 0))
-        return sorted(source_time_ranges, key=lambda item: item[0])
+                            source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        time = num2date(dataset.variables['time'][0],
+                        dataset.variables['time'].units,
+                        calendar='gregorian')
+        self.dataset_cache.close_dataset(file)
+        return [(time, time + timedelta(days=1), 0)]
 
     def transform_source_image(self, source_image):
         """
@@ -37,19 +37,24 @@ class BurntAreaProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         file_names = os.listdir(self.dir_path)
         for file_name in file_names:
             file = os.path.join(self.dir_path, file_name)
-            dataset = self.dataset_cache.get_dataset(file)
-            time_bnds = dataset.variables['time_bnds']
-            # TODO (forman, 20151028) - check datetime units, may be wrong in either the netCDF file (which is
-            # 'days since 1582-10-14 00:00') or the netCDF4 library
-            dates1 = netCDF4.num2date(time_bnds[:, 0], 'days since 1582-10-24 00:00', calendar='gregorian')
-            dates2 = netCDF4.num2date(time_bnds[:, 1], 'days since 1582-10-24 00:00', calendar='gregorian')
-            self.dataset_cache.close_dataset(file)
-            for i in range(len(dates1)):
-                t1 = datetime(dates1[i].year, dates1[i].month, dates1[i].day)
-                t2 = datetime(dates2[i].year, dates2[i].month, dates2[i].day)
-                source_time_ranges.append((t1, t2, file, i))
-        return sorted(source_time_ranges, key=lambda item: item[0])
+            source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        time_bnds = dataset.variables['time_bnds']
+        # TODO (forman, 20151028) - check datetime units, may be wrong in either the netCDF file (which is
+        # 'days since 1582-10-14 00:00') or the netCDF4 library
+        dates1 = netCDF4.num2date(time_bnds[:, 0], 'days since 1582-10-24 00:00', calendar='gregorian')
+        dates2 = netCDF4.num2date(time_bnds[:, 1], 'days since 1582-10-24 00:00', calendar='gregorian')
+        self.dataset_cache.close_dataset(file)
+        time_ranges = []
+        for i in range(len(dates1)):
+            t1 = datetime(dates1[i].year, dates1[i].month, dates1[i].day)
+            t2 = datetime(dates2[i].year, dates2[i].month, dates2[i].day)
+            time_ranges.append((t1, t2, i))
+        return time_ranges
@@ -7,6 +7,8 @@ from esdl.cube_provider import NetCDFCubeSourceProvider
 
 
 class FaparAvhrrProvider(NetCDFCubeSourceProvider):
+    flip_source_images = True
+
     def __init__(self, cube_config, name='fapar_avhrr', dir=None, resampling_order=None):
         super(FaparAvhrrProvider, self).__init__(cube_config, name, dir, resampling_order)
         self.old_indices = None
@@ -48,14 +50,6 @@ class FaparAvhrrProvider(NetCDFCubeSourceProvider):
                     source_time_ranges.append((date1, date2, file, 0))
         return sorted(source_time_ranges, key=lambda item: item[0])
 
-    def transform_source_image(self, source_image):
-        """
-        Transforms the source image, here by flipping and then shifting horizontally.
-        :param source_image: 2D image
-        :return: source_image
-        """
-        return np.flipud(source_image)
-
     @staticmethod
     def int2date(time_int: int):
         """
@@ -181,6 +181,8 @@ all_vars_descr = {'E': {
 
 
 class GleamProvider(NetCDFCubeSourceProvider):
+    transpose_source_images = True
+
     def __init__(self, cube_config, name='GLEAM', dir=None, resampling_order=None, var=None):
         super(GleamProvider, self).__init__(cube_config, name, dir, resampling_order)
         self.var_name = var
@@ -191,7 +193,7 @@ class GleamProvider(NetCDFCubeSourceProvider):
         return all_vars_descr[self.var_name]
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         for root, sub_dirs, files in os.walk(self.dir_path):
             for sub_dir in sub_dirs:
                 source_year = int(sub_dir)
@@ -201,24 +203,16 @@ class GleamProvider(NetCDFCubeSourceProvider):
                     for file_name in file_names:
                         if self.var_name + '_' in file_name:
                             file = os.path.join(self.dir_path, sub_dir, file_name).replace("\\", "/")
-                            dataset = self.dataset_cache.get_dataset(file)
-                            year = dataset.variables['DATE'][0, :].astype(int)
-                            month = dataset.variables['DATE'][1, :].astype(int)
-                            day = dataset.variables['DATE'][2, :].astype(int)
-                            self.dataset_cache.close_dataset(file)
-                            dates = [datetime.datetime(year[i], month[i], day[i]) for i in range(len(year))]
-                            cnt = 0
-                            for time in dates:
-                                if self.cube_config.start_time <= time <= self.cube_config.end_time:
-                                    source_time_ranges.append((time, time + timedelta(days=1), file, cnt))
-                                    cnt += 1
+                            source_files.append(file)
 
-        return sorted(source_time_ranges, key=lambda item: item[0])
+        return [time_range for time_range in self.scan_source_time_ranges(source_files)
+                if self.cube_config.start_time <= time_range[0] <= self.cube_config.end_time]
 
-    def transform_source_image(self, source_image):
-        """
-        Transforms the source image, here by rotating and flipping.
-        :param source_image: 2D image
-        :return: source_image
-        """
-        return numpy.fliplr(numpy.rot90(source_image, 3))
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        year = dataset.variables['DATE'][0, :].astype(int)
+        month = dataset.variables['DATE'][1, :].astype(int)
+        day = dataset.variables['DATE'][2, :].astype(int)
+        self.dataset_cache.close_dataset(file)
+        dates = [datetime.datetime(year[i], month[i], day[i]) for i in range(len(year))]
+        return [(dates[i], dates[i] + timedelta(days=1), i) for i in range(len(dates))]
@@ -39,7 +39,7 @@ class LaiFaparTipProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         for root, sub_dirs, files in os.walk(self.dir_path):
             for sub_dir in sub_dirs:
                 source_year = int(sub_dir)
@@ -49,10 +49,13 @@ class LaiFaparTipProvider(NetCDFCubeSourceProvider):
                     for file_name in file_names:
                         if '.nc' in file_name:
                             file = os.path.join(sub_dir_path, file_name)
-                            dataset = self.dataset_cache.get_dataset(file)
-                            time = netCDF4.num2date(dataset.variables['time'][0],
-                                                    dataset.variables['time'].units,
-                                                    calendar=dataset.variables['time'].calendar)
-                            self.dataset_cache.close_dataset(file)
-                            source_time_ranges.append((time, time + timedelta(days=1), file, 0))
-        return sorted(source_time_ranges, key=lambda item: item[0])
+                            source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        time = netCDF4.num2date(dataset.variables['time'][0],
+                                dataset.variables['time'].units,
+                                calendar=dataset.variables['time'].calendar)
+        self.dataset_cache.close_dataset(file)
+        return [(time, time + timedelta(days=1), 0)]
@@ -8,6 +8,8 @@ from esdl.cube_provider import NetCDFCubeSourceProvider
 
 
 class LandSurfTemperatureProvider(NetCDFCubeSourceProvider):
+    flip_source_images = True
+
     def __init__(self, cube_config, name='land_surface_temperature', dir=None, resampling_order=None):
         super(LandSurfTemperatureProvider, self).__init__(cube_config, name, dir, resampling_order)
         self.old_indices = None
@@ -30,7 +32,7 @@ class LandSurfTemperatureProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         file_names = os.listdir(self.dir_path)
         for file_name in file_names:
             if '.nc' in file_name:
@@ -39,17 +41,15 @@ class LandSurfTemperatureProvider(NetCDFCubeSourceProvider):
                                                 00)
                 if self.cube_config.start_time.year <= source_date.year <= self.cube_config.end_time.year:
                     file = os.path.join(self.dir_path, file_name).replace("\\", "/")
-                    dataset = self.dataset_cache.get_dataset(file)
-                    if self.variable_descriptors[self._name]["source_name"] in dataset.variables:
-                        source_time_ranges.append(
-                            (source_date - timedelta(hours=12), source_date + timedelta(hours=12), file, 0))
-                    self.dataset_cache.close_dataset(file)
-        return sorted(source_time_ranges, key=lambda item: item[0])
-
-    def transform_source_image(self, source_image):
-        """
-        Transforms the source image, here by rotating and flipping.
-        :param source_image: 2D image
-        :return: source_image
-        """
-        return numpy.flipud(source_image)
+                    source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        file_name = os.path.basename(file)
+        source_date = datetime.datetime(int(file_name[22:26]), int(file_name[26:28]), int(file_name[28:30]), 12, 00)
+        time_ranges = []
+        dataset = self.dataset_cache.get_dataset(file)
+        if self.variable_descriptors[self._name]["source_name"] in dataset.variables:
+            time_ranges.append((source_date - timedelta(hours=12), source_date + timedelta(hours=12), 0))
+        self.dataset_cache.close_dataset(file)
+        return time_ranges
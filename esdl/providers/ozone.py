@@ -1,13 +1,15 @@
 import os
 from datetime import datetime
 
-import netCDF4
 import numpy
 
 from esdl.cube_provider import NetCDFCubeSourceProvider
 
 
 class OzoneProvider(NetCDFCubeSourceProvider):
+    flip_source_images = True
+    shift_source_images = 180
+
     def __init__(self, cube_config, name='ozone', dir=None, resampling_order=None):
         super(OzoneProvider, self).__init__(cube_config, name, dir, resampling_order)
         self.old_indices = None
@@ -33,26 +35,28 @@ class OzoneProvider(NetCDFCubeSourceProvider):
 
     def compute_source_time_ranges(self):
         file_names = os.listdir(self.dir_path)
-        source_time_ranges = list()
+        source_files = []
         for file_name in file_names:
             file = os.path.join(self.dir_path, file_name)
-            dataset = netCDF4.Dataset(file)
-            t1 = dataset.time_coverage_start
-            t2 = dataset.time_coverage_end
-            dataset.close()
-            source_time_ranges.append((datetime(int(t1[0:4]), int(t1[4:6]), int(t1[6:8])),
-                                       datetime(int(t2[0:4]), int(t2[4:6]), int(t2[6:8])),
-                                       file,
-                                       None))
-        return sorted(source_time_ranges, key=lambda item: item[0])
+            source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        t1 = dataset.time_coverage_start
+        t2 = dataset.time_coverage_end
+        self.dataset_cache.close_dataset(file)
+        return [(datetime(int(t1[0:4]), int(t1[4:6]), int(t1[6:8])),
+                 datetime(int(t2[0:4]), int(t2[4:6]), int(t2[6:8])),
+                 None)]
 
     def transform_source_image(self, source_image):
         """
-        Transforms the source image, here by flipping and then shifting horizontally.
+        Transforms the source image, here by replacing -9.9 values by NaN.
         :param source_image: 2D image
         :return: source_image
         """
         # TODO (hans-permana, 20161219): the following line is a workaround to an issue where the nan values are
         # always read as -9.9. Find out why these values are automatically converted and create a better fix.
         source_image[source_image == -9.9] = numpy.nan
-        return numpy.roll(numpy.flipud(source_image), 180, axis=1)
+        return source_image
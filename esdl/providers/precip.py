@@ -32,13 +32,16 @@ class PrecipProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         file_names = os.listdir(self.dir_path)
         for file_name in file_names:
             file = os.path.join(self.dir_path, file_name)
-            dataset = self.dataset_cache.get_dataset(file)
-            time = dataset.variables['time']
-            dates = netCDF4.num2date(time[:], calendar=time.calendar, units=time.units)
-            self.dataset_cache.close_dataset(file)
-            source_time_ranges += [(dates[i], dates[i] + timedelta(days=1), file, i) for i in range(len(dates))]
-        return sorted(source_time_ranges, key=lambda item: item[0])
+            source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        time = dataset.variables['time']
+        dates = netCDF4.num2date(time[:], calendar=time.calendar, units=time.units)
+        self.dataset_cache.close_dataset(file)
+        return [(dates[i], dates[i] + timedelta(days=1), i) for i in range(len(dates))]
@@ -31,20 +31,22 @@ class SnowWaterEquivalentProvider(NetCDFCubeSourceProvider):
             }
         }
 
-    def close(self):
-        self.dataset_cache.close_all_datasets()
-
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         file_names = os.listdir(self.dir_path)
         for file_name in file_names:
             file = os.path.join(self.dir_path, file_name)
-            dataset = self.dataset_cache.get_dataset(file)
-            time_bnds = dataset.variables['time']
-            time = netCDF4.num2date(time_bnds[:], 'days since 1582-10-15 00:00', calendar='gregorian')
-            self.dataset_cache.close_dataset(file)
-            for i in range(len(time)):
-                t1 = datetime(time[i].year, time[i].month, time[i].day)
-                t2 = t1 + timedelta(days=1)
-                source_time_ranges.append((t1, t2, file, i))
-        return sorted(source_time_ranges, key=lambda item: item[0])
+            source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        time_bnds = dataset.variables['time']
+        time = netCDF4.num2date(time_bnds[:], 'days since 1582-10-15 00:00', calendar='gregorian')
+        self.dataset_cache.close_dataset(file)
+        time_ranges = []
+        for i in range(len(time)):
+            t1 = datetime(time[i].year, time[i].month, time[i].day)
+            t2 = t1 + timedelta(days=1)
+            time_ranges.append((t1, t2, i))
+        return time_ranges
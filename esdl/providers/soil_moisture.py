@@ -36,22 +36,27 @@ class SoilMoistureProvider(NetCDFCubeSourceProvider):
         }
 
     def compute_source_time_ranges(self):
-        source_time_ranges = []
+        source_files = []
         file_names = os.listdir(self.dir_path)
         for file_name in file_names:
             if file_name.endswith('.nc.gz'):
                 file = os.path.join(self.dir_path, file_name)
-                dataset = self.dataset_cache.get_dataset(file)
-                time = dataset.variables['time']
-                # dates = netCDF4.num2date(time[:], time.units, calendar=time.calendar)
-                dates = netCDF4.num2date(time[:], 'days since 1582-10-15 00:00', calendar='gregorian')
-                self.dataset_cache.close_dataset(file)
-                n = len(dates)
-                for i in range(n):
-                    t1 = dates[i]
-                    if i < n - 1:
-                        t2 = dates[i + 1]
-                    else:
-                        t2 = t1 + timedelta(days=31)  # assuming it's December
-                    source_time_ranges.append((t1, t2, file, i))
-        return sorted(source_time_ranges, key=lambda item: item[0])
+                source_files.append(file)
+        return self.scan_source_time_ranges(source_files)
+
+    def read_file_time_ranges(self, file):
+        dataset = self.dataset_cache.get_dataset(file)
+        time = dataset.variables['time']
+        # dates = netCDF4.num2date(time[:], time.units, calendar=time.calendar)
+        dates = netCDF4.num2date(time[:], 'days since 1582-10-15 00:00', calendar='gregorian')
+        self.dataset_cache.close_dataset(file)
+        time_ranges = []
+        n = len(dates)
+        for i in range(n):
+            t1 = dates[i]
+            if i < n - 1:
+                t2 = dates[i + 1]
+            else:
+                t2 = t1 + timedelta(days=31)  # assuming it's December
+            time_ranges.append((t1, t2, i))
+        return time_ranges
@@ -1,15 +1,18 @@
 import glob
 import os
 
-import gridtools.resampling as gtr
 import netCDF4
 import numpy as np
 
 from esdl.cube_provider import BaseStaticCubeSourceProvider
-from esdl.util import Config
+from esdl.util import Config, NETCDF_LOCK
 
 
 class WaterMaskProvider(BaseStaticCubeSourceProvider):
+    #: Number of target rows computed from each band of source rows read. Each target row of a band needs
+    #: about 4 bytes per source pixel, e.g. 190 MB for the 259200x129600 source and a 0.25 degree grid.
+    band_height = 1
+
     def __init__(self, cube_config, name='water_mask', dir=None):
         super(WaterMaskProvider, self).__init__(cube_config, name)
         if dir is None:
@@ -47,25 +50,38 @@ class WaterMaskProvider(BaseStaticCubeSourceProvider):
         if not file_paths:
             raise ValueError('No *.nc file found in %s' % self._dir_path)
         file = file_paths[0]
-        return netCDF4.Dataset(file)
+        with NETCDF_LOCK:
+            return netCDF4.Dataset(file)
 
     def get_dataset_image(self, dataset, var_name):
-        variable = dataset.variables[var_name]
-        var_image = np.empty((self.cube_config.grid_height, self.cube_config.grid_width))
-        x_max = 259200
-        y_max = 129600
-        chunk_size = int(x_max / self.cube_config.grid_width)
-        x_index = 1
-        y_index = 1
-        while (y_index * chunk_size) <= y_max:
-            while (x_index * chunk_size) <= x_max:
-                chunked = variable[(y_index - 1) * chunk_size:(y_index * chunk_size),
-                          (x_index - 1) * chunk_size:(x_index * chunk_size)]
-                var_image[y_index - 1, x_index - 1] = gtr.resample_2d(chunked.astype(int), 1, 1)
-                x_index += 1
-            y_index += 1
-            x_index = 1
+        """
+        Compute the mean of the valid source pixels of each target pixel, NaN if there are none. The source image
+        is read in bands of whole source rows, each band is reduced to **band_height** target rows at once.
+        Only the reads hold ``NETCDF_LOCK``, so that other providers can read their sources during the reduction.
+        """
+        with NETCDF_LOCK:
+            variable = dataset.variables[var_name]
+            src_height, src_width = variable.shape
+        grid_height = self.cube_config.grid_height
+        grid_width = self.cube_config.grid_width
+        if src_height % grid_height != 0 or src_width % grid_width != 0:
+            raise ValueError('source image size %dx%d is not a multiple of the grid size %dx%d' % (
+                src_width, src_height, grid_width, grid_height))
+        block_height = src_height // grid_height
+        block_width = src_width // grid_width
+        var_image = np.empty((grid_height, grid_width))
+        for y1 in range(0, grid_height, self.band_height):
+            y2 = min(y1 + self.band_height, grid_height)
+            with NETCDF_LOCK:
+                band = variable[y1 * block_height:y2 * block_height, :]
+            block_shape = (y2 - y1, block_height, grid_width, block_width)
+            valid = ~np.ma.getmaskarray(band)
+            sums = (np.ma.getdata(band) * valid).reshape(block_shape).sum(axis=(1, 3), dtype=np.int64)
+            counts = valid.reshape(block_shape).sum(axis=(1, 3))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                var_image[y1:y2, :] = sums / counts
         return var_image
 
     def close_dataset(self, dataset):
-        dataset.close()
+        with NETCDF_LOCK:
+            dataset.close()
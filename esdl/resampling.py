@@ -0,0 +1,266 @@
+"""
+Spatial resampling of source images using cached resampling plans.
+
+Downsampling by area-weighted mean (``DS_MEAN``) and upsampling by an integer factor using the nearest neighbour
+(``US_NEAREST``) are separable into one resampling step per axis. For a given source shape, target size and
+resampling methods a :py:class:`ResamplingPlan` holding the source indices and weights of each target row and
+column is computed once and then applied to every image by a compiled kernel, which reduces the source rows of a
+target row in a single contiguous pass. All other cases are delegated to ``gridtools.resampling``.
+A :py:class:`ResamplingAccumulator` uses the same kernel to average images over time and space at once.
+"""
+import functools
+
+import gridtools.resampling as gtr
+import numba
+import numpy as np
+
+from .util import ImageAccumulator
+
+#: Maximum number of resampling plans kept by :py:func:`get_resampling_plan`.
+MAX_RESAMPLING_PLANS = 32
+
+_EPS = 1e-10
+
+_NO_MASK = np.zeros((1, 1), dtype=np.bool_)
+
+
+def resample_2d(src, w: int, h: int, ds_method=gtr.DS_MEAN, us_method=gtr.US_LINEAR, fill_value=None):
+    """
+    Resample the 2D image *src* to width *w* and height *h*, like ``gridtools.resampling.resample_2d()``.
+
+    Floating point images are resampled by a cached :py:class:`ResamplingPlan`, if one exists for the given
+    shapes and methods. Masked pixels and non-finite values are ignored.
+
+    :param src: 2D image (numpy array or masked array)
+    :param w: the target width
+    :param h: the target height
+    :param ds_method: the downsampling method, one of the ``gridtools.resampling.DS_*`` constants
+    :param us_method: the upsampling method, one of the ``gridtools.resampling.US_*`` constants
+    :param fill_value: the value of target pixels without valid source pixels
+    :return: the resampled 2D image
+    """
+    src_h, src_w = src.shape
+    if src_w == w and src_h == h:
+        return src
+    if fill_value is not None and src.dtype in (np.float32, np.float64):
+        plan = get_resampling_plan((src_h, src_w), w, h, ds_method, us_method)
+        if plan is not None:
+            return plan.apply(src, fill_value)
+    return gtr.resample_2d(src, w, h, ds_method=ds_method, us_method=us_method, fill_value=fill_value)
+
+
+@functools.lru_cache(maxsize=MAX_RESAMPLING_PLANS)
+def get_resampling_plan(src_shape, w: int, h: int, ds_method, us_method):
+    """
+    Get the resampling plan for images of shape *src_shape* (height, width) resampled to width *w* and height *h*.
+
+    :return: a cached :py:class:`ResamplingPlan` or ``None``, if the resampling is not supported by plans.
+    """
+    src_h, src_w = src_shape
+    if w <= src_w and h <= src_h:
+        if ds_method != gtr.DS_MEAN:
+            return None
+    elif w >= src_w and h >= src_h:
+        if us_method != gtr.US_NEAREST or w % src_w != 0 or h % src_h != 0:
+            return None
+    else:
+        # Downsampling one axis and upsampling the other one is done in two passes by gridtools
+        return None
+    return ResamplingPlan(src_shape, w, h)
+
+
+class ResamplingPlan:
+    """
+    The source indices and weights of the target rows and columns for resampling images of shape *src_shape*
+    (height, width) to width *w* and height *h*. Axes are either downsampled by area-weighted mean or
+    upsampled by an integer factor.
+
+    :param src_shape: the source image shape (height, width)
+    :param w: the target width
+    :param h: the target height
+    """
+
+    def __init__(self, src_shape, w: int, h: int):
+        src_h, src_w = src_shape
+        self._src_shape = tuple(src_shape)
+        self._shape = (h, w)
+        self._y_indices, self._y_weights = _get_axis_plan(src_h, h)
+        self._x_indices, self._x_weights = _get_axis_plan(src_w, w)
+
+    @property
+    def src_shape(self):
+        """The source image shape (height, width)."""
+        return self._src_shape
+
+    @property
+    def shape(self):
+        """The target image shape (height, width)."""
+        return self._shape
+
+    def apply(self, src, fill_value):
+        """
+        Resample the 2D floating point image *src*. Masked pixels and non-finite values are ignored.
+
+        :param src: 2D image (numpy array or masked array) of shape **src_shape**
+        :param fill_value: the value of target pixels without valid source pixels
+        :return: the resampled 2D image, a numpy array of shape **shape** with the data type of **src**
+        """
+        value_sums = np.zeros(self._shape, dtype=np.float64)
+        weight_sums = np.zeros(self._shape, dtype=np.float64)
+        self.accumulate(src, 1.0, value_sums, weight_sums)
+        return _get_mean(value_sums, weight_sums, fill_value, np.ma.getdata(src).dtype)
+
+    def accumulate(self, src, weight, value_sums, weight_sums):
+        """
+        Add the weighted sums of the valid pixels of the 2D floating point image *src* covered by each target pixel,
+        multiplied by *weight*, to *value_sums* and the sums of their weights to *weight_sums*.
+        Masked pixels and non-finite values are ignored.
+
+        :param src: 2D image (numpy array or masked array) of shape **src_shape**
+        :param weight: the weight of **src**
+        :param value_sums: float64 array of shape **shape**
+        :param weight_sums: float64 array of shape **shape**
+        """
+        if src.shape != self._src_shape:
+            raise ValueError('expected image of shape %s, got %s' % (self._src_shape, src.shape))
+        data = np.ma.getdata(src)
+        mask = np.ma.getmask(src)
+        use_mask = mask is not np.ma.nomask
+        _accumulate_plan(data, mask if use_mask else _NO_MASK, use_mask, weight,
+                         self._y_indices, self._y_weights, self._x_indices, self._x_weights, value_sums, weight_sums)
+
+
+class ResamplingAccumulator:
+    """
+    Averages 2D source images over time and space in one pass: the weighted pixels of each image added are
+    accumulated straight into the target pixels of width *w* and height *h* by a :py:class:`ResamplingPlan`,
+    without computing a temporal mean image of the source resolution. Each target pixel becomes the weighted mean
+    of all valid source pixels covering it, weighted by their image's weight and their covered area.
+
+    If no plan exists for the images' shape and methods, the images are averaged by an
+    :py:class:`esdl.util.ImageAccumulator` and the mean image is then resampled by :py:func:`resample_2d`.
+
+    :param w: the target width
+    :param h: the target height
+    :param ds_method: the downsampling method, one of the ``gridtools.resampling.DS_*`` constants
+    :param us_method: the upsampling method, one of the ``gridtools.resampling.US_*`` constants
+    :param fill_value: the value of target pixels without valid source pixels
+    :param skip_nan: passed to the :py:class:`esdl.util.ImageAccumulator` if no plan exists
+    """
+
+    def __init__(self, w: int, h: int, ds_method=gtr.DS_MEAN, us_method=gtr.US_LINEAR, fill_value=np.nan,
+                 skip_nan=False):
+        self._w = w
+        self._h = h
+        self._ds_method = ds_method
+        self._us_method = us_method
+        self._fill_value = fill_value
+        self._skip_nan = skip_nan
+        self._plan = None
+        self._value_sums = None
+        self._weight_sums = None
+        self._image_accumulator = None
+
+    def add(self, image, weight=1.0):
+        """
+        Add the 2D *image* with the given *weight*.
+
+        :param image: 2D image (numpy array or masked array), all images must have the same shape
+        :param weight: a weight 0..1
+        """
+        if self._plan is None and self._image_accumulator is None:
+            if image.dtype in (np.float32, np.float64):
+                self._plan = get_resampling_plan(image.shape, self._w, self._h, self._ds_method, self._us_method)
+            if self._plan is not None:
+                self._value_sums = np.zeros(self._plan.shape, dtype=np.float64)
+                self._weight_sums = np.zeros(self._plan.shape, dtype=np.float64)
+            else:
+                self._image_accumulator = ImageAccumulator(skip_nan=self._skip_nan)
+        if self._plan is not None:
+            self._plan.accumulate(image, weight, self._value_sums, self._weight_sums)
+        else:
+            self._image_accumulator.add(image, weight)
+
+    def get_image(self):
+        """
+        Get the resampled mean of the images added so far.
+
+        :return: A float64 image of width **w** and height **h**.
+        """
+        if self._plan is not None:
+            return _get_mean(self._value_sums, self._weight_sums, self._fill_value, np.float64)
+        if self._image_accumulator is None:
+            raise ValueError('no images added')
+        return resample_2d(self._image_accumulator.get_image(), self._w, self._h,
+                           ds_method=self._ds_method, us_method=self._us_method, fill_value=self._fill_value)
+
+
+def _get_axis_plan(src_size: int, size: int):
+    """
+    Get the source indices and weights of each target cell along an axis of *src_size* cells resampled to *size*
+    cells, as two arrays of shape (size, n). If downsampling, each target cell covers *src_size* / *size* source
+    cells, partially covered ones get a weight less than one. Unused entries have index 0 and weight 0.
+    """
+    if size >= src_size:
+        # Upsampling by an integer factor, the nearest source cell
+        return (np.arange(size) * src_size // size).reshape((size, 1)), np.ones((size, 1))
+    scale = src_size / size
+    start = scale * np.arange(size)
+    end = start + scale
+    first = start.astype(np.int64)
+    last = end.astype(np.int64)
+    first_weight = 1.0 - (start - first)
+    last_weight = end - last
+    # A cell ending at a source cell border does not cover the next one
+    at_border = last_weight < _EPS
+    last_weight[at_border] = 1.0
+    last[at_border & (last > first)] -= 1
+    n = int((last - first).max()) + 1
+    indices = first[:, np.newaxis] + np.arange(n)
+    weights = np.where(indices == last[:, np.newaxis], last_weight[:, np.newaxis], 1.0)
+    weights[:, 0] = first_weight
+    unused = indices > last[:, np.newaxis]
+    weights[unused] = 0.0
+    indices[unused] = 0
+    return indices, weights
+
+
+def _get_mean(value_sums, weight_sums, fill_value, dtype):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = value_sums / weight_sums
+    mean[weight_sums < _EPS] = fill_value
+    return mean.astype(dtype, copy=False)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _accumulate_plan(src, mask, use_mask, weight, y_indices, y_weights, x_indices, x_weights,
+                     value_sums, weight_sums):
+    h, y_n = y_indices.shape
+    w, x_n = x_indices.shape
+    src_w = src.shape[1]
+    # Weighted sums of the values and weights of the source rows of a target row
+    row_values = np.empty(src_w, dtype=np.float64)
+    row_weights = np.empty(src_w, dtype=np.float64)
+    for y in range(h):
+        row_values[:] = 0.0
+        row_weights[:] = 0.0
+        for i in range(y_n):
+            y_weight = weight * y_weights[y, i]
+            if y_weight == 0.0:
+                continue
+            src_y = y_indices[y, i]
+            for src_x in range(src_w):
+                value = src[src_y, src_x]
+                valid = np.isfinite(value) and not (use_mask and mask[src_y, src_x])
+                row_values[src_x] += y_weight * value if valid else 0.0
+                row_weights[src_x] += y_weight if valid else 0.0
+        for x in range(w):
+            value_sum = 0.0
+            weight_sum = 0.0
+            for i in range(x_n):
+                src_x = x_indices[x, i]
+                x_weight = x_weights[x, i]
+                value_sum += x_weight * row_values[src_x]
+                weight_sum += x_weight * row_weights[src_x]
+            value_sums[y, x] += value_sum
+            weight_sums[y, x] += weight_sum
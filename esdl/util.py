@@ -3,15 +3,26 @@ Various utility constants, functions and classes.
 Developer note: make sure this module does not import any other esdl module!
 """
 import gzip
+import json
 import math
 import os
+import shutil
+import socket
+import threading
 from abc import abstractmethod, ABCMeta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import netCDF4
 import numpy
 
 
+#: Serializes all access to netCDF datasets. The netCDF and HDF5 libraries are not thread-safe, but
+#: netCDF4 releases the GIL while calling them, so source files must never be accessed by two threads at once.
+NETCDF_LOCK = threading.RLock()
+
+
 def temporal_weight(a1, a2, b1, b2):
     """
     Compute a weight (0.0 to 1.0) from the overlap of time range *a1*...*a2* with time range *b1*...*b2*.
@@ -50,22 +61,153 @@ def aggregate_images(images, weights=None):
     :param weights: a weight 0..1 for each image
     :return: A combined, masked image.
     """
-    reshaped_images = []
+    accumulator = ImageAccumulator()
     for i in range(len(images)):
-        image = images[i]
-        reshaped_image = image.reshape((1,) + image.shape)
-        reshaped_images.append(reshaped_image)
-        image_stack = numpy.ma.concatenate(reshaped_images)
-    return numpy.ma.average(image_stack, axis=0, weights=weights)
-
-    # aggregated_images = numpy.ma.zeros(images[0].shape,dtype = numpy.float32)
-    # for i in range(len(images)):
-    #     image = images[i].astype(numpy.float32)
-    #     if weights:
-    #         numpy.multiply(image,weights[i],out = image, casting = 'same_kind')
-    #     aggregated_images += image * 1./(len(images))
-    #     numpy.add(aggregated_images, image * 1./(len(images)),out = aggregated_images)
-    # return aggregated_images
+        accumulator.add(images[i], weights[i] if weights is not None else 1.0)
+    return accumulator.get_image()
+
+
+class ImageAccumulator:
+    """
+    Averages optionally masked 2-D images of the same shape one by one, like :py:func:`aggregate_images`,
+    but without keeping the images. A running weighted sum and weight sum are kept in float64,
+    so that memory use does not grow with the number of images added.
+    """
+
+    def __init__(self, skip_nan=False):
+        """
+        :param skip_nan: if ``True``, NaN pixels are ignored like masked ones, and :py:meth:`get_image` returns a
+               plain array with NaN for missing pixels. Use this for images read by :py:func:`read_nan_array`.
+        """
+        self._skip_nan = skip_nan
+        self._sum = None
+        self._weight_sum = None
+
+    def add(self, image, weight=1.0):
+        """
+        Add *image* with the given *weight* to the average. Masked pixels of **image** are ignored.
+
+        :param image: 2-D image (numpy array-like object)
+        :param weight: a weight 0..1
+        """
+        data = numpy.ma.getdata(image)
+        mask = numpy.ma.getmask(image)
+        if self._sum is None:
+            self._sum = numpy.zeros(data.shape, dtype=numpy.float64)
+            self._weight_sum = numpy.zeros(data.shape, dtype=numpy.float64)
+        if self._skip_nan and data.dtype.kind == 'f':
+            valid = ~numpy.isnan(data)
+            if mask is not numpy.ma.nomask:
+                valid &= ~mask
+            self._sum += weight * numpy.where(valid, data, 0.0)
+            self._weight_sum += weight * valid
+        elif mask is numpy.ma.nomask:
+            self._sum += weight * data.astype(numpy.float64, copy=False)
+            self._weight_sum += weight
+        else:
+            valid = ~mask
+            self._sum += weight * numpy.where(valid, data, 0.0)
+            self._weight_sum += weight * valid
+
+    def get_image(self):
+        """
+        Get the average of the images added so far.
+
+        :return: A combined, masked float64 image. Pixels masked in all images, with a zero weight sum or a
+                 non-finite average are masked. If **skip_nan** is set, a plain float64 image with NaN for them.
+        """
+        if self._sum is None:
+            raise ValueError('no images added')
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            average = self._sum / self._weight_sum
+        if self._skip_nan:
+            return average
+        # Like numpy.ma.average, also mask non-finite results
+        mask = ~numpy.isfinite(average)
+        return numpy.ma.masked_array(average, mask=mask if mask.any() else False)
+
+
+def read_nan_array(variable, key):
+    """
+    Read *variable* [*key*] from a netCDF4 variable as a plain numpy array, with NaN instead of a masked array.
+    Automatic masking and scaling of **variable** are turned off while reading, the values masked by netCDF4
+    (``missing_value``, ``_FillValue`` or the default fill value, outside ``valid_range`` or ``valid_min`` and
+    ``valid_max``) are replaced by NaN in a single pass and ``scale_factor`` and ``add_offset`` are applied
+    as by netCDF4. Integer data without scaling is converted to float32, or float64 if wider than 16 bits.
+    Must be called while holding the :py:data:`NETCDF_LOCK`.
+
+    :param variable: a netCDF4 variable
+    :param key: the index, e.g. a time index or a slice
+    :return: a float32 or float64 numpy array
+    """
+    mask, scale = variable.mask, variable.scale
+    variable.set_auto_maskandscale(False)
+    try:
+        data = variable[key]
+    finally:
+        variable.set_auto_mask(mask)
+        variable.set_auto_scale(scale)
+    data = numpy.asarray(data)
+
+    if data.dtype.kind == 'i' and getattr(variable, '_Unsigned', False) in ('true', 'True'):
+        data = data.view('%su%s' % (data.dtype.byteorder, data.dtype.itemsize))
+    invalid = _get_invalid_values(variable, data)
+
+    scale_factor = getattr(variable, 'scale_factor', None)
+    add_offset = getattr(variable, 'add_offset', None)
+    if scale_factor is not None and add_offset is not None:
+        if add_offset != 0.0 or scale_factor != 1.0:
+            data = data * scale_factor + add_offset
+        else:
+            data = data.astype(numpy.asarray(scale_factor).dtype)
+    elif scale_factor is not None and scale_factor != 1.0:
+        data = data * scale_factor
+    elif add_offset is not None and add_offset != 0.0:
+        data = data + add_offset
+    if data.dtype.kind != 'f':
+        data = data.astype(numpy.float32 if data.dtype.itemsize <= 2 else numpy.float64)
+
+    if invalid is not None:
+        # Setting bits 22 or 51 and all exponent bits makes any float a NaN. ORing them in is branch-free and
+        # several times faster than assigning NaN through a scattered boolean mask.
+        if data.dtype == numpy.float32:
+            data.view(numpy.uint32)[...] |= invalid.view(numpy.uint8) * numpy.uint32(0x7fc00000)
+        elif data.dtype == numpy.float64:
+            data.view(numpy.uint64)[...] |= invalid.view(numpy.uint8) * numpy.uint64(0x7ff8000000000000)
+        else:
+            data[invalid] = numpy.nan
+    return data
+
+
+def _get_invalid_values(variable, data):
+    """Get the mask of values in the unscaled *data* that netCDF4 would mask, or None if there are none."""
+    dtype = data.dtype
+
+    def get_values(name):
+        value = getattr(variable, name, None)
+        return None if value is None else numpy.array(value).astype(dtype).reshape(-1)
+
+    invalid = numpy.zeros(data.shape, dtype=numpy.bool_)
+    missing_values = get_values('missing_value')
+    fill_values = get_values('_FillValue')
+    if fill_values is None and dtype.str[1:] not in ('u1', 'i1'):
+        fill_values = numpy.array([netCDF4.default_fillvals[variable.dtype.str[1:]]]).astype(dtype)
+    for values in (missing_values, fill_values):
+        if values is not None:
+            for value in values:
+                invalid |= numpy.isnan(data) if dtype.kind == 'f' and numpy.isnan(value) else data == value
+    valid_range = get_values('valid_range')
+    if valid_range is not None and valid_range.size == 2:
+        valid_min, valid_max = valid_range
+    else:
+        valid_min, valid_max = get_values('valid_min'), get_values('valid_max')
+        valid_min = valid_min[0] if valid_min is not None else None
+        valid_max = valid_max[0] if valid_max is not None else None
+    if valid_min is not None:
+        invalid |= data < valid_min
+    if valid_max is not None:
+        invalid |= data > valid_max
+    return invalid if invalid.any() else None
 
 
 def resolve_temporal_range_index(target_start_year: int,
@@ -124,15 +266,93 @@ class DatasetCache(metaclass=ABCMeta):
 
     Datasets are cached the CAB-LAB user data folder **cache_base_dir**/**name**.
 
+    The number of open datasets may be bounded by *max_open_datasets* and the total size of their files by
+    *max_bytes*. If a bound is exceeded, the least recently used datasets are closed. The **stats** property
+    counts cache hits, misses and evictions.
+
+    Gzip-compressed files (``*.gz``) are unpacked into the cache directory before they are opened.
+    The size of the unpacked files may be bounded by *max_unpacked_bytes*, least recently used files are removed
+    then. Unpacked files that are being used by any process sharing the cache directory are never removed,
+    every process marks the files it uses by a lock file named after its process ID.
+    **prefetch_unpacked_files()** unpacks files in the background before they are needed.
+
     :param name: A name for the cache.
     :param cache_base_dir: Cache base directory. Defaults to ~/.esdl.
+    :param max_open_datasets: Maximum number of open datasets. Defaults to no limit.
+    :param max_bytes: Maximum total size in bytes of the files of open datasets. Defaults to no limit.
+    :param eviction_callback: Optional function called with the file path and the dataset of each evicted dataset
+           before the dataset is closed.
+    :param max_unpacked_bytes: Maximum total size in bytes of the unpacked files in the cache directory.
+           Defaults to no limit.
     """
 
-    def __init__(self, name, cache_base_dir=None):
+    def __init__(self, name, cache_base_dir=None, max_open_datasets=None, max_bytes=None, eviction_callback=None,
+                 max_unpacked_bytes=None):
         if cache_base_dir is None:
             cache_base_dir = os.path.join(os.path.join(os.path.expanduser("~"), '.esdl'), 'cache')
+        if max_open_datasets is not None and max_open_datasets < 1:
+            raise ValueError('max_open_datasets must be a positive integer')
         self._cache_dir = os.path.join(cache_base_dir, name)
-        self._file_to_dataset = dict()
+        self._max_open_datasets = max_open_datasets
+        self._max_bytes = max_bytes
+        self._eviction_callbacks = [eviction_callback] if eviction_callback is not None else []
+        # Least recently used datasets first
+        self._file_to_dataset = OrderedDict()
+        self._file_to_size = dict()
+        self._num_bytes = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_evictions = 0
+        self._lock = threading.RLock()
+        self._max_unpacked_bytes = max_unpacked_bytes
+        self._unpack_executor = None
+        self._file_to_unpack_future = dict()
+        # Unpacked files marked as used by this process, see _lock_real_file()
+        self._locked_real_files = set()
+        self._time_range_index = None
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def max_open_datasets(self):
+        return self._max_open_datasets
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def stats(self):
+        """
+        A dictionary with the numbers of cache *hits*, *misses* and *evictions*, the number of currently
+        *open_datasets* and their total file size in *bytes*.
+        """
+        with self._lock:
+            return dict(hits=self._num_hits,
+                        misses=self._num_misses,
+                        evictions=self._num_evictions,
+                        open_datasets=len(self._file_to_dataset),
+                        bytes=self._num_bytes)
+
+    @property
+    def time_range_index(self):
+        """
+        The persistent **SourceTimeRangeIndex** of this cache, stored in the cache directory.
+        """
+        if self._time_range_index is None:
+            self._time_range_index = SourceTimeRangeIndex(os.path.join(self._cache_dir, 'source-time-ranges.json'))
+        return self._time_range_index
+
+    def add_eviction_callback(self, eviction_callback):
+        """
+        Add a function that is called with the file path and the dataset of each evicted dataset
+        before the dataset is closed.
+
+        :param eviction_callback: The callback function.
+        """
+        self._eviction_callbacks.append(eviction_callback)
 
     @abstractmethod
     def open_dataset(self, file):
@@ -146,18 +366,37 @@ class DatasetCache(metaclass=ABCMeta):
     def get_dataset(self, file):
         """
         Get a cached dataset for given file path. May call **open_dataset()** if dataset is not yet cached.
+        Opening a dataset may close the least recently used datasets if the cache is bounded.
         :param file: The file path.
         :return: A cached dataset
         """
-        dataset = self.get_cached_dataset(file)
+        with self._lock:
+            dataset = self._file_to_dataset.get(file, None)
+            if dataset is not None:
+                self._file_to_dataset.move_to_end(file)
+                self._num_hits += 1
+                return dataset
+            self._num_misses += 1
+        root, ext = os.path.splitext(file)
+        if ext == '.gz':
+            real_file = self._get_unpacked_file(file)
+        else:
+            real_file = file
+        dataset = self.open_dataset(real_file)
         if dataset is None:
-            root, ext = os.path.splitext(file)
-            if ext == '.gz':
-                real_file = self._get_unpacked_file(file)
-            else:
-                real_file = file
-            dataset = self.open_dataset(real_file)
+            return None
+        size = os.path.getsize(real_file) if self._max_bytes is not None else 0
+        with self._lock:
+            other_dataset = self._file_to_dataset.get(file, None)
+            if other_dataset is not None:
+                # Opened by another thread meanwhile
+                dataset.close()
+                self._file_to_dataset.move_to_end(file)
+                return other_dataset
             self._file_to_dataset[file] = dataset
+            self._file_to_size[file] = size
+            self._num_bytes += size
+            self._evict()
         return dataset
 
     def get_cached_dataset(self, file):
@@ -173,32 +412,357 @@ class DatasetCache(metaclass=ABCMeta):
         Close a dataset for the given file.
         :param file: The file path.
         """
-        dataset = self.get_cached_dataset(file)
+        with self._lock:
+            dataset = self._remove_dataset(file)
         if dataset is not None:
             dataset.close()
-            del self._file_to_dataset[file]
+            self._unlock_file(file)
 
     def close_all_datasets(self):
+        """
+        Close all datasets and stop unpacking prefetched files.
+        """
+        with self._lock:
+            unpack_executor = self._unpack_executor
+            self._unpack_executor = None
+        if unpack_executor is not None:
+            unpack_executor.shutdown(wait=True, cancel_futures=True)
+            with self._lock:
+                # Cancelled futures never complete
+                self._file_to_unpack_future.clear()
         files = list(self._file_to_dataset.keys())
         for file in files:
             self.close_dataset(file)
+        # Also release unpacked files that have never been opened
+        with self._lock:
+            real_files = list(self._locked_real_files)
+        for real_file in real_files:
+            self._unlock_real_file(real_file)
+
+    def _remove_dataset(self, file):
+        dataset = self._file_to_dataset.pop(file, None)
+        if dataset is not None:
+            self._num_bytes -= self._file_to_size.pop(file)
+        return dataset
 
-    def _get_unpacked_file(self, file):
+    def _evict(self):
+        # Never evict the most recently used dataset
+        while len(self._file_to_dataset) > 1 \
+                and ((self._max_open_datasets is not None and len(self._file_to_dataset) > self._max_open_datasets)
+                     or (self._max_bytes is not None and self._num_bytes > self._max_bytes)):
+            file = next(iter(self._file_to_dataset))
+            dataset = self._remove_dataset(file)
+            self._num_evictions += 1
+            for eviction_callback in self._eviction_callbacks:
+                eviction_callback(file, dataset)
+            dataset.close()
+            self._unlock_file(file)
+
+    def unpack_file(self, file):
+        """
+        Unpack *file* into the cache directory if it is gzip-compressed and not yet unpacked.
+
+        :param file: The file path.
+        :return: The path of the unpacked file, or *file* if it is not gzip-compressed.
+        """
+        if not file.endswith('.gz'):
+            return file
+        return self._get_unpacked_file(file)
+
+    def prefetch_unpacked_files(self, files):
+        """
+        Unpack the given gzip-compressed files in a background thread, so that they are ready when
+        their datasets are opened by **get_dataset()**. Files not ending with ``.gz`` and files already unpacked
+        or being unpacked are ignored.
+
+        :param files: The file paths.
+        """
+        with self._lock:
+            for file in files:
+                if not file.endswith('.gz') or file in self._file_to_unpack_future:
+                    continue
+                if os.path.exists(self._get_real_file(file)):
+                    continue
+                if self._unpack_executor is None:
+                    self._unpack_executor = ThreadPoolExecutor(max_workers=1)
+                self._file_to_unpack_future[file] = self._unpack_executor.submit(self._unpack_file, file)
+
+    def _get_real_file(self, file):
         root, _ = os.path.splitext(file)
-        filename = os.path.basename(root)
-        real_file = os.path.join(self._cache_dir, filename)
-        if not os.path.exists(real_file):
-            if not os.path.exists(self._cache_dir):
-                os.makedirs(self._cache_dir, exist_ok=True)
-            with gzip.open(file, 'rb') as istream:
-                with open(real_file, 'wb') as ostream:
-                    ostream.write(istream.read())
+        return os.path.join(self._cache_dir, os.path.basename(root))
+
+    def _get_unpacked_file(self, file):
+        with self._lock:
+            future = self._file_to_unpack_future.get(file)
+        if future is not None:
+            return future.result()
+        real_file = self._get_real_file(file)
+        if os.path.exists(real_file):
+            # Lock before use, other processes may remove the file until then
+            self._lock_real_file(real_file)
+            try:
+                # Mark as recently used, see _limit_unpacked_files()
+                os.utime(real_file)
+                return real_file
+            except FileNotFoundError:
+                pass
+        return self._unpack_file(file)
+
+    def _unpack_file(self, file):
+        real_file = self._get_real_file(file)
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            self._lock_real_file(real_file)
+            if not os.path.exists(real_file):
+                # Unpack to a temporary file first so that other threads and processes never see a partial file
+                temp_file = '%s.%d.%d%s' % (real_file, os.getpid(), threading.get_ident(), _UNPACK_TEMP_EXT)
+                try:
+                    with gzip.open(file, 'rb') as istream:
+                        with open(temp_file, 'wb') as ostream:
+                            shutil.copyfileobj(istream, ostream, _UNPACK_BLOCK_SIZE)
+                    os.replace(temp_file, real_file)
+                finally:
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+                if self._max_unpacked_bytes is not None:
+                    self._limit_unpacked_files(real_file)
+        finally:
+            with self._lock:
+                self._file_to_unpack_future.pop(file, None)
         return real_file
 
+    def _unlock_file(self, file):
+        if file.endswith('.gz'):
+            self._unlock_real_file(self._get_real_file(file))
+
+    def _lock_real_file(self, real_file):
+        """
+        Mark the unpacked *real_file* as used by this process by creating a lock file named after the process ID
+        and host name, so that **_limit_unpacked_files()** of other processes does not remove it.
+        """
+        with self._lock:
+            if real_file in self._locked_real_files:
+                return
+            self._locked_real_files.add(real_file)
+        open(_get_lock_file(real_file, os.getpid()), 'w').close()
+
+    def _unlock_real_file(self, real_file):
+        with self._lock:
+            if real_file not in self._locked_real_files:
+                return
+            self._locked_real_files.remove(real_file)
+        try:
+            os.remove(_get_lock_file(real_file, os.getpid()))
+        except OSError:
+            pass
+
+    def _limit_unpacked_files(self, new_real_file):
+        """
+        Remove the least recently used unpacked files until their total size is within the limit.
+        Files used by this cache or locked by a running process are kept, stale lock files are removed.
+        Whether a process is running can only be checked on this host, so files locked by processes
+        on other hosts sharing the cache directory are always kept and their lock files never removed.
+        """
+        with self._lock:
+            used_real_files = {self._get_real_file(file) for file in self._file_to_dataset.keys()
+                               if file.endswith('.gz')}
+            used_real_files.update(self._get_real_file(file) for file in self._file_to_unpack_future.keys())
+        used_real_files.add(new_real_file)
+        index_file = self.time_range_index.index_file
+        entries = []
+        num_bytes = 0
+        with os.scandir(self._cache_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if not dir_entry.is_file() or dir_entry.path.startswith(index_file) \
+                        or dir_entry.name.endswith(_UNPACK_TEMP_EXT):
+                    continue
+                if dir_entry.name.endswith(_LOCK_EXT):
+                    real_file, pid, host_name = _parse_lock_file(dir_entry.path)
+                    if host_name != _HOST_NAME or _is_process_running(pid):
+                        used_real_files.add(real_file)
+                    else:
+                        _remove_file(dir_entry.path)
+                    continue
+                stat = dir_entry.stat()
+                num_bytes += stat.st_size
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        for _, size, real_file in sorted(entries):
+            if num_bytes <= self._max_unpacked_bytes:
+                break
+            if real_file in used_real_files:
+                continue
+            try:
+                os.remove(real_file)
+            except OSError:
+                # Removed by another process or still open elsewhere
+                continue
+            num_bytes -= size
+
+
+_UNPACK_BLOCK_SIZE = 4 * 1024 * 1024
+_UNPACK_TEMP_EXT = '.unpacking'
+_LOCK_EXT = '.lock'
+
+
+# Lock files of processes on other hosts sharing the cache directory must not be taken as stale
+_HOST_NAME = socket.gethostname()
+
+
+def _get_lock_file(real_file, pid):
+    return '%s.%d@%s%s' % (real_file, pid, _HOST_NAME, _LOCK_EXT)
+
+
+def _parse_lock_file(lock_file):
+    # Host names may contain dots, but no '@'
+    real_file_and_pid, host_name = lock_file[:-len(_LOCK_EXT)].rsplit('@', 1)
+    real_file, pid = real_file_and_pid.rsplit('.', 1)
+    return real_file, int(pid), host_name
+
+
+def _is_process_running(pid):
+    if os.name == 'nt':
+        # No cheap check on Windows, keep the locked files
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, but owned by another user
+        pass
+    return True
+
+
+def _remove_file(file):
+    try:
+        os.remove(file)
+    except OSError:
+        pass
+
+
+class SourceTimeRangeIndex:
+    """
+    A persistent index of the time ranges of the images contained in source files.
+
+    The entries are stored in the JSON file *index_file* and are keyed by the source file's path.
+    An entry is only reused as long as the size and modification time of its file are unchanged,
+    otherwise the file's time ranges are read again.
+
+    :param index_file: The path of the JSON file the index is stored in.
+    """
+
+    def __init__(self, index_file):
+        self._index_file = index_file
+        self._entries = None
+        self._modified_entries = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def index_file(self):
+        return self._index_file
+
+    def get_time_ranges(self, file, read_time_ranges):
+        """
+        Get the time ranges of the images in *file*. *read_time_ranges* is only called if the index has no valid
+        entry for *file*. May be called from multiple threads.
+
+        :param file: The source file path.
+        :param read_time_ranges: A function that receives *file* and returns a sequence of
+               (start_time, end_time, time_index) tuples.
+        :return: A list of (start_time, end_time, time_index) tuples.
+        """
+        key = os.path.abspath(file)
+        stat = os.stat(file)
+        entry = self._get_valid_entry(key, stat)
+        if entry is not None:
+            return [(datetime.strptime(t1, _TIME_FORMAT), datetime.strptime(t2, _TIME_FORMAT), time_index)
+                    for t1, t2, time_index in entry['ranges']]
+        time_ranges = [(_to_datetime(t1), _to_datetime(t2), None if time_index is None else int(time_index))
+                       for t1, t2, time_index in read_time_ranges(file)]
+        entry = dict(size=stat.st_size,
+                     mtime=stat.st_mtime_ns,
+                     ranges=[[t1.strftime(_TIME_FORMAT), t2.strftime(_TIME_FORMAT), time_index]
+                             for t1, t2, time_index in time_ranges])
+        with self._lock:
+            self._entries[key] = entry
+            self._modified_entries[key] = entry
+        return time_ranges
+
+    def contains(self, file):
+        """
+        Test whether the index has a valid entry for *file*, that is, whether :py:meth:`get_time_ranges`
+        can return the time ranges of *file* without reading it.
+
+        :param file: The source file path.
+        :return: ``True`` if *file* is indexed and has not changed since.
+        """
+        return self._get_valid_entry(os.path.abspath(file), os.stat(file)) is not None
+
+    def _get_valid_entry(self, key, stat):
+        with self._lock:
+            entry = self._get_entries().get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry
+        return None
+
+    def save(self):
+        """
+        Write new and changed entries to the index file. Entries written meanwhile by other processes are kept.
+        """
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self._modified_entries:
+            return
+        entries = self._read_entries()
+        entries.update(self._modified_entries)
+        dir_path = os.path.dirname(self._index_file)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        # Write to a temporary file first so that readers never see a partially written index
+        temp_file = '%s.%d.tmp' % (self._index_file, os.getpid())
+        with open(temp_file, 'w') as fp:
+            json.dump(dict(version=_INDEX_VERSION, files=entries), fp)
+        os.replace(temp_file, self._index_file)
+        self._entries = entries
+        self._modified_entries = dict()
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = self._read_entries()
+        return self._entries
+
+    def _read_entries(self):
+        if not os.path.exists(self._index_file):
+            return dict()
+        try:
+            with open(self._index_file) as fp:
+                index = json.load(fp)
+        except ValueError:
+            print('Warning: ignoring invalid source time range index \'%s\'' % self._index_file)
+            return dict()
+        if index.get('version') != _INDEX_VERSION:
+            return dict()
+        return index.get('files', dict())
+
+
+_INDEX_VERSION = 1
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _to_datetime(time):
+    # Also accepts the cftime date-time objects returned by netCDF4.num2date()
+    return datetime(time.year, time.month, time.day, time.hour, time.minute, time.second, time.microsecond)
+
 
 class NetCDFDatasetCache(DatasetCache):
-    def __init__(self, name, cache_base_dir=None):
-        super(NetCDFDatasetCache, self).__init__(name, cache_base_dir=cache_base_dir)
+    def __init__(self, name, cache_base_dir=None, max_open_datasets=None, max_bytes=None, eviction_callback=None,
+                 max_unpacked_bytes=None):
+        super(NetCDFDatasetCache, self).__init__(name, cache_base_dir=cache_base_dir,
+                                                 max_open_datasets=max_open_datasets, max_bytes=max_bytes,
+                                                 eviction_callback=eviction_callback,
+                                                 max_unpacked_bytes=max_unpacked_bytes)
 
     def open_dataset(self, real_file):
         if os.path.isfile(real_file):
@@ -32,7 +32,7 @@ requirements = [
     'netCDF4',
     'numpy',
     'xarray',
-    'zarr',
+    'zarr>=2.11',
 ]
 
 on_rtd = os.environ.get('READTHEDOCS') == 'True'
@@ -1,9 +1,16 @@
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 from datetime import datetime
+
+import netCDF4
+import numpy as np
+
 from esdl import CubeConfig
 from esdl.providers.water_mask import WaterMaskProvider
-from esdl.util import Config
+from esdl.util import Config, NETCDF_LOCK
 
 SOURCE_DIR = Config.instance().get_cube_source_path('WaterBodies4.0')
 
@@ -52,3 +59,105 @@ class WaterMaskProviderTest(unittest.TestCase):
         self.assertTrue('water_mask' in images)
         image = images['water_mask']
         self.assertEqual((720, 1440), image.shape)
+
+    def test_get_dataset_image(self):
+        dir_path = tempfile.mkdtemp()
+        try:
+            data = np.ma.masked_array(np.random.randint(1, 3, size=(24, 48)), mask=np.random.random((24, 48)) < 0.3)
+            # A target pixel without valid source pixels
+            data[0:6, 0:6] = np.ma.masked
+            dataset = netCDF4.Dataset(os.path.join(dir_path, 'water_bodies.nc'), 'w')
+            dataset.createDimension('lat', 24)
+            dataset.createDimension('lon', 48)
+            dataset.createVariable('wb_class', 'u1', ('lat', 'lon'), fill_value=0)[:, :] = data
+            dataset.close()
+
+            provider = WaterMaskProvider(CubeConfig(grid_width=8, grid_height=4, spatial_res=45), dir=dir_path)
+            provider.band_height = 3
+            dataset = provider.open_dataset()
+            try:
+                image = provider.get_dataset_image(dataset, 'wb_class')
+            finally:
+                provider.close_dataset(dataset)
+
+            expected = data.reshape((4, 6, 8, 6)).mean(axis=(1, 3))
+            self.assertEqual((4, 8), image.shape)
+            self.assertTrue(np.isnan(image[0, 0]))
+            np.testing.assert_almost_equal(image.ravel()[1:], expected.ravel()[1:])
+        finally:
+            shutil.rmtree(dir_path)
+
+    def test_compute_variable_images_locks_reads_only(self):
+        dir_path = tempfile.mkdtemp()
+        try:
+            dataset = netCDF4.Dataset(os.path.join(dir_path, 'water_bodies.nc'), 'w')
+            dataset.createDimension('lat', 24)
+            dataset.createDimension('lon', 48)
+            dataset.createVariable('wb_class', 'u1', ('lat', 'lon'), fill_value=0)[:, :] = 1
+            dataset.close()
+
+            provider = LockTracingWaterMaskProvider(CubeConfig(grid_width=8, grid_height=4, spatial_res=45),
+                                                    dir=dir_path)
+            provider.band_height = 2
+            provider.prepare()
+            images = provider.compute_variable_images(datetime(2001, 1, 1), datetime(2001, 1, 9))
+            np.testing.assert_almost_equal(images['water_mask'], 1.0)
+            # Both bands are read holding the lock, which is free while the source image is reduced
+            self.assertEqual([True, True], provider.reads_locked)
+            self.assertFalse(provider.transform_locked)
+        finally:
+            shutil.rmtree(dir_path)
+
+
+def _is_netcdf_lock_held():
+    # NETCDF_LOCK is reentrant, so it must be tried from another thread
+    acquired = []
+
+    def try_acquire():
+        acquired.append(NETCDF_LOCK.acquire(blocking=False))
+        if acquired[0]:
+            NETCDF_LOCK.release()
+
+    thread = threading.Thread(target=try_acquire)
+    thread.start()
+    thread.join()
+    return not acquired[0]
+
+
+class LockTracingVariable:
+    def __init__(self, variable, reads_locked):
+        self.variable = variable
+        self.reads_locked = reads_locked
+
+    @property
+    def shape(self):
+        return self.variable.shape
+
+    def __getitem__(self, key):
+        self.reads_locked.append(_is_netcdf_lock_held())
+        return self.variable[key]
+
+
+class LockTracingDataset:
+    def __init__(self, dataset, reads_locked):
+        self.dataset = dataset
+        self.filepath = dataset.filepath
+        self.variables = {name: LockTracingVariable(variable, reads_locked)
+                          for name, variable in dataset.variables.items()}
+
+    def close(self):
+        self.dataset.close()
+
+
+class LockTracingWaterMaskProvider(WaterMaskProvider):
+    def __init__(self, cube_config, dir):
+        super(LockTracingWaterMaskProvider, self).__init__(cube_config, dir=dir)
+        self.reads_locked = []
+        self.transform_locked = None
+
+    def open_dataset(self):
+        return LockTracingDataset(super(LockTracingWaterMaskProvider, self).open_dataset(), self.reads_locked)
+
+    def transform_source_image(self, source_image):
+        self.transform_locked = _is_netcdf_lock_held()
+        return source_image
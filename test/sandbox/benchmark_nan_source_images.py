@@ -0,0 +1,103 @@
+"""
+Compares computing 8-daily images from daily source images read as masked arrays with reading them as plain
+arrays with NaN for missing values (nan_source_images), for float32 sources and for int16 sources packed with
+scale_factor, with and without missing values. Prints the time and the peak traced memory of both modes.
+
+Usage: python benchmark_nan_source_images.py [NUM_PERIODS]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import netCDF4
+import numpy as np
+
+from esdl import CubeConfig
+from esdl.cube_provider import NetCDFCubeSourceProvider
+
+PERIOD_DAYS = 8
+
+
+class SyntheticProvider(NetCDFCubeSourceProvider):
+    """A provider for the synthetic source, a single file of daily 720 x 1440 images."""
+
+    image_prefetch_depth = 0
+
+    def __init__(self, cube_config, file, num_days):
+        super(SyntheticProvider, self).__init__(cube_config, 'benchmark_nan_source_images', os.path.dirname(file),
+                                                None)
+        self.file = file
+        self.num_days = num_days
+
+    @property
+    def variable_descriptors(self):
+        return {'var': {'data_type': np.float32, 'fill_value': np.nan}}
+
+    def compute_source_time_ranges(self):
+        return [(datetime(2001, 1, 1) + timedelta(days=i), datetime(2001, 1, 2) + timedelta(days=i), self.file, i)
+                for i in range(self.num_days)]
+
+
+def write_source(file, num_days, packed, missing_fraction):
+    dataset = netCDF4.Dataset(file, 'w')
+    dataset.createDimension('time', num_days)
+    dataset.createDimension('lat', 720)
+    dataset.createDimension('lon', 1440)
+    if packed:
+        variable = dataset.createVariable('var', 'i2', ('time', 'lat', 'lon'), fill_value=-32768,
+                                          chunksizes=(1, 720, 1440))
+        variable.scale_factor = 0.001
+        variable.add_offset = 0.0
+    else:
+        variable = dataset.createVariable('var', 'f4', ('time', 'lat', 'lon'), fill_value=-999.0,
+                                          chunksizes=(1, 720, 1440))
+    for i in range(num_days):
+        values = np.random.random((720, 1440))
+        variable[i, :, :] = np.ma.masked_array(10 * values, mask=values < missing_fraction)
+    dataset.close()
+
+
+def run(file, num_periods, nan_source_images):
+    provider = SyntheticProvider(CubeConfig(), file, num_periods * PERIOD_DAYS)
+    provider.nan_source_images = nan_source_images
+    provider.prepare()
+    periods = [(datetime(2001, 1, 1) + timedelta(days=PERIOD_DAYS * i),
+                datetime(2001, 1, 1) + timedelta(days=PERIOD_DAYS * (i + 1))) for i in range(num_periods)]
+    t1 = time.perf_counter()
+    for period_start, period_end in periods:
+        provider.compute_variable_images(period_start, period_end)
+    t2 = time.perf_counter()
+    tracemalloc.start()
+    provider.compute_variable_images(*periods[0])
+    _, peak_size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    provider.close()
+    shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+    return t2 - t1, peak_size / 2 ** 20
+
+
+def main(num_periods):
+    dir_path = tempfile.mkdtemp()
+    try:
+        file = os.path.join(dir_path, 'synthetic.nc')
+        results = []
+        for packed in (False, True):
+            for missing_fraction in (0.0, 0.3):
+                write_source(file, num_periods * PERIOD_DAYS, packed, missing_fraction)
+                masked = run(file, num_periods, False)
+                nan = run(file, num_periods, True)
+                results.append(('int16 packed' if packed else 'float32', missing_fraction) + masked + nan)
+                os.remove(file)
+        for result in results:
+            print('%s, %d%% missing: masked %.2f seconds, %.0f MiB; NaN %.2f seconds, %.0f MiB' %
+                  ((result[0], 100 * result[1]) + result[2:]))
+    finally:
+        shutil.rmtree(dir_path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
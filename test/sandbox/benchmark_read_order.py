@@ -0,0 +1,140 @@
+"""
+Compares reading the source images of a multi-variable NetCDF source variable-major (all source indexes for
+one variable, then the next variable) with the file-major order used by NetCDFCubeSourceProvider (all variables
+for one file and time index, then the next), and with file-major hyperslab reads of consecutive time indexes.
+
+Usage: python benchmark_read_order.py [NUM_FILES [OPEN_LATENCY]]
+
+OPEN_LATENCY is an extra delay in seconds added to each dataset open, to mimic a high-latency file system
+such as Lustre. On a local disk the read times of both orders are dominated by decompression and are equal,
+the difference is the number of datasets opened when open handles are limited.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import netCDF4
+import numpy as np
+
+from esdl import CubeConfig
+from esdl.cube_provider import NetCDFCubeSourceProvider
+
+VAR_NAMES = ['AOD550_mean', 'AOD555_mean', 'AOD659_mean', 'AOD865_mean', 'AOD1610_mean']
+STEPS_PER_FILE = 8
+PERIOD_STEPS = 8
+# Number of time steps per HDF5 chunk, as in sources chunked along time
+TIME_CHUNK_SIZE = 8
+# Per-variable HDF5 chunk cache, smaller than a chunk as with older netCDF-C versions, so that chunks
+# are decompressed for every time index read from them unless read as a hyperslab
+CHUNK_CACHE_SIZE = 4 * 1024 * 1024
+
+
+class SyntheticProvider(NetCDFCubeSourceProvider):
+    """A provider for the synthetic source, one file per 8 days with 5 variables."""
+
+    image_prefetch_depth = 0
+    unpack_prefetch_count = 0
+
+    def __init__(self, cube_config, dir_path, open_latency=0.0):
+        super(SyntheticProvider, self).__init__(cube_config, 'benchmark_read_order', dir_path, None)
+        open_dataset = self.dataset_cache.open_dataset
+
+        def open_dataset_with_latency(file):
+            time.sleep(open_latency)
+            return open_dataset(file)
+
+        self.dataset_cache.open_dataset = open_dataset_with_latency
+
+    @property
+    def variable_descriptors(self):
+        return {var_name: {'data_type': np.float32, 'fill_value': np.nan} for var_name in VAR_NAMES}
+
+    def compute_source_time_ranges(self):
+        source_time_ranges = []
+        for file_name in sorted(os.listdir(self.dir_path)):
+            file = os.path.join(self.dir_path, file_name)
+            start_time = datetime.strptime(file_name[0:8], '%Y%m%d')
+            for i in range(STEPS_PER_FILE):
+                t1 = start_time + timedelta(days=i)
+                source_time_ranges.append((t1, t1 + timedelta(days=1), file, i))
+        return source_time_ranges
+
+
+def write_source(dir_path, num_files):
+    for file_index in range(num_files):
+        start_time = datetime(2001, 1, 1) + timedelta(days=file_index * STEPS_PER_FILE)
+        dataset = netCDF4.Dataset(os.path.join(dir_path, start_time.strftime('%Y%m%d') + '-synthetic.nc'), 'w')
+        dataset.createDimension('time', STEPS_PER_FILE)
+        dataset.createDimension('lat', 720)
+        dataset.createDimension('lon', 1440)
+        for var_index, var_name in enumerate(VAR_NAMES):
+            variable = dataset.createVariable(var_name, 'f4', ('time', 'lat', 'lon'), zlib=True,
+                                              chunksizes=(TIME_CHUNK_SIZE, 720, 1440), fill_value=-999.0)
+            for i in range(STEPS_PER_FILE):
+                variable[i, :, :] = np.random.random((720, 1440)).astype(np.float32) + var_index
+        dataset.close()
+
+
+def read_variable_major(provider, periods):
+    for indices in periods:
+        provider.close_unused_open_files(dict.fromkeys(indices, 1.0))
+        for var_name in VAR_NAMES:
+            for i in indices:
+                file, time_index = provider._get_file_and_time_index(i)
+                provider.dataset_cache.get_dataset(file).variables[var_name][time_index, :, :]
+    provider.dataset_cache.close_all_datasets()
+
+
+def read_file_major(provider, periods):
+    for indices in periods:
+        provider.close_unused_open_files(dict.fromkeys(indices, 1.0))
+        for i in indices:
+            provider._read_source_images([i], VAR_NAMES)
+    provider.dataset_cache.close_all_datasets()
+
+
+def read_file_major_hyperslabs(provider, periods):
+    for indices in periods:
+        provider.close_unused_open_files(dict.fromkeys(indices, 1.0))
+        for index_run in provider._get_index_runs(indices):
+            provider._read_source_images(index_run, VAR_NAMES)
+    provider.dataset_cache.close_all_datasets()
+
+
+def main(num_files, open_latency):
+    netCDF4.set_chunk_cache(CHUNK_CACHE_SIZE)
+    dir_path = tempfile.mkdtemp()
+    try:
+        print('writing %d synthetic source files with %d variables...' % (num_files, len(VAR_NAMES)))
+        write_source(dir_path, num_files)
+        # With a single open dataset, as when many providers share the process' file handles
+        for max_open_datasets in (SyntheticProvider.max_open_datasets, 1):
+            SyntheticProvider.max_open_datasets = max_open_datasets
+            provider = SyntheticProvider(CubeConfig(), dir_path, open_latency=open_latency)
+            provider.prepare()
+            num_indices = len(provider.source_time_ranges)
+            # Periods are shifted by half a file, so that each of them reads from two files
+            periods = [list(range(i, min(i + PERIOD_STEPS, num_indices)))
+                       for i in range(PERIOD_STEPS // 2, num_indices, PERIOD_STEPS)]
+            print('max_open_datasets=%d:' % max_open_datasets)
+            for name, read in (('variable-major', read_variable_major),
+                               ('file-major', read_file_major),
+                               ('file-major hyperslabs', read_file_major_hyperslabs)):
+                misses = provider.dataset_cache.stats['misses']
+                t1 = time.perf_counter()
+                read(provider, periods)
+                t2 = time.perf_counter()
+                print('  %s: %.3f seconds, %d dataset(s) opened' % (name, t2 - t1,
+                                                                    provider.dataset_cache.stats['misses'] - misses))
+            provider.close()
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(dir_path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 6,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
@@ -0,0 +1,67 @@
+"""
+Compares the resampling orders of NetCDFCubeSourceProvider for a target period of several source images:
+'time_first' (temporal mean at source resolution, then spatial resampling), 'space_first' (spatial resampling of
+every source image, then temporal mean) and 'fused' (both in one pass by esdl.resampling.ResamplingAccumulator).
+
+Usage: python benchmark_resampling_order.py [NUM_IMAGES [SOURCE_RES [INVALID_FRACTION]]]
+"""
+import sys
+import time
+
+import gridtools.resampling as gtr
+import numpy as np
+
+from esdl.resampling import ResamplingAccumulator, resample_2d
+from esdl.util import ImageAccumulator
+
+TARGET_WIDTH = 1440
+TARGET_HEIGHT = 720
+
+
+def time_first(images, weights):
+    accumulator = ImageAccumulator()
+    for image, weight in zip(images, weights):
+        accumulator.add(image, weight)
+    return resample_2d(accumulator.get_image(), TARGET_WIDTH, TARGET_HEIGHT,
+                       ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST, fill_value=np.nan)
+
+
+def space_first(images, weights):
+    accumulator = ImageAccumulator()
+    for image, weight in zip(images, weights):
+        accumulator.add(resample_2d(image, TARGET_WIDTH, TARGET_HEIGHT,
+                                    ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST, fill_value=np.nan), weight)
+    return accumulator.get_image()
+
+
+def fused(images, weights):
+    accumulator = ResamplingAccumulator(TARGET_WIDTH, TARGET_HEIGHT, ds_method=gtr.DS_MEAN,
+                                        us_method=gtr.US_NEAREST, fill_value=np.nan)
+    for image, weight in zip(images, weights):
+        accumulator.add(image, weight)
+    return accumulator.get_image()
+
+
+def main(num_images, source_res, invalid_fraction):
+    width, height = int(round(360 / source_res)), int(round(180 / source_res))
+    print('%d source images of %dx%d pixels, %d%% invalid, to %dx%d pixels' % (
+        num_images, width, height, 100 * invalid_fraction, TARGET_WIDTH, TARGET_HEIGHT))
+    images = []
+    for _ in range(num_images):
+        data = np.random.random((height, width)).astype(np.float32)
+        images.append(np.ma.masked_array(data, mask=np.random.random((height, width)) < invalid_fraction))
+    weights = [1.0] * num_images
+    weights[0] = weights[-1] = 0.5
+    for name, aggregate in (('time_first', time_first), ('space_first', space_first), ('fused', fused)):
+        # Compile kernels and compute resampling plans first
+        aggregate(images[0:2], weights[0:2])
+        t1 = time.perf_counter()
+        aggregate(images, weights)
+        t2 = time.perf_counter()
+        print('  %s: %.3f seconds' % (name, t2 - t1))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.05,
+         float(sys.argv[3]) if len(sys.argv) > 3 else 0.3)
@@ -0,0 +1,102 @@
+"""
+Measures NetCDFCubeSourceProvider.scan_source_time_ranges() on a synthetic multi-file source, gzip-compressed
+and plain, read in the calling process and by a pool of SCAN_WORKERS processes.
+
+Usage: python benchmark_source_scan.py [NUM_FILES [SCAN_WORKERS [OPEN_LATENCY]]]
+
+OPEN_LATENCY is an extra delay in seconds added to each header read, to mimic a high-latency file system
+such as Lustre. Within a process the header reads are serialized by NETCDF_LOCK, only the processes of the
+pool wait for their files concurrently. Starting the pool takes about a second, which the scan must make up for.
+"""
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import netCDF4
+import numpy as np
+
+from esdl import CubeConfig
+from esdl.cube_provider import NetCDFCubeSourceProvider
+
+STEPS_PER_FILE = 8
+OPEN_LATENCY = 0.0
+
+
+class SyntheticProvider(NetCDFCubeSourceProvider):
+    """A provider for the synthetic source, one file per 8 days."""
+
+    def __init__(self, cube_config, dir_path, open_latency):
+        super(SyntheticProvider, self).__init__(cube_config, 'benchmark_source_scan', dir_path, None)
+        self.open_latency = open_latency
+
+    @property
+    def variable_descriptors(self):
+        return {'var': {'data_type': np.float32, 'fill_value': np.nan}}
+
+    def compute_source_time_ranges(self):
+        return self.scan_source_time_ranges(os.path.join(self.dir_path, file_name)
+                                            for file_name in sorted(os.listdir(self.dir_path)))
+
+    def read_file_time_ranges(self, file):
+        time.sleep(self.open_latency)
+        dataset = self.dataset_cache.get_dataset(file)
+        start_time = datetime.strptime(dataset.time_coverage_start, '%Y%m%d')
+        self.dataset_cache.close_dataset(file)
+        return [(start_time + timedelta(days=i), start_time + timedelta(days=i + 1), i) for i in range(STEPS_PER_FILE)]
+
+
+def write_source(dir_path, num_files, compress):
+    for file_index in range(num_files):
+        start_time = datetime(2001, 1, 1) + timedelta(days=file_index * STEPS_PER_FILE)
+        file = os.path.join(dir_path, start_time.strftime('%Y%m%d') + '-synthetic.nc')
+        dataset = netCDF4.Dataset(file, 'w')
+        dataset.time_coverage_start = start_time.strftime('%Y%m%d')
+        dataset.createDimension('time', STEPS_PER_FILE)
+        dataset.createDimension('lat', 360)
+        dataset.createDimension('lon', 720)
+        variable = dataset.createVariable('var', 'f4', ('time', 'lat', 'lon'))
+        variable[:, :, :] = np.random.random((STEPS_PER_FILE, 360, 720)).astype(np.float32)
+        dataset.close()
+        if compress:
+            with open(file, 'rb') as src, gzip.open(file + '.gz', 'wb', compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(file)
+
+
+def scan(dir_path, scan_workers, open_latency):
+    SyntheticProvider.source_scan_workers = scan_workers
+    provider = SyntheticProvider(CubeConfig(), dir_path, open_latency)
+    # Start from an empty source time range index and unpacked file cache
+    shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+    provider = SyntheticProvider(CubeConfig(), dir_path, open_latency)
+    t1 = time.perf_counter()
+    provider.prepare()
+    num_ranges = len(provider.source_time_ranges)
+    t2 = time.perf_counter()
+    provider.close()
+    shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+    return t2 - t1, num_ranges
+
+
+def main(num_files, scan_workers, open_latency):
+    print('%d CPU(s), %.3f seconds open latency' % (os.cpu_count(), open_latency))
+    for compress in (True, False):
+        dir_path = tempfile.mkdtemp()
+        try:
+            write_source(dir_path, num_files, compress)
+            print('%d %s source files:' % (num_files, 'gzip-compressed' if compress else 'plain'))
+            for workers in (1, scan_workers):
+                seconds, num_ranges = scan(dir_path, workers, open_latency)
+                print('  %d process(es): %.3f seconds, %d source time ranges' % (workers, seconds, num_ranges))
+        finally:
+            shutil.rmtree(dir_path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 48,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+         float(sys.argv[3]) if len(sys.argv) > 3 else OPEN_LATENCY)
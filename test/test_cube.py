@@ -1,9 +1,16 @@
+import contextlib
+import io
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import tracemalloc
 import unittest
 from builtins import IOError
 
 import shutil
 from datetime import datetime
+from unittest.mock import patch
 from unittest import TestCase
 import zarr
 import numpy as np
@@ -13,6 +20,9 @@ from esdl.cube_provider import CubeSourceProvider
 
 CUBE_DIR = 'testcube'
 
+SMALL_CUBE_CONFIG = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18,
+                               start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+
 
 class CubeTest(TestCase):
     def setUp(self):
@@ -137,6 +147,292 @@ class CubeTest(TestCase):
 #         self.assertEqual(result[0].values, np.array(0.13, dtype=np.float32))
 #         self.assertEqual(result[1].values, np.array(0.615, dtype=np.float32))
 
+    def test_update_with_workers(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        provider = PeriodSourceProviderMock(cube.config)
+        cube.update(provider, workers=2)
+
+        lai = zarr.open_group(CUBE_DIR)['LAI']
+        self.assertEqual((46, 18, 36), lai.shape)
+        for time_index in range(46):
+            self.assertTrue(np.all(lai[time_index] == 1 + 8 * time_index))
+
+    def test_update_with_workers_keeps_options_and_closes_providers(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        closed_dir = tempfile.mkdtemp()
+        try:
+            provider = WorkerSourceProviderMock(cube.config, closed_dir)
+            # Options set after construction are passed to the workers
+            provider.offset = 1000
+            cube.update(provider, workers=2)
+
+            lai = zarr.open_group(CUBE_DIR)['LAI']
+            for time_index in range(46):
+                self.assertTrue(np.all(lai[time_index] == 1001 + 8 * time_index))
+            # The providers of the workers and the update's own provider have been closed
+            pids = set(os.listdir(closed_dir))
+            self.assertIn(str(os.getpid()), pids)
+            self.assertGreaterEqual(len(pids), 2)
+        finally:
+            shutil.rmtree(closed_dir)
+
+    def test_update_many_shares_workers(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        providers = [PeriodSourceProviderMock(cube.config, var_name=var_name) for var_name in ['LAI', 'FAPAR']]
+        with patch('esdl.cube.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as executor_class:
+            cube.update_many(providers, workers=2)
+        # A single pool of two workers computes the images of both providers
+        self.assertEqual(1, executor_class.call_count)
+        self.assertEqual(2, executor_class.call_args[1]['max_workers'])
+
+        group = zarr.open_group(CUBE_DIR)
+        for var_name in ['LAI', 'FAPAR']:
+            for time_index in range(46):
+                self.assertTrue(np.all(group[var_name][time_index] == 1 + 8 * time_index))
+
+    def test_update_writes_chunk_aligned_batches(self):
+        config = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18, chunk_sizes=(10, 9, 18),
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        batches = []
+        write_images = cube._write_images
+
+        def trace_write_images(datasets, block, *args):
+            batches.append(block.ranges['LAI'])
+            return write_images(datasets, block, *args)
+
+        cube._write_images = trace_write_images
+        cube.update(PeriodSourceProviderMock(cube.config), image_cache_size=50)
+        self.assertEqual([(0, 20), (20, 40), (40, 46)], batches)
+
+        lai = zarr.open_group(CUBE_DIR)['LAI']
+        for time_index in range(46):
+            self.assertTrue(np.all(lai[time_index] == 1 + 8 * time_index))
+
+    def test_update_writes_whole_chunks_with_small_image_cache(self):
+        config = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18, chunk_sizes=(46, 18, 36),
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2003, 1, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        batches = []
+        write_images = cube._write_images
+
+        def trace_write_images(datasets, block, *args):
+            batches.append(block.ranges['LAI'])
+            return write_images(datasets, block, *args)
+
+        cube._write_images = trace_write_images
+        output = io.StringIO()
+        with self.assertWarns(UserWarning), contextlib.redirect_stdout(output):
+            cube.update(PeriodSourceProviderMock(cube.config))
+        # The default image cache is too small for a time chunk, the blocks are enlarged instead
+        self.assertEqual([(0, 46), (46, 92)], batches)
+        self.assertIn('Wrote 2 chunk(s), 0 of them partially; '
+                      'writing every 12 time step(s) would have written 9 chunk(s), 9 of them partially',
+                      output.getvalue())
+
+    def test_update_memory(self):
+        config = CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180, chunk_sizes=(1, 90, 180),
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        var_names = ['LAI', 'FAPAR', 'GPP']
+        image_size = 180 * 360 * 4
+        tracemalloc.start()
+        try:
+            cube.update_many([PeriodSourceProviderMock(cube.config, var_name=var_name) for var_name in var_names],
+                             image_cache_size=12)
+            _, peak_size = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # Previously, 12 time steps of every variable were collected and then stacked variable by variable,
+        # now the image blocks hold 12 time steps of every variable, plus the images being computed
+        self.assertLess(peak_size, (12 + 2) * len(var_names) * image_size)
+        self.assertGreater(peak_size, 12 * len(var_names) * image_size)
+
+    def test_update_resumes_after_failure(self):
+        config = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18, chunk_sizes=(10, 18, 36),
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        # Time index 25 starts at day 201
+        provider = PeriodSourceProviderMock(cube.config, fail_at=datetime(2001, 7, 20))
+        with self.assertRaises(IOError):
+            cube.update(provider, image_cache_size=10)
+        self.assertEqual(25, len(provider.trace))
+        # The consolidated metadata already contain the new variable
+        self.assertIn('LAI', zarr.open_consolidated(CUBE_DIR).array_keys())
+        self.assertEqual((46, 18, 36), Cube.open(CUBE_DIR).data['LAI'].shape)
+
+        provider = PeriodSourceProviderMock(cube.config)
+        cube.update(provider, image_cache_size=10, resume=True)
+        self.assertEqual(26, len(provider.trace))
+        self.assertEqual(datetime(2001, 6, 10), provider.trace[0])
+
+        lai = zarr.open_group(CUBE_DIR)['LAI']
+        for time_index in range(46):
+            self.assertTrue(np.all(lai[time_index] == 1 + 8 * time_index))
+
+        provider = PeriodSourceProviderMock(cube.config)
+        cube.update(provider, resume=True)
+        self.assertEqual([], provider.trace)
+        # Without resume, e.g. after the source data has been refreshed, all time steps are written again
+        cube.update(provider)
+        self.assertEqual(46, len(provider.trace))
+
+    def test_update_many(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        lai_provider = PeriodSourceProviderMock(cube.config)
+        fapar_provider = PeriodSourceProviderMock(cube.config, var_name='FAPAR', end_time=datetime(2001, 3, 1))
+        cube.update_many([lai_provider, fapar_provider])
+        self.assertEqual(46, len(lai_provider.trace))
+        self.assertEqual(8, len(fapar_provider.trace))
+
+        g = zarr.open_group(CUBE_DIR)
+        lai = g['LAI'][:]
+        fapar = g['FAPAR'][:]
+        for time_index in range(46):
+            self.assertTrue(np.all(lai[time_index] == 1 + 8 * time_index))
+        for time_index in range(8):
+            self.assertTrue(np.all(fapar[time_index] == 1 + 8 * time_index))
+        self.assertTrue(np.all(np.isnan(fapar[8:])))
+
+        with self.assertRaises(ValueError):
+            cube.update_many([PeriodSourceProviderMock(cube.config), PeriodSourceProviderMock(cube.config)])
+
+    def test_update_with_write_workers(self):
+        config = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18, chunk_sizes=(4, 5, 10),
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        cube.update_many([PeriodSourceProviderMock(cube.config),
+                          PeriodSourceProviderMock(cube.config, var_name='FAPAR')],
+                         image_cache_size=10, write_workers=4)
+
+        g = zarr.open_group(CUBE_DIR)
+        for var_name in ('LAI', 'FAPAR'):
+            values = g[var_name][:]
+            for time_index in range(46):
+                self.assertTrue(np.all(values[time_index] == 1 + 8 * time_index))
+
+    def test_update_skips_fill_chunks(self):
+        config = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18, chunk_sizes=(4, 9, 18),
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        fill_chunk_stats = []
+        write_images = cube._write_images
+
+        def trace_write_images(*args):
+            result = write_images(*args)
+            fill_chunk_stats.append(result)
+            return result
+
+        cube._write_images = trace_write_images
+        cube.update(FillingSourceProviderMock(cube.config, fill_from=datetime(2001, 3, 1)), image_cache_size=46)
+        # 8 periods with data, written to 2 time chunks of 4 spatial chunks each,
+        # the 40 chunks of the remaining 10 time chunks contain fill values only
+        self.assertEqual(40, sum(num_chunks for num_chunks, _ in fill_chunk_stats))
+        self.assertEqual(38 * 18 * 36 * 4, sum(num_bytes for _, num_bytes in fill_chunk_stats))
+        chunk_files = [name for name in os.listdir(os.path.join(CUBE_DIR, 'LAI')) if not name.startswith('.')]
+        self.assertEqual(8, len(chunk_files))
+
+        # Overwriting with fill values removes the chunk
+        g = zarr.open_group(CUBE_DIR)
+        lai = zarr.Array(g.store, path='LAI', write_empty_chunks=False)
+        lai[0:4] = np.nan
+        chunk_files = [name for name in os.listdir(os.path.join(CUBE_DIR, 'LAI')) if not name.startswith('.')]
+        self.assertEqual(4, len(chunk_files))
+        self.assertTrue(np.all(np.isnan(g['LAI'][0:4])))
+
+        regions = Cube._get_chunk_regions(lai, 2, 10)
+        self.assertEqual(3 * 4, len(regions))
+        self.assertEqual((slice(2, 4), slice(0, 9), slice(0, 18)), regions[0])
+        self.assertEqual((slice(8, 10), slice(9, 18), slice(18, 36)), regions[-1])
+        self.assertFalse(Cube._is_whole_chunk(lai, *regions[0]))
+        self.assertTrue(Cube._is_whole_chunk(lai, *regions[4]))
+        self.assertTrue(Cube._is_fill(np.full((2, 2), np.nan), np.nan))
+        self.assertFalse(Cube._is_fill(np.array([np.nan, 1.0]), np.nan))
+        self.assertTrue(Cube._is_fill(np.zeros((2, 2)), 0))
+
+    def test_consolidated_metadata(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        self.assertTrue(os.path.exists(CUBE_DIR + '/.zmetadata'))
+        self.assertIn('cube.config', zarr.open_consolidated(CUBE_DIR).attrs)
+
+        cube.update(PeriodSourceProviderMock(cube.config))
+        self.assertIn('LAI', zarr.open_consolidated(CUBE_DIR).array_keys())
+
+        cube = Cube.open(CUBE_DIR)
+        self.assertEqual(36, cube.config.grid_width)
+        self.assertEqual((46, 18, 36), cube.data['LAI'].shape)
+
+        # Cubes without consolidated metadata can still be opened
+        os.remove(CUBE_DIR + '/.zmetadata')
+        cube = Cube.open(CUBE_DIR)
+        self.assertEqual((46, 18, 36), cube.data['LAI'].shape)
+
+    def test_create_time_axis(self):
+        # The time axis ends with the last whole year before the end time
+        config = CubeConfig(spatial_res=1.0, grid_width=36, grid_height=18,
+                            start_time=datetime(2001, 1, 1), end_time=datetime(2002, 6, 1))
+        cube = Cube.create(CUBE_DIR, config)
+        self.assertEqual((46,), zarr.open_group(CUBE_DIR)['time'].shape)
+
+        cube.extend(datetime(2003, 6, 1))
+        self.assertEqual((138,), zarr.open_group(CUBE_DIR)['time'].shape)
+
+    def test_extend(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        cube.update(PeriodSourceProviderMock(cube.config))
+
+        # Cubes written by older versions have no record of written time steps
+        del zarr.open_group(CUBE_DIR).attrs['cube.completed']
+
+        cube = Cube.open(CUBE_DIR)
+        with self.assertRaises(ValueError):
+            cube.extend(datetime(2001, 6, 1))
+        start_time = cube.extend(datetime(2002, 6, 1))
+        self.assertEqual(datetime(2002, 1, 1), start_time)
+        self.assertEqual(datetime(2002, 6, 1), cube.config.end_time)
+        self.assertEqual(datetime(2002, 6, 1), Cube.open(CUBE_DIR).config.end_time)
+
+        provider = PeriodSourceProviderMock(cube.config)
+        cube.update(provider, start_time=start_time)
+        # Only the periods of the new year up to the end time are computed
+        self.assertEqual(19, len(provider.trace))
+        self.assertEqual(datetime(2002, 1, 1), provider.trace[0])
+
+        g = zarr.open_group(CUBE_DIR)
+        self.assertEqual((92, 18, 36), g['LAI'].shape)
+        self.assertEqual((92, 2), g['time_bnds'].shape)
+        self.assertEqual(369.0, g['time'][46])
+        self.assertEqual([365.0, 373.0], list(g['time_bnds'][46]))
+        lai = g['LAI'][:]
+        self.assertTrue(np.all(lai[45] == 1 + 8 * 45))
+        self.assertTrue(np.all(lai[46 + 18] == 1 + 8 * 18))
+        self.assertTrue(np.all(np.isnan(lai[46 + 19])))
+        self.assertEqual((92, 18, 36), cube.data['LAI'].shape)
+
+    def test_update_raises_write_errors(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        # Images are too small, so writing them must fail
+        provider = PeriodSourceProviderMock(CubeConfig(spatial_res=1.0, grid_width=18, grid_height=9))
+        with self.assertRaises(ValueError):
+            cube.update(provider, image_cache_size=4, write_queue_size=1)
+
+    def test_update_shuts_down_after_write_errors(self):
+        cube = Cube.create(CUBE_DIR, SMALL_CUBE_CONFIG)
+        closed_dir = tempfile.mkdtemp()
+        try:
+            # Images are too small, so writing them must fail
+            provider = WorkerSourceProviderMock(CubeConfig(spatial_res=1.0, grid_width=18, grid_height=9),
+                                                closed_dir)
+            with self.assertRaises(ValueError):
+                cube.update(provider, image_cache_size=4, workers=2, write_workers=2)
+            # The worker processes have exited and all providers have been closed
+            self.assertEqual([], multiprocessing.active_children())
+            pids = set(os.listdir(closed_dir))
+            self.assertIn(str(os.getpid()), pids)
+            self.assertGreaterEqual(len(pids), 2)
+        finally:
+            shutil.rmtree(closed_dir)
+
     def assert_cf_conformant_time_info(self, data):
         P = 8.  # period = 8d
         L = 506  # num periods
@@ -260,3 +556,77 @@ class CubeSourceProviderMock(CubeSourceProvider):
 
     def close(self):
         pass
+
+
+class PeriodSourceProviderMock(CubeSourceProvider):
+    """Provides images filled with the day of year of the requested period's start."""
+
+    def __init__(self, cube_config, name='period', var_name='LAI', end_time=None, fail_at=None):
+        super(PeriodSourceProviderMock, self).__init__(cube_config, name)
+        self.var_name = var_name
+        self.end_time = end_time or cube_config.end_time
+        self.fail_at = fail_at
+        self.trace = []
+
+    def prepare(self):
+        pass
+
+    @property
+    def temporal_coverage(self):
+        return self.cube_config.start_time, self.end_time
+
+    @property
+    def spatial_coverage(self):
+        return 0, 0, self.cube_config.grid_width, self.cube_config.grid_height
+
+    @property
+    def variable_descriptors(self):
+        return {
+            self.var_name: {
+                'data_type': np.float32,
+                'fill_value': np.nan,
+            }
+        }
+
+    def compute_variable_images(self, period_start, period_end):
+        if period_start == self.fail_at:
+            raise IOError('failed to read sources')
+        self.trace.append(period_start)
+        image_shape = (self.cube_config.grid_height, self.cube_config.grid_width)
+        day_of_year = period_start.timetuple().tm_yday
+        return {self.var_name: np.full(image_shape, day_of_year, dtype=np.float32)}
+
+    def close(self):
+        pass
+
+
+class FillingSourceProviderMock(PeriodSourceProviderMock):
+    """Provides images filled with fill values from *fill_from* on."""
+
+    def __init__(self, cube_config, fill_from=None):
+        super(FillingSourceProviderMock, self).__init__(cube_config)
+        self.fill_from = fill_from
+
+    def compute_variable_images(self, period_start, period_end):
+        images = super(FillingSourceProviderMock, self).compute_variable_images(period_start, period_end)
+        if period_start >= self.fill_from:
+            images[self.var_name][:] = np.nan
+        return images
+
+
+class WorkerSourceProviderMock(PeriodSourceProviderMock):
+    """Adds *offset* to the images and records the IDs of the processes that closed it in *closed_dir*."""
+
+    offset = 0
+
+    def __init__(self, cube_config, closed_dir):
+        super(WorkerSourceProviderMock, self).__init__(cube_config)
+        self.closed_dir = closed_dir
+
+    def compute_variable_images(self, period_start, period_end):
+        images = super(WorkerSourceProviderMock, self).compute_variable_images(period_start, period_end)
+        images[self.var_name] += self.offset
+        return images
+
+    def close(self):
+        open(os.path.join(self.closed_dir, str(os.getpid())), 'w').close()
@@ -1,10 +1,19 @@
-from datetime import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
 from unittest import TestCase
 
+import netCDF4
 import numpy
 
-from esdl import CubeConfig
-from esdl.cube_provider import BaseCubeSourceProvider, BaseStaticCubeSourceProvider
+from esdl import Cube, CubeConfig
+from esdl.cube_provider import BaseCubeSourceProvider, BaseStaticCubeSourceProvider, NetCDFCubeSourceProvider, \
+    _get_target_shift
+from esdl.util import temporal_weight
 
 
 class BaseCubeSourceProviderTest(TestCase):
@@ -60,6 +69,31 @@ class BaseCubeSourceProviderTest(TestCase):
         self.assertEqual([], provider.trace)
 
 
+    def test_get_images_weights_equal_linear_scan(self):
+        # Daily, 3-daily and 10-daily source ranges, some of them overlapping each other
+        source_time_ranges = []
+        for i in range(120):
+            start_time = datetime(2010, 1, 1) + timedelta(days=i)
+            source_time_ranges.append((start_time, start_time + timedelta(days=(1, 3, 10)[i % 3])))
+        source_time_ranges.append((datetime(2010, 1, 20), datetime(2010, 1, 20)))
+        source_time_ranges.sort(key=lambda item: item[0])
+        provider = MyCubeSourceProvider(CubeConfig(), source_time_ranges)
+        provider.prepare()
+
+        period_start = datetime(2009, 12, 1)
+        while period_start < datetime(2010, 6, 1):
+            period_end = period_start + timedelta(days=8)
+            expected_index_to_weight = dict()
+            for i, (source_start_time, source_end_time) in enumerate(source_time_ranges):
+                weight = temporal_weight(source_start_time, source_end_time, period_start, period_end)
+                if weight > 0.0:
+                    expected_index_to_weight[i] = weight
+            provider.trace = []
+            provider.compute_variable_images(period_start, period_end)
+            self.assertEqual([expected_index_to_weight] if expected_index_to_weight else [], provider.trace)
+            period_start += timedelta(days=5)
+
+
 class MyCubeSourceProvider(BaseCubeSourceProvider):
     def __init__(self, cube_config, source_time_ranges):
         super(MyCubeSourceProvider, self).__init__(cube_config, 'test')
@@ -153,3 +187,417 @@ class MyStaticCubeSourceProvider(BaseStaticCubeSourceProvider):
                 'ds_method': 'MODE'
             },
         }
+
+
+class NetCDFCubeSourceProviderTest(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        for month in range(1, 13):
+            with open(os.path.join(self.dir_path, 'source_%02d.txt' % month), 'w') as fp:
+                fp.write('2001-%02d-01' % month)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_scan_source_time_ranges(self):
+        provider = MyNetCDFCubeSourceProvider(CubeConfig(), self.dir_path)
+        try:
+            provider.prepare()
+            source_time_ranges = provider.source_time_ranges
+            self.assertEqual(24, len(source_time_ranges))
+            self.assertEqual((datetime(2001, 1, 1), datetime(2001, 1, 2),
+                              os.path.join(self.dir_path, 'source_01.txt'), 0), source_time_ranges[0])
+            self.assertEqual((datetime(2001, 12, 2), datetime(2001, 12, 3),
+                              os.path.join(self.dir_path, 'source_12.txt'), 1), source_time_ranges[-1])
+            self.assertEqual(sorted(source_time_ranges, key=lambda item: item[0]), source_time_ranges)
+            self.assertEqual(12, len(provider.read_files))
+
+            # The time ranges are now taken from the persistent index
+            provider = MyNetCDFCubeSourceProvider(CubeConfig(), self.dir_path)
+            provider.prepare()
+            self.assertEqual(source_time_ranges, provider.source_time_ranges)
+            self.assertEqual(0, len(provider.read_files))
+        finally:
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_scan_source_time_ranges_in_processes(self):
+        dir_path = os.path.join(self.dir_path, 'gz')
+        os.mkdir(dir_path)
+        for month in range(1, 13):
+            with gzip.open(os.path.join(dir_path, 'source_%02d.txt.gz' % month), 'wt') as fp:
+                fp.write('2001-%02d-01' % month)
+        reads_dir = os.path.join(self.dir_path, 'reads')
+        os.mkdir(reads_dir)
+        # Worker processes must use the dataset cache of this process, so the name must not depend on the pid
+        name = 'test_scanning_%d' % os.getpid()
+        provider = MyScanningCubeSourceProvider(CubeConfig(), dir_path, reads_dir, name)
+        try:
+            provider.prepare()
+            self.assertEqual(24, len(provider.source_time_ranges))
+            self.assertEqual((datetime(2001, 12, 2), datetime(2001, 12, 3),
+                              os.path.join(dir_path, 'source_12.txt.gz'), 1), provider.source_time_ranges[-1])
+            # Files are unpacked and read by the worker processes
+            reads = os.listdir(reads_dir)
+            self.assertEqual(12, len(reads))
+            read_pids = {int(read.split('-')[0]) for read in reads}
+            self.assertNotIn(os.getpid(), read_pids)
+            self.assertGreater(len(read_pids), 1)
+
+            # The time ranges read by the workers are in the persistent index
+            provider = MyScanningCubeSourceProvider(CubeConfig(), dir_path, reads_dir, name)
+            provider.prepare()
+            self.assertEqual(24, len(provider.source_time_ranges))
+            self.assertEqual(12, len(os.listdir(reads_dir)))
+        finally:
+            provider.close()
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_file_name_time_ranges(self):
+        dir_path = self.write_named_sources((1, 2, 3))
+        with open(os.path.join(dir_path, '20010104-myvar.nc'), 'w') as fp:
+            fp.write('not a netCDF file')
+        with open(os.path.join(dir_path, 'README'), 'w') as fp:
+            fp.write('not a source file')
+
+        provider = MyFileNameCubeSourceProvider(CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180),
+                                                dir_path)
+        try:
+            provider.prepare()
+            source_time_ranges = provider.source_time_ranges
+            self.assertEqual([(datetime(2001, 1, day), datetime(2001, 1, day + 1),
+                               os.path.join(dir_path, '2001010%d-myvar.nc' % day), 0) for day in (1, 2, 3, 4)],
+                             source_time_ranges)
+            # No source file has been opened
+            self.assertEqual(0, len(provider.read_files))
+            self.assertEqual(0, len(provider.dataset_cache._file_to_dataset))
+
+            images = provider.compute_variable_images(datetime(2001, 1, 3), datetime(2001, 1, 5))
+            numpy.testing.assert_almost_equal(images['myvar'], 3.0)
+            self.assertIsNone(provider.compute_variable_images(datetime(2001, 1, 4), datetime(2001, 1, 5)))
+        finally:
+            provider.close()
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+
+    def test_prefetch_source_images(self):
+        dir_path = self.write_named_sources(range(1, 25))
+        cube_config = CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180, end_time=datetime(2001, 1, 25))
+        provider = MyFileNameCubeSourceProvider(cube_config, dir_path)
+        non_prefetching_provider = MyFileNameCubeSourceProvider(cube_config, dir_path)
+        non_prefetching_provider.image_prefetch_depth = 0
+        try:
+            provider.prepare()
+            non_prefetching_provider.prepare()
+            for period_start in (datetime(2001, 1, 1), datetime(2001, 1, 9), datetime(2001, 1, 17)):
+                period_end = period_start + timedelta(days=8)
+                images = provider.compute_variable_images(period_start, period_end)
+                expected_images = non_prefetching_provider.compute_variable_images(period_start, period_end)
+                numpy.testing.assert_almost_equal(images['myvar'], expected_images['myvar'])
+                numpy.testing.assert_almost_equal(images['myvar'], period_start.day + 3.5)
+            # All images of the following periods have been read in the background
+            self.assertEqual(0, len(provider._prefetched_images))
+            self.assertGreaterEqual(provider.image_stall_time, 0.0)
+            self.assertEqual(24, provider.dataset_cache.stats['misses'])
+        finally:
+            provider.close()
+            non_prefetching_provider.close()
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_aggregate_while_reading(self):
+        dir_path = self.write_named_sources(range(1, 17))
+        cube_config = CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180, end_time=datetime(2001, 1, 17))
+        provider = MyFileNameCubeSourceProvider(cube_config, dir_path)
+        provider.image_prefetch_depth = 0
+        image_size = 180 * 360 * 4
+        try:
+            provider.prepare()
+            peak_sizes = []
+            for num_days in (2, 8):
+                period_start = datetime(2001, 1, 9 - num_days)
+                tracemalloc.start()
+                try:
+                    images = provider.compute_variable_images(period_start, datetime(2001, 1, 9))
+                    _, peak_size = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                numpy.testing.assert_almost_equal(images['myvar'], 8.5 - num_days / 2)
+                peak_sizes.append(peak_size)
+            # Every source image is added to the average as soon as it has been read
+            self.assertLess(peak_sizes[1], peak_sizes[0] + 2 * image_size)
+        finally:
+            provider.close()
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_read_hyperslabs(self):
+        file = self.write_daily_source()
+        for nan_source_images in (True, False):
+            provider = MyDailyCubeSourceProvider(CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180), file)
+            provider.nan_source_images = nan_source_images
+            try:
+                provider.prepare()
+                images = provider.compute_variable_images(datetime(2001, 1, 1), datetime(2001, 1, 9))
+                numpy.testing.assert_almost_equal(images['myvar'][1:, :], 3.5)
+                # The fill value is ignored in both read modes
+                self.assertAlmostEqual(images['myvar'][0, 0], (0 + 1 + 2 + 4 + 5 + 6 + 7) / 7)
+                images = provider.compute_variable_images(datetime(2001, 1, 9), datetime(2001, 1, 17))
+                numpy.testing.assert_almost_equal(images['myvar'], 11.5)
+                # Consecutive time indexes are read as one hyperslab per period
+                self.assertEqual([list(range(0, 8)), list(range(8, 16))], provider.index_runs)
+            finally:
+                provider.close()
+                shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_resampling_orders(self):
+        file = self.write_daily_source()
+        cube_config = CubeConfig(spatial_res=2.0, grid_width=180, grid_height=90)
+        # Target pixel (0, 0) covers 4 source pixels, one of them masked in 1 of 8 images
+        expected_values = {'time_first': (3 * 3.5 + 25 / 7) / 4,
+                           'space_first': 3.5,
+                           'fused': (4 * 28 - 3) / 31}
+        for resampling_order, expected_value in expected_values.items():
+            provider = MyDailyCubeSourceProvider(cube_config, file, resampling_order=resampling_order)
+            try:
+                provider.prepare()
+                images = provider.compute_variable_images(datetime(2001, 1, 1), datetime(2001, 1, 9))
+                self.assertEqual(images['myvar'].shape, (90, 180))
+                self.assertAlmostEqual(images['myvar'][0, 0], expected_value, places=5, msg=resampling_order)
+                numpy.testing.assert_almost_equal(images['myvar'][1:, :], 3.5, decimal=5)
+            finally:
+                provider.close()
+                shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_source_image_orientation(self):
+        file = os.path.join(self.dir_path, 'transposed.nc')
+        dataset = netCDF4.Dataset(file, 'w')
+        dataset.createDimension('time', 16)
+        dataset.createDimension('lon', 360)
+        dataset.createDimension('lat', 180)
+        variable = dataset.createVariable('myvar', 'f4', ('time', 'lon', 'lat'), fill_value=-1.0)
+        variable[:, :, :] = numpy.random.RandomState(0).random_sample((16, 360, 180))
+        variable[3, 10, 20] = numpy.ma.masked
+        dataset.close()
+
+        # The shift of 180 columns is applied to the target images, 1 column to every source image if downsampled
+        self.assertEqual(_get_target_shift(180, 360, 360, None), 180)
+        self.assertEqual(_get_target_shift(180, 360, 180, None), 90)
+        self.assertIsNone(_get_target_shift(1, 360, 180, None))
+
+        for shift in (180, 1):
+            for grid_width in (360, 180):
+                cube_config = CubeConfig(spatial_res=360 / grid_width, grid_width=grid_width,
+                                         grid_height=grid_width // 2)
+                for resampling_order in ('time_first', 'space_first', 'fused'):
+                    provider = MyDailyCubeSourceProvider(cube_config, file, resampling_order=resampling_order)
+                    provider.transpose_source_images = True
+                    provider.flip_source_images = True
+                    provider.shift_source_images = shift
+                    expected_provider = MyTransformingCubeSourceProvider(cube_config, file,
+                                                                         resampling_order=resampling_order)
+                    expected_provider.shift = shift
+                    try:
+                        provider.prepare()
+                        expected_provider.prepare()
+                        images = provider.compute_variable_images(datetime(2001, 1, 1), datetime(2001, 1, 9))
+                        expected_images = expected_provider.compute_variable_images(datetime(2001, 1, 1),
+                                                                                    datetime(2001, 1, 9))
+                        self.assertEqual(images['myvar'].shape, (grid_width // 2, grid_width))
+                        numpy.testing.assert_almost_equal(numpy.ma.filled(images['myvar'], numpy.nan),
+                                                          numpy.ma.filled(expected_images['myvar'], numpy.nan),
+                                                          decimal=5)
+                    finally:
+                        provider.close()
+                        expected_provider.close()
+                        shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+    def test_read_order_equivalence(self):
+        # Two files with two variables of 8 daily images each, with missing values that differ by variable
+        files = []
+        for file_index in range(2):
+            file = os.path.join(self.dir_path, 'two_vars_%d.nc' % file_index)
+            dataset = netCDF4.Dataset(file, 'w')
+            dataset.createDimension('time', 8)
+            dataset.createDimension('lat', 180)
+            dataset.createDimension('lon', 360)
+            for var_index, var_name in enumerate(('var_a', 'var_b')):
+                variable = dataset.createVariable(var_name, 'f4', ('time', 'lat', 'lon'), fill_value=-1.0)
+                for i in range(8):
+                    variable[i, :, :] = numpy.random.random((180, 360)) + 10 * var_index
+                    variable[i, i + var_index, 0:100] = numpy.ma.masked
+            dataset.close()
+            files.append(file)
+        cube_config = CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180)
+        provider = MyTwoVariableCubeSourceProvider(cube_config, files)
+        try:
+            provider.prepare()
+            # The period covers the last four images of the first file and the first four of the second one
+            images = provider.compute_variable_images(datetime(2001, 1, 5), datetime(2001, 1, 13))
+        finally:
+            provider.close()
+            shutil.rmtree(provider.dataset_cache.cache_dir, ignore_errors=True)
+
+        # Reference: every variable read on its own, one source image after another, then averaged
+        for var_name in ('var_a', 'var_b'):
+            source_images = []
+            for file, time_indexes in ((files[0], range(4, 8)), (files[1], range(0, 4))):
+                dataset = netCDF4.Dataset(file)
+                source_images.extend(dataset.variables[var_name][time_index, :, :] for time_index in time_indexes)
+                dataset.close()
+            expected_image = numpy.ma.mean(numpy.ma.stack(source_images), axis=0)
+            numpy.testing.assert_allclose(images[var_name], expected_image.filled(numpy.nan), rtol=1e-6)
+
+    def test_update_with_workers_reads_sources_once(self):
+        file = os.path.join(self.dir_path, 'daily_48.nc')
+        dataset = netCDF4.Dataset(file, 'w')
+        dataset.createDimension('time', 48)
+        dataset.createDimension('lat', 180)
+        dataset.createDimension('lon', 360)
+        variable = dataset.createVariable('myvar', 'f4', ('time', 'lat', 'lon'))
+        for i in range(48):
+            variable[i, :, :] = float(i)
+        dataset.close()
+        read_dir = os.path.join(self.dir_path, 'read')
+        os.mkdir(read_dir)
+        cube_config = CubeConfig(spatial_res=1.0, grid_width=360, grid_height=180,
+                                 start_time=datetime(2001, 1, 1), end_time=datetime(2002, 1, 1))
+        cube = Cube.create(os.path.join(self.dir_path, 'cube'), cube_config)
+        provider = MyCountingCubeSourceProvider(cube.config, file, read_dir)
+        cache_base_dir = os.path.dirname(provider.dataset_cache.cache_dir)
+        try:
+            cube.update(provider, workers=2)
+            self.assertAlmostEqual(3.5, float(cube.data['myvar'][0, 0, 0]))
+            self.assertAlmostEqual(43.5, float(cube.data['myvar'][5, 0, 0]))
+            # The workers prefetch no source images of periods computed by other workers
+            read_indexes = []
+            for pid in os.listdir(read_dir):
+                with open(os.path.join(read_dir, pid)) as fp:
+                    read_indexes.extend(int(line) for line in fp)
+            self.assertEqual(list(range(48)), sorted(read_indexes))
+        finally:
+            for pid in os.listdir(read_dir) + [str(os.getpid())]:
+                shutil.rmtree(os.path.join(cache_base_dir, 'test_netcdf_' + pid), ignore_errors=True)
+
+    def write_daily_source(self):
+        file = os.path.join(self.dir_path, 'daily.nc')
+        dataset = netCDF4.Dataset(file, 'w')
+        dataset.createDimension('time', 16)
+        dataset.createDimension('lat', 180)
+        dataset.createDimension('lon', 360)
+        variable = dataset.createVariable('myvar', 'f4', ('time', 'lat', 'lon'), fill_value=-1.0)
+        for i in range(16):
+            variable[i, :, :] = float(i)
+        variable[3, 0, 0] = numpy.ma.masked
+        dataset.close()
+        return file
+
+    def write_named_sources(self, days):
+        dir_path = os.path.join(self.dir_path, 'named')
+        os.mkdir(dir_path)
+        for day in days:
+            dataset = netCDF4.Dataset(os.path.join(dir_path, '200101%02d-myvar.nc' % day), 'w')
+            dataset.createDimension('lat', 180)
+            dataset.createDimension('lon', 360)
+            dataset.createVariable('myvar', 'f4', ('lat', 'lon'))[:, :] = float(day)
+            dataset.close()
+        return dir_path
+
+
+class MyNetCDFCubeSourceProvider(NetCDFCubeSourceProvider):
+    # Read files in this process, so that they are recorded in read_files
+    source_scan_workers = 1
+
+    def __init__(self, cube_config, dir_path, resampling_order=None, name=None):
+        super(MyNetCDFCubeSourceProvider, self).__init__(cube_config, name or 'test_netcdf_%d' % os.getpid(),
+                                                         dir_path, resampling_order)
+        self.read_files = []
+
+    @property
+    def variable_descriptors(self):
+        return {'myvar': {'data_type': numpy.float32, 'fill_value': numpy.nan}}
+
+    def compute_source_time_ranges(self):
+        return self.scan_source_time_ranges(os.path.join(self.dir_path, file_name)
+                                            for file_name in os.listdir(self.dir_path))
+
+    def read_file_time_ranges(self, file):
+        self.read_files.append(file)
+        with open(self.dataset_cache.unpack_file(file)) as fp:
+            t1 = datetime.strptime(fp.read(), '%Y-%m-%d')
+        return [(t1, t1 + timedelta(days=1), 0), (t1 + timedelta(days=1), t1 + timedelta(days=2), 1)]
+
+
+class MyScanningCubeSourceProvider(MyNetCDFCubeSourceProvider):
+    source_scan_workers = 2
+
+    def __init__(self, cube_config, dir_path, reads_dir, name):
+        super(MyScanningCubeSourceProvider, self).__init__(cube_config, dir_path, name=name)
+        self.reads_dir = reads_dir
+
+    def read_file_time_ranges(self, file):
+        # Record the read in a file, as reads happen in the worker processes
+        open(os.path.join(self.reads_dir, '%d-%s' % (os.getpid(), os.path.basename(file))), 'w').close()
+        # Wait a little so that both worker processes get busy
+        time.sleep(0.2)
+        return super(MyScanningCubeSourceProvider, self).read_file_time_ranges(file)
+
+
+class MyFileNameCubeSourceProvider(MyNetCDFCubeSourceProvider):
+    source_file_name_time = (r'^(\d{8})-', '%Y%m%d', timedelta(days=1))
+    skip_invalid_source_files = True
+
+
+class MyDailyCubeSourceProvider(MyNetCDFCubeSourceProvider):
+    image_prefetch_depth = 0
+
+    def __init__(self, cube_config, file, resampling_order=None):
+        super(MyDailyCubeSourceProvider, self).__init__(cube_config, os.path.dirname(file), resampling_order)
+        self.file = file
+        self.index_runs = []
+
+    def compute_source_time_ranges(self):
+        return [(datetime(2001, 1, 1 + i), datetime(2001, 1, 2 + i), self.file, i) for i in range(16)]
+
+    def _read_source_images(self, index_run, source_names):
+        self.index_runs.append(index_run)
+        return super(MyDailyCubeSourceProvider, self)._read_source_images(index_run, source_names)
+
+
+class MyTwoVariableCubeSourceProvider(MyNetCDFCubeSourceProvider):
+    def __init__(self, cube_config, files):
+        super(MyTwoVariableCubeSourceProvider, self).__init__(cube_config, os.path.dirname(files[0]))
+        self.files = files
+
+    @property
+    def variable_descriptors(self):
+        return {var_name: {'data_type': numpy.float32, 'fill_value': numpy.nan} for var_name in ('var_a', 'var_b')}
+
+    def compute_source_time_ranges(self):
+        return [(datetime(2001, 1, 1) + timedelta(days=8 * file_index + i),
+                 datetime(2001, 1, 2) + timedelta(days=8 * file_index + i), file, i)
+                for file_index, file in enumerate(self.files) for i in range(8)]
+
+
+class MyCountingCubeSourceProvider(MyNetCDFCubeSourceProvider):
+    """Prefetches source images and records the source indexes read by each process in *read_dir*."""
+
+    image_prefetch_depth = 2
+
+    def __init__(self, cube_config, file, read_dir):
+        super(MyCountingCubeSourceProvider, self).__init__(cube_config, os.path.dirname(file))
+        self.file = file
+        self.read_dir = read_dir
+
+    def compute_source_time_ranges(self):
+        return [(datetime(2001, 1, 1) + timedelta(days=i), datetime(2001, 1, 2) + timedelta(days=i), self.file, i)
+                for i in range(48)]
+
+    def _read_source_images(self, index_run, source_names):
+        with open(os.path.join(self.read_dir, str(os.getpid())), 'a') as fp:
+            fp.write(''.join('%d\n' % i for i in index_run))
+        return super(MyCountingCubeSourceProvider, self)._read_source_images(index_run, source_names)
+
+
+class MyTransformingCubeSourceProvider(MyDailyCubeSourceProvider):
+    shift = 0
+
+    def transform_source_image(self, source_image):
+        return numpy.roll(numpy.flipud(source_image.T), self.shift, axis=1)
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+import gridtools.resampling as gtr
+import numpy as np
+
+from esdl.resampling import ResamplingAccumulator, resample_2d, get_resampling_plan
+
+
+class ResamplingTest(TestCase):
+    def test_get_resampling_plan(self):
+        plan = get_resampling_plan((3600, 7200), 1440, 720, gtr.DS_MEAN, gtr.US_NEAREST)
+        self.assertIsNotNone(plan)
+        self.assertEqual(plan.src_shape, (3600, 7200))
+        self.assertEqual(plan.shape, (720, 1440))
+        self.assertIs(get_resampling_plan((3600, 7200), 1440, 720, gtr.DS_MEAN, gtr.US_NEAREST), plan)
+
+        self.assertIsNotNone(get_resampling_plan((180, 360), 1440, 720, gtr.DS_MEAN, gtr.US_NEAREST))
+        self.assertIsNone(get_resampling_plan((3600, 7200), 1440, 720, gtr.DS_MODE, gtr.US_NEAREST))
+        self.assertIsNone(get_resampling_plan((180, 360), 1440, 720, gtr.DS_MEAN, gtr.US_LINEAR))
+        self.assertIsNone(get_resampling_plan((500, 1000), 1440, 720, gtr.DS_MEAN, gtr.US_NEAREST))
+        self.assertIsNone(get_resampling_plan((1000, 1000), 1440, 720, gtr.DS_MEAN, gtr.US_NEAREST))
+
+    def test_downsample_mean(self):
+        src = np.array([[1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+                        [7.0, 8.0, 9.0, 10.0, 11.0, 12.0],
+                        [13.0, 14.0, np.nan, 16.0, np.nan, np.nan],
+                        [19.0, 20.0, 21.0, 22.0, np.nan, np.nan]], dtype=np.float32)
+        out = resample_2d(src, 4, 2, ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST, fill_value=-1.0)
+        self.assertEqual(out.dtype, np.float32)
+        # Each target cell covers 1.5 source columns
+        np.testing.assert_almost_equal(out, [[(1 + 0.5 * 2 + 7 + 0.5 * 8) / 3,
+                                              (0.5 * 2 + 3 + 0.5 * 8 + 9) / 3,
+                                              (4 + 0.5 * 5 + 10 + 0.5 * 11) / 3,
+                                              (0.5 * 5 + 6 + 0.5 * 11 + 12) / 3],
+                                             [(13 + 0.5 * 14 + 19 + 0.5 * 20) / 3,
+                                              (0.5 * 14 + 0.5 * 20 + 21) / 2,
+                                              (16 + 22) / 2,
+                                              -1.0]], decimal=5)
+
+        masked_src = np.ma.masked_array(src, mask=np.isnan(src))
+        masked_src.data[np.isnan(src)] = 0.0
+        masked_src.mask[0, 0] = True
+        out = resample_2d(masked_src, 4, 2, ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST, fill_value=np.nan)
+        self.assertNotIsInstance(out, np.ma.MaskedArray)
+        self.assertAlmostEqual(out[0, 0], (0.5 * 2 + 7 + 0.5 * 8) / 2, places=5)
+        self.assertAlmostEqual(out[1, 2], (16 + 22) / 2, places=5)
+        self.assertTrue(np.isnan(out[1, 3]))
+
+    def test_upsample_nearest(self):
+        src = np.array([[1.0, np.nan], [3.0, 4.0]])
+        out = resample_2d(src, 4, 4, ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST, fill_value=-1.0)
+        np.testing.assert_equal(out, [[1.0, 1.0, -1.0, -1.0],
+                                      [1.0, 1.0, -1.0, -1.0],
+                                      [3.0, 3.0, 4.0, 4.0],
+                                      [3.0, 3.0, 4.0, 4.0]])
+
+    def test_same_shape(self):
+        src = np.zeros((2, 4))
+        self.assertIs(resample_2d(src, 4, 2, fill_value=np.nan), src)
+
+    def test_resampling_accumulator(self):
+        im1 = np.array([[1.0, 2.0, 3.0, 4.0], [5.0, 6.0, 7.0, np.nan]], dtype=np.float32)
+        im2 = np.ma.masked_array([[2.0, 3.0, 4.0, 5.0], [6.0, 7.0, 8.0, 9.0]], mask=[[1, 0, 0, 0], [0, 0, 0, 0]])
+
+        accumulator = ResamplingAccumulator(2, 1, ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST)
+        accumulator.add(im1, 0.5)
+        accumulator.add(im2, 1.0)
+        out = accumulator.get_image()
+        self.assertEqual(out.dtype, np.float64)
+        np.testing.assert_almost_equal(out, [[(0.5 * (1 + 2 + 5 + 6) + 3 + 6 + 7) / (0.5 * 4 + 3),
+                                              (0.5 * (3 + 4 + 7) + 4 + 5 + 8 + 9) / (0.5 * 3 + 4)]])
+
+        # Without a resampling plan, the images are averaged first
+        accumulator = ResamplingAccumulator(2, 1, ds_method=gtr.DS_MEAN, us_method=gtr.US_NEAREST)
+        accumulator.add(np.ones((2, 4), dtype=np.int16), 0.5)
+        accumulator.add(np.zeros((2, 4), dtype=np.int16), 0.5)
+        np.testing.assert_almost_equal(accumulator.get_image(), [[0.5, 0.5]])
@@ -1,12 +1,23 @@
+import gzip
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 import unittest
 
+import netCDF4
 import numpy
 
 from esdl.util import temporal_weight
 from esdl.util import resolve_temporal_range_index
-from esdl.util import aggregate_images
+from esdl.util import aggregate_images, ImageAccumulator
+from esdl.util import SourceTimeRangeIndex
+from esdl.util import DatasetCache
+from esdl.util import read_nan_array
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 class UtilTest(unittest.TestCase):
@@ -58,6 +69,36 @@ class UtilTest(unittest.TestCase):
 
         self.assertEqual(im[0][0], 0.75)
 
+    def test_image_accumulator(self):
+        im1 = numpy.ma.masked_array([[1.1, 2.1], [3.1, 4.1]], mask=[[1, 0], [1, 0]])
+        im2 = numpy.ma.masked_array([[2.2, 3.2], [4.2, 5.2]], mask=[[0, 1], [1, 0]])
+        im3 = numpy.array([[3.3, numpy.nan], [5.3, 6.3]], dtype=numpy.float32)
+
+        accumulator = ImageAccumulator()
+        with self.assertRaises(ValueError):
+            accumulator.get_image()
+        for image, weight in ((im1, 0.5), (im2, 1.0), (im3, 0.0)):
+            accumulator.add(image, weight)
+        im = accumulator.get_image()
+
+        self.assertEqual(im.dtype, numpy.float64)
+        numpy.testing.assert_equal(numpy.ma.getmaskarray(im), [[False, True], [True, False]])
+        numpy.testing.assert_equal(im, aggregate_images((im1, im2, im3), weights=(0.5, 1.0, 0.0)))
+        self.assertAlmostEqual(im[0][0], 2.2)
+        self.assertAlmostEqual(im[1][1], (0.5 * 4.1 + 1.0 * 5.2) / 1.5)
+
+    def test_image_accumulator_skip_nan(self):
+        im1 = numpy.array([[1.0, numpy.nan], [3.0, numpy.nan]], dtype=numpy.float32)
+        im2 = numpy.array([[2.0, 4.0], [numpy.nan, numpy.nan]], dtype=numpy.float32)
+
+        accumulator = ImageAccumulator(skip_nan=True)
+        accumulator.add(im1, 0.5)
+        accumulator.add(im2, 1.0)
+        im = accumulator.get_image()
+
+        self.assertNotIsInstance(im, numpy.ma.MaskedArray)
+        numpy.testing.assert_almost_equal(im, [[(0.5 * 1.0 + 2.0) / 1.5, 4.0], [3.0, numpy.nan]])
+
     def test_resolve_temporal_range_index(self):
         time1_index, time2_index = resolve_temporal_range_index(2001, 2011, 8,
                                                                 datetime(2001, 1, 1),
@@ -88,3 +129,231 @@ class UtilTest(unittest.TestCase):
                                                                 datetime(2020, 12, 31))
         self.assertEqual(time1_index, 0)
         self.assertEqual(time2_index, 505)
+
+
+class ReadNanArrayTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.temp_dir, 'test.nc')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_read_nan_array(self):
+        data = numpy.arange(-10, 14, dtype=numpy.int16).reshape((2, 3, 4))
+        dataset = netCDF4.Dataset(self.file, 'w')
+        dataset.createDimension('time', 2)
+        dataset.createDimension('lat', 3)
+        dataset.createDimension('lon', 4)
+        variables = [dataset.createVariable('fill', 'f4', ('time', 'lat', 'lon'), fill_value=-5.0),
+                     dataset.createVariable('default_fill', 'f8', ('time', 'lat', 'lon')),
+                     dataset.createVariable('packed', 'i2', ('time', 'lat', 'lon'), fill_value=-10),
+                     dataset.createVariable('valid', 'i2', ('time', 'lat', 'lon')),
+                     dataset.createVariable('unsigned', 'i1', ('time', 'lat', 'lon'))]
+        dataset['packed'].setncatts({'scale_factor': numpy.float32(0.5), 'add_offset': numpy.float32(1.0)})
+        dataset['valid'].setncatts({'valid_range': numpy.array([-5, 5], numpy.int16), 'missing_value': 0})
+        dataset['unsigned'].setncatts({'_Unsigned': 'true', 'scale_factor': numpy.float32(2.0)})
+        for variable in variables:
+            variable.set_auto_maskandscale(False)
+            variable[:] = data
+        dataset['default_fill'][0, 0, 0] = netCDF4.default_fillvals['f8']
+        dataset.close()
+
+        dataset = netCDF4.Dataset(self.file)
+        try:
+            for variable in dataset.variables.values():
+                for key in (1, slice(0, 2)):
+                    expected = variable[key]
+                    actual = read_nan_array(variable, key)
+                    self.assertNotIsInstance(actual, numpy.ma.MaskedArray)
+                    self.assertEqual(actual.dtype, numpy.float64 if variable.name == 'default_fill' else numpy.float32)
+                    numpy.testing.assert_equal(actual, numpy.ma.filled(expected.astype(actual.dtype), numpy.nan))
+                self.assertTrue(variable.mask)
+                self.assertTrue(variable.scale)
+        finally:
+            dataset.close()
+
+
+class SourceTimeRangeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.temp_dir, 'cache', 'source-time-ranges.json')
+        self.source_file = os.path.join(self.temp_dir, 'source.nc')
+        with open(self.source_file, 'w') as fp:
+            fp.write('2001-01-01')
+        self.read_files = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read_time_ranges(self, file):
+        self.read_files.append(file)
+        with open(file) as fp:
+            t1 = datetime.strptime(fp.read(), '%Y-%m-%d')
+        return [(t1, t1 + timedelta(days=1), 0), (t1 + timedelta(days=1), t1 + timedelta(days=2), 1)]
+
+    def test_get_time_ranges(self):
+        expected_time_ranges = [(datetime(2001, 1, 1), datetime(2001, 1, 2), 0),
+                                (datetime(2001, 1, 2), datetime(2001, 1, 3), 1)]
+
+        index = SourceTimeRangeIndex(self.index_file)
+        self.assertEqual(expected_time_ranges, index.get_time_ranges(self.source_file, self.read_time_ranges))
+        self.assertEqual(expected_time_ranges, index.get_time_ranges(self.source_file, self.read_time_ranges))
+        self.assertEqual(1, len(self.read_files))
+        index.save()
+        self.assertTrue(os.path.exists(self.index_file))
+
+        # A new index reuses the saved entries
+        index = SourceTimeRangeIndex(self.index_file)
+        self.assertEqual(expected_time_ranges, index.get_time_ranges(self.source_file, self.read_time_ranges))
+        self.assertEqual(1, len(self.read_files))
+
+        # Changed files are read again
+        with open(self.source_file, 'w') as fp:
+            fp.write('2002-01-01')
+        mtime = os.stat(self.source_file).st_mtime + 10
+        os.utime(self.source_file, (mtime, mtime))
+        index = SourceTimeRangeIndex(self.index_file)
+        time_ranges = index.get_time_ranges(self.source_file, self.read_time_ranges)
+        self.assertEqual(datetime(2002, 1, 1), time_ranges[0][0])
+        self.assertEqual(2, len(self.read_files))
+
+
+class DatasetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(4):
+            file = os.path.join(self.temp_dir, 'source_%d.nc' % i)
+            with open(file, 'w') as fp:
+                fp.write('x' * 100)
+            self.files.append(file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_max_open_datasets(self):
+        evicted_files = []
+        cache = MyDatasetCache(self.temp_dir, max_open_datasets=2,
+                               eviction_callback=lambda file, dataset: evicted_files.append(file))
+        dataset_0 = cache.get_dataset(self.files[0])
+        cache.get_dataset(self.files[1])
+        self.assertIs(dataset_0, cache.get_dataset(self.files[0]))
+        cache.get_dataset(self.files[2])
+        # files[1] has been used least recently
+        self.assertEqual([self.files[1]], evicted_files)
+        self.assertIsNone(cache.get_cached_dataset(self.files[1]))
+        self.assertFalse(dataset_0.closed)
+        self.assertEqual(dict(hits=1, misses=3, evictions=1, open_datasets=2, bytes=0), cache.stats)
+
+        cache.close_all_datasets()
+        self.assertTrue(dataset_0.closed)
+        self.assertEqual(0, cache.stats['open_datasets'])
+
+    def test_max_bytes(self):
+        cache = MyDatasetCache(self.temp_dir, max_bytes=250)
+        for file in self.files:
+            cache.get_dataset(file)
+        self.assertEqual(dict(hits=0, misses=4, evictions=2, open_datasets=2, bytes=200), cache.stats)
+        self.assertEqual(self.files[2:], list(cache._file_to_dataset.keys()))
+
+        # The most recently used dataset is kept even if it is too big on its own
+        cache = MyDatasetCache(self.temp_dir, max_bytes=50)
+        self.assertIsNotNone(cache.get_dataset(self.files[0]))
+        self.assertEqual(1, cache.stats['open_datasets'])
+
+
+    def test_unpacked_files(self):
+        packed_files = []
+        for i in range(4):
+            packed_file = os.path.join(self.temp_dir, 'packed_%d.nc.gz' % i)
+            with gzip.open(packed_file, 'wb') as fp:
+                fp.write(bytes([i]) * 1000)
+            packed_files.append(packed_file)
+        cache_dir = os.path.join(self.temp_dir, 'test')
+
+        cache = MyDatasetCache(self.temp_dir, max_unpacked_bytes=2500)
+        cache.prefetch_unpacked_files(packed_files[0:2])
+        cache.get_dataset(packed_files[0])
+        cache.get_dataset(packed_files[1])
+        with open(os.path.join(cache_dir, 'packed_1.nc'), 'rb') as fp:
+            self.assertEqual(bytes([1]) * 1000, fp.read())
+        cache.close_all_datasets()
+
+        # Mark packed_1.nc as older than packed_0.nc
+        mtime = os.stat(os.path.join(cache_dir, 'packed_1.nc')).st_mtime - 10
+        os.utime(os.path.join(cache_dir, 'packed_1.nc'), (mtime, mtime))
+        cache.get_dataset(packed_files[2])
+        lock_file_2 = 'packed_2.nc.%d@%s.lock' % (os.getpid(), socket.gethostname())
+        self.assertEqual(['packed_0.nc', 'packed_2.nc', lock_file_2], sorted(os.listdir(cache_dir)))
+        cache.get_dataset(packed_files[3])
+        lock_file_3 = 'packed_3.nc.%d@%s.lock' % (os.getpid(), socket.gethostname())
+        self.assertEqual(['packed_2.nc', lock_file_2, 'packed_3.nc', lock_file_3], sorted(os.listdir(cache_dir)))
+        cache.close_all_datasets()
+        self.assertEqual(['packed_2.nc', 'packed_3.nc'], sorted(os.listdir(cache_dir)))
+
+    def test_unpacked_files_locked_by_other_processes(self):
+        packed_files = []
+        for i in range(3):
+            packed_file = os.path.join(self.temp_dir, 'packed_%d.nc.gz' % i)
+            with gzip.open(packed_file, 'wb') as fp:
+                fp.write(bytes([i]) * 1000)
+            packed_files.append(packed_file)
+        cache_dir = os.path.join(self.temp_dir, 'test')
+        cache = MyDatasetCache(self.temp_dir)
+        for packed_file in packed_files[0:2]:
+            cache.get_dataset(packed_file)
+        cache.close_all_datasets()
+        # packed_0.nc is used by a running process, packed_1.nc by a process that has exited
+        host_name = socket.gethostname()
+        exited_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited_process.wait()
+        open(os.path.join(cache_dir, 'packed_0.nc.%d@%s.lock' % (os.getppid(), host_name)), 'w').close()
+        open(os.path.join(cache_dir, 'packed_1.nc.%d@%s.lock' % (exited_process.pid, host_name)), 'w').close()
+
+        cache = MyDatasetCache(self.temp_dir, max_unpacked_bytes=1500)
+        cache.get_dataset(packed_files[2])
+        self.assertEqual(['packed_0.nc', 'packed_0.nc.%d@%s.lock' % (os.getppid(), host_name),
+                          'packed_2.nc', 'packed_2.nc.%d@%s.lock' % (os.getpid(), host_name)],
+                         sorted(os.listdir(cache_dir)))
+        cache.close_all_datasets()
+
+    def test_unpacked_files_locked_on_other_hosts(self):
+        packed_files = []
+        for i in range(2):
+            packed_file = os.path.join(self.temp_dir, 'packed_%d.nc.gz' % i)
+            with gzip.open(packed_file, 'wb') as fp:
+                fp.write(bytes([i]) * 1000)
+            packed_files.append(packed_file)
+        cache_dir = os.path.join(self.temp_dir, 'test')
+        cache = MyDatasetCache(self.temp_dir)
+        cache.get_dataset(packed_files[0])
+        cache.close_all_datasets()
+        # The process ID is not running here, but may be running on the other host
+        exited_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited_process.wait()
+        other_lock_file = 'packed_0.nc.%d@other-host.example.org.lock' % exited_process.pid
+        open(os.path.join(cache_dir, other_lock_file), 'w').close()
+
+        cache = MyDatasetCache(self.temp_dir, max_unpacked_bytes=1500)
+        cache.get_dataset(packed_files[1])
+        self.assertEqual(['packed_0.nc', other_lock_file,
+                          'packed_1.nc', 'packed_1.nc.%d@%s.lock' % (os.getpid(), socket.gethostname())],
+                         sorted(os.listdir(cache_dir)))
+        cache.close_all_datasets()
+
+
+class MyDatasetCache(DatasetCache):
+    def __init__(self, cache_base_dir, **kwargs):
+        super(MyDatasetCache, self).__init__('test', cache_base_dir=cache_base_dir, **kwargs)
+
+    def open_dataset(self, file):
+        return MyDataset()
+
+
+class MyDataset:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True